@@ -3,25 +3,31 @@ Cori+
 =====
 
 The root module of the package.
-This module also contains very basic web hooks, such as robots.txt.
+This module contains the app factory, `create_app()`, and also very
+basic web hooks, such as robots.txt.
 
 For the website hooks, see `app.website`.
 For the AJAX hook, see `app.ajax`.
 For public API, see `app.api`.
-For report pages, see `app.reports`.
-For site administration, see `app.admin`.
+For report pages, see `app.reports` (lazily imported).
+For site administration, see `app.admin` (lazily imported).
 For template filters, see `app.filters`.
+For JSON serialization and compression, see `app.jsonprovider` and `app.compress`.
 For the database models, see `app.models`.
+For command line tools, see `app.cli`.
 For other, see `app.utils`.
 '''
 
 from flask import (
-    Flask, abort, flash, g, jsonify, redirect, render_template, request,
-    send_from_directory, session, url_for, __version__ as flask_version)
+    Blueprint, Flask, abort, current_app, flash, g, jsonify, redirect,
+    render_template, request, send_from_directory, session, url_for,
+    __version__ as flask_version)
 import hashlib
 import datetime, time, re, os, sys, string, json, html
 from functools import wraps
 from flask_login import LoginManager
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.utils import import_string
 
 __version__ = '0.9-dev'
 
@@ -30,65 +36,60 @@ __version__ = '0.9-dev'
 if sys.version_info[0] < 3:
     raise RuntimeError('Python 3 required')
 
-os.chdir(os.path.dirname(os.path.dirname(__file__)))
-
-app = Flask(__name__)
-app.config.from_pyfile('../config.py')
-
-login_manager = LoginManager(app)
+login_manager = LoginManager()
 
 from .models import *
 
 from .utils import *
 
-from .filters import *
+from . import jsonprovider, compress, filters, upvotes, ratelimit, cache, identity, storage, \
+    traffic, notifications, backup
 
 ### WEB ###
 
 login_manager.login_view = 'website.login'
 
-@app.before_request
+bp = Blueprint('root', __name__)
+
 def before_request():
+    # changed in 0.9: connections are opened on first use, so requests
+    # that only read never take the writer connection.
     g.db = database
-    try:
-        g.db.connect()
-    except OperationalError:
-        sys.stderr.write('database connected twice.\n')
 
-@app.after_request
 def after_request(response):
-    g.db.close()
+    # not g.db, since it's unset if a hook answered before before_request()
+    database.close()
     return response
 
-@app.context_processor
 def _inject_variables():
     return {
-        'site_name': app.config['SITE_NAME'],
+        'site_name': current_app.config['SITE_NAME'],
         'locations': locations,
         'inline_svg': inline_svg
     }
 
 @login_manager.user_loader
 def _inject_user(userid):
-    return User[userid]
+    # changed in 0.9: cached
+    return get_user(int(userid))
 
-@app.errorhandler(404)
 def error_404(body):
     return render_template('404.html'), 404
     
-@app.route('/favicon.ico')
+@bp.route('/favicon.ico')
 def favicon_ico():
-    return send_from_directory(os.getcwd(), 'favicon.ico')
+    return send_from_directory(BASE_DIR, 'favicon.ico')
 
-@app.route('/robots.txt')
+@bp.route('/robots.txt')
 def robots_txt():
-    return send_from_directory(os.getcwd(), 'robots.txt')
+    return send_from_directory(BASE_DIR, 'robots.txt')
 
-@app.route('/uploads/<id>.<type>')
-def uploads(id, type='jpg'):
-    return send_from_directory(UPLOAD_DIRECTORY, id + '.' + type)
+# changed in 0.9: files are named by digest (see `app.storage`)
+@bp.route('/uploads/<name>.<type>')
+def uploads(name, type='jpg'):
+    return storage.send_upload(name, type)
 
-@app.route('/get_access_token', methods=['POST'])
+@bp.route('/get_access_token', methods=['POST'])
 def send_access_token():
     try:
         data = request.get_json(True)
@@ -122,17 +123,91 @@ def send_access_token():
             'status': 'fail'
         })
 
-from .website import bp
-app.register_blueprint(bp)
-
-from .ajax import bp
-app.register_blueprint(bp)
-
-from .api import bp
-app.register_blueprint(bp)
-
-from .reports import bp
-app.register_blueprint(bp)
-
-from .admin import bp
-app.register_blueprint(bp)
+from . import website, ajax, api, cli
+
+class LazyView(object):
+    '''
+    A view function imported on first use. New in 0.9.
+    '''
+    def __init__(self, import_name):
+        self.import_name = import_name
+        self.view = None
+    def __call__(self, *args, **kwargs):
+        if self.view is None:
+            self.view = import_string(self.import_name)
+        return self.view(*args, **kwargs)
+
+# Rarely used views, imported on first use. New in 0.9.
+LAZY_VIEWS = [
+    # (rule, endpoint, import name, methods)
+    ('/report/user/<int:userid>', 'reports.report_user', 'app.reports.report_user',
+        ['GET', 'POST']),
+    ('/report/message/<int:userid>', 'reports.report_message', 'app.reports.report_message',
+        ['GET', 'POST']),
+    ('/report/done', 'reports.report_done', 'app.reports.report_done', ['GET', 'POST']),
+    ('/admin/', 'admin.homepage', 'app.admin.homepage', ['GET']),
+    ('/admin/reports', 'admin.reports', 'app.admin.reports', ['GET']),
+    ('/admin/reports/<int:id>', 'admin.reports_detail', 'app.admin.reports_detail',
+        ['GET', 'POST']),
+]
+
+def create_app(config=None):
+    '''
+    Create the app. New in 0.9.
+
+    Config is loaded, in order, from `config.py` in the package's parent
+    directory, from the file named by the `CORIPLUS_CONFIG` environment
+    variable, from environment variables starting with `CORIPLUS_` (e.g.
+    `CORIPLUS_SECRET_KEY`), and at last from the config mapping, if given.
+    The database is at `DATABASE`, defaulting to `coriplus.sqlite` in the
+    package's parent directory; up to `DATABASE_READERS` idle read-only
+    connections are pooled (0 sends every query to the writer). Old
+    messages may be moved into the database at `ARCHIVE_DATABASE`.
+
+    Nothing is connected at creation time, so the app can be created
+    before forking worker processes (e.g. `gunicorn --preload`).
+    '''
+    app = Flask(__name__)
+    app.config['SITE_NAME'] = 'Cori+'
+    app.config['DATABASE'] = os.path.join(BASE_DIR, 'coriplus.sqlite')
+    app.config['DATABASE_READERS'] = 4
+    app.config.from_pyfile(os.path.join(BASE_DIR, 'config.py'), silent=True)
+    app.config.from_envvar('CORIPLUS_CONFIG', silent=True)
+    app.config.from_prefixed_env('CORIPLUS')
+    if config:
+        app.config.update(config)
+
+    if app.config.get('TEMPLATE_BYTECODE_CACHE', True):
+        # set before the template environment is created
+        app.jinja_options = dict(app.jinja_options,
+            bytecode_cache=FileSystemBytecodeCache(app.config.get('TEMPLATE_CACHE_DIR')))
+
+    init_database(app.config['DATABASE'], readers=app.config['DATABASE_READERS'],
+        archive=app.config.get('ARCHIVE_DATABASE'))
+    # first, so that the recorded timings include the other hooks
+    traffic.init_app(app)
+    login_manager.init_app(app)
+    jsonprovider.init_app(app)
+    compress.init_app(app)
+    upvotes.init_app(app)
+    ratelimit.init_app(app)
+    cache.init_app(app)
+    identity.init_app(app)
+    storage.init_app(app)
+    notifications.init_app(app)
+    backup.init_app(app)
+    filters.init_app(app)
+
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.context_processor(_inject_variables)
+    app.register_error_handler(404, error_404)
+
+    app.register_blueprint(bp)
+    app.register_blueprint(website.bp)
+    app.register_blueprint(ajax.bp)
+    app.register_blueprint(api.bp)
+    app.register_blueprint(cli.bp)
+    for rule, endpoint, import_name, methods in LAZY_VIEWS:
+        app.add_url_rule(rule, endpoint, LazyView(import_name), methods=methods)
+    return app
@@ -7,7 +7,7 @@ XXX Using "--debug" argument currently causes an ImportError.
 '''
 
 import argparse
-from . import app
+from . import create_app
 from .models import create_tables
 
 arg_parser = argparse.ArgumentParser()
@@ -22,6 +22,8 @@ arg_parser.add_argument('-p', '--port', type=int, default=5000,
 
 args = arg_parser.parse_args()
 
+app = create_app()
+
 if not args.no_create_tables:
     create_tables()
 
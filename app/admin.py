@@ -2,16 +2,21 @@
 Management of reports and the entire site.
 
 New in 0.8.
+Changed in 0.9: since rarely used, this module is imported on first use;
+its routes are in `app.LAZY_VIEWS`.
 '''
 
-from flask import Blueprint, redirect, render_template, request, url_for
+from flask import redirect, render_template, request, url_for
 from .models import User, Message, Report, report_reasons, REPORT_STATUS_ACCEPTED, \
-    REPORT_MEDIA_USER, REPORT_MEDIA_MESSAGE
-from .utils import pwdhash, object_list
+    REPORT_STATUS_DECLINED, \
+    REPORT_MEDIA_USER, REPORT_MEDIA_MESSAGE, database
+from .utils import pwdhash
+from .moderation import refresh_summary, get_queue_query, load_queue_page
+from .cleanup import delete_messages
+from .cache import cache
+from .identity import identity_map
 from functools import wraps
 
-bp = Blueprint('admin', __name__, url_prefix='/admin')
-
 def check_auth(username, password):
     try:
         return User.get((User.username == username) & (User.password == pwdhash(password))
@@ -31,29 +36,35 @@ def admin_required(f):
     return wrapped_view
 
 def review_reports(status, media_type, media_id):
-    (Report
-     .update(status=status)
-     .where((Report.media_type == media_type) & (Report.media_id == media_id))
-     .execute())
+    with database.atomic():
+        (Report
+         .update(status=status)
+         .where((Report.media_type == media_type) & (Report.media_id == media_id))
+         .execute())
+        refresh_summary(media_type, media_id)
     if status == REPORT_STATUS_ACCEPTED:
         if media_type == REPORT_MEDIA_USER:
             user = User[media_id]
             user.is_disabled = 2
             user.save()
         elif media_type == REPORT_MEDIA_MESSAGE:
-            Message.delete().where(Message.id == media_id).execute()
+            delete_messages([media_id])
 
-@bp.route('/')
 @admin_required
 def homepage():
-    return render_template('admin_home.html')
+    return render_template('admin_home.html', cache_stats=cache.stats(),
+        identity_stats=identity_map.stats())
 
-@bp.route('/reports')
 @admin_required
 def reports():
-    return object_list('admin_reports.html', Report.select().order_by(Report.created_date.desc()), 'report_list', report_reasons=dict(report_reasons))
+    # changed in 0.9: reports are grouped per reported user or message
+    query = get_queue_query()
+    page = int(request.args.get('page', 1))
+    return render_template('admin_reports.html',
+        queue=load_queue_page(query.paginate(page, 20)),
+        page=page, pages=query.count() // 20 + 1,
+        report_reasons=dict(report_reasons))
 
-@bp.route('/reports/<int:id>', methods=['GET', 'POST'])
 @admin_required
 def reports_detail(id):
     report = Report[id]
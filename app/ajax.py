@@ -5,9 +5,9 @@ Warning: this is not the public API.
 '''
 
 from flask import Blueprint, jsonify
-from .models import User, Message, MessageUpvote
+from .models import User, Message
+from .upvotes import upvote_buffer
 from .utils import locations, get_current_user, is_username
-import datetime
 
 bp = Blueprint('ajax', __name__, url_prefix='/ajax')
 
@@ -39,27 +39,11 @@ def location_search(name):
 
 @bp.route('/score/<int:id>/toggle', methods=['POST'])
 def score_toggle(id):
+    # changed in 0.9: toggles are buffered (see `app.upvotes`)
     user = get_current_user()
     message = Message[id]
-    upvoted_by_self = (MessageUpvote
-            .select()
-            .where((MessageUpvote.message == message) & (MessageUpvote.user == user))
-            .exists())
-    if upvoted_by_self:
-        (MessageUpvote
-         .delete()
-         .where(
-            (MessageUpvote.message == message) &
-            (MessageUpvote.user == user))
-         .execute()
-        )
-    else:
-        MessageUpvote.create(
-            message=message,
-            user=user,
-            created_date=datetime.datetime.now()
-        )
+    upvote_buffer.set(message.id, user.id)
     return jsonify({
-        "score": message.score,
+        "score": upvote_buffer.score(message.id),
         "status": "ok"
     })
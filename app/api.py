@@ -1,12 +1,24 @@
-from flask import Blueprint, jsonify, request
-import sys, os, datetime, re, uuid
+from flask import Blueprint, Response, current_app, jsonify, request
+from flask.globals import request_ctx
+from werkzeug.exceptions import HTTPException
+import sys, os, datetime, re, uuid, json
 from functools import wraps
-from peewee import IntegrityError
+from contextlib import contextmanager, nullcontext
+from peewee import IntegrityError, fn
 from .models import User, UserProfile, Message, Upload, Relationship, Notification, \
-    MessageUpvote, database, \
-    MSGPRV_PUBLIC, MSGPRV_UNLISTED, MSGPRV_FRIENDS, MSGPRV_ONLYME, UPLOAD_DIRECTORY
+    MessageUpvote, database, invalidate_cache, \
+    MSGPRV_PUBLIC, MSGPRV_UNLISTED, MSGPRV_FRIENDS, MSGPRV_ONLYME
 from .utils import check_access_token, Visibility, push_notification, unpush_notification, \
-    create_mentions, is_username, generate_access_token, pwdhash
+    create_mentions, is_username, generate_access_token, pwdhash, validate_website, \
+    filter_visible, get_notification_info, get_feed_query, get_public_timeline_query
+from .export import export_ndjson
+from .events import notification_stream_response, is_stream_enabled
+from .upvotes import upvote_buffer
+from .profiles import get_profile_view, get_profile_views
+from .storage import save_upload
+from .mentions import update_mentions, get_mentions_page
+from .ratelimit import check_limit
+from .archive import user_messages
 
 bp = Blueprint('api', __name__, url_prefix='/api/V1')
 
@@ -15,8 +27,10 @@ def get_message_info(message):
         media = message.uploads[0].url()
     except IndexError:
         media = None
-    if media:
-        print(media)
+    return make_message_info(message, media, len(message.upvotes),
+        message.upvoted_by_self())
+
+def make_message_info(message, media, score, upvoted_by_self):
     return {
         'id': message.id,
         'user': {
@@ -27,38 +41,52 @@ def get_message_info(message):
         'privacy': message.privacy,
         'pub_date': message.pub_date.timestamp(),
         'media': media,
-        'score': len(message.upvotes),
-        'upvoted_by_self': message.upvoted_by_self(),
+        'score': score,
+        'upvoted_by_self': upvoted_by_self,
     }
 
 def validate_access(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
-        access_token = request.args.get('access_token')
-        if access_token is None:
-            return jsonify({
-                'message': 'missing access_token',
-                'status': 'fail'
-            })
-        user = check_access_token(access_token)
+        user, error = get_request_user()
         if user is None:
             return jsonify({
-                'message': 'invalid access_token',
-                'status': 'fail'
-            })
-        try:
-            result = func(user, *args, **kwargs)
-            assert isinstance(result, dict)
-        except Exception:
-            import traceback; traceback.print_exc()
-            return jsonify({
-                'message': str(sys.exc_info()[1]),
+                'message': error,
                 'status': 'fail'
             })
-        result['status'] = 'ok'
-        return jsonify(result)
+        return jsonify(call_api(func, user, *args, **kwargs))
     return wrapper
 
+def get_request_user():
+    '''
+    Return the user owning the access token of the request, along with
+    an error message if the token is missing or invalid.
+    '''
+    access_token = request.args.get('access_token')
+    if access_token is None:
+        return None, 'missing access_token'
+    user = check_access_token(access_token)
+    if user is None:
+        return None, 'invalid access_token'
+    return user, None
+
+def call_api(func, user, *args, **kwargs):
+    '''
+    Call an API function with an already validated user, and return its
+    result, with the status field set.
+    '''
+    try:
+        result = func(user, *args, **kwargs)
+        assert isinstance(result, dict)
+    except Exception:
+        import traceback; traceback.print_exc()
+        return {
+            'message': str(sys.exc_info()[1]),
+            'status': 'fail'
+        }
+    result['status'] = 'ok'
+    return result
+
 @bp.route('/feed')
 @validate_access
 def feed(self):
@@ -68,12 +96,7 @@ def feed(self):
         date = datetime.datetime.now()
     else:
         date = datetime.datetime.fromtimestamp(float(date))
-    query = Visibility(Message
-        .select()
-        .where(((Message.user << self.following())
-            | (Message.user == self))
-            & (Message.pub_date < date))
-        .order_by(Message.pub_date.desc()))
+    query = Visibility(get_feed_query(self, date))
     for message in query.paginate(1):
         timeline_media.append(get_message_info(message))
     return {'timeline_media': timeline_media, 'has_more': query.count() > len(timeline_media)}
@@ -87,14 +110,26 @@ def explore(self):
         date = datetime.datetime.now()
     else:
         date = datetime.datetime.fromtimestamp(float(date))
-    query = Visibility(Message
-                .select()
-                .where(Message.pub_date < date)
-                .order_by(Message.pub_date.desc()), True)
+    query = Visibility(get_public_timeline_query(date), True)
     for message in query.paginate(1):
         timeline_media.append(get_message_info(message))
     return {'timeline_media': timeline_media, 'has_more': query.count() > len(timeline_media)}
 
+# New in 0.9.
+@bp.route('/mentions')
+@validate_access
+def mentions(self):
+    timeline_media = []
+    date = request.args.get('offset')
+    if date is None:
+        date = datetime.datetime.now()
+    else:
+        date = datetime.datetime.fromtimestamp(float(date))
+    messages, has_more = get_mentions_page(self, date)
+    for message in messages:
+        timeline_media.append(get_message_info(message))
+    return {'timeline_media': timeline_media, 'has_more': has_more}
+
 @bp.route('/create', methods=['POST'])
 @validate_access
 def create(self):
@@ -107,7 +142,7 @@ def create(self):
         pub_date=datetime.datetime.now(),
         privacy=privacy)
     # This API does not support files. Use create2 instead.
-    create_mentions(self, text, privacy)
+    create_mentions(self, text, privacy, message)
     return {}
 
 @bp.route('/create2', methods=['POST'])
@@ -122,14 +157,9 @@ def create2(self):
         privacy=privacy)
     file = request.files.get('file')
     if file:
-        print('Uploading', file.filename)
-        ext = file.filename.split('.')[-1]
-        upload = Upload.create(
-            type=ext,
-            message=message
-        )
-        file.save(os.path.join(UPLOAD_DIRECTORY, str(upload.id) + '.' + ext))
-    create_mentions(self, text, privacy)
+        # changed in 0.9: see `app.storage`
+        save_upload(file, message)
+    create_mentions(self, text, privacy, message)
     return {}
 
 def get_relationship_info(self, other):
@@ -140,37 +170,51 @@ def get_relationship_info(self, other):
         "followed_by": other.is_following(self)
     }
 
+# Changed in 0.9: in one query (see `app.profiles`).
 @bp.route('/profile_info/<userid>', methods=['GET'])
 @validate_access
 def profile_info(self, userid):
     if userid == 'self':
-        user = self
+        condition = User.id == self.id
     elif userid.startswith('+'):
-        user = User.get(User.username == userid[1:])
+        condition = User.username == userid[1:]
     elif userid.isdigit():
-        try:
-            user = User[userid]
-        except User.DoesNotExist:
-            return {'user': None}
+        condition = User.id == int(userid)
     else:
         raise ValueError('userid should be an integer or "self"')
-    profile = user.profile
+    profile = get_profile_view(condition, viewer=self)
+    if profile is None:
+        if userid.isdigit():
+            return {'user': None}
+        raise User.DoesNotExist('user not found')
     return {
-        "user": {
-            "id": user.id,
-            "username": user.username,
-            "full_name": profile.full_name,
-            "biography": profile.biography,
-            "website": profile.website,
-            "generation": profile.year,
-            "instagram": profile.instagram,
-            "facebook": profile.facebook,
-            "join_date": user.join_date.timestamp(),
-            "relationships": get_relationship_info(self, user),
-            "messages_count": len(user.messages),
-            "followers_count": len(user.followers()),
-            "following_count": len(user.following())
-        }
+        "user": make_profile_info(profile, get_view_relationships(self, profile))
+    }
+
+def get_view_relationships(self, profile):
+    if profile.id == self.id:
+        return
+    return {
+        "following": profile.following,
+        "followed_by": profile.followed_by
+    }
+
+def make_profile_info(profile, relationships):
+    # changed in 0.9: takes a ProfileView
+    return {
+        "id": profile.id,
+        "username": profile.username,
+        "full_name": profile.full_name,
+        "biography": profile.biography,
+        "website": profile.website,
+        "generation": profile.year,
+        "instagram": profile.instagram,
+        "facebook": profile.facebook,
+        "join_date": profile.join_date.timestamp(),
+        "relationships": relationships,
+        "messages_count": profile.messages_count,
+        "followers_count": profile.followers_count,
+        "following_count": profile.following_count
     }
 
 @bp.route('/profile_info/feed/<userid>', methods=['GET'])
@@ -190,11 +234,8 @@ def profile_feed(self, userid):
         date = datetime.datetime.now()
     else:
         date = datetime.datetime.fromtimestamp(float(date))
-    query = Visibility(Message
-        .select()
-        .where((Message.user == user)
-            & (Message.pub_date < date))
-        .order_by(Message.pub_date.desc()))
+    # changed in 0.9: archived messages included
+    query = Visibility(user_messages(user, date))
     for message in query.paginate(1):
         timeline_media.append(get_message_info(message))
     return {'timeline_media': timeline_media, 'has_more': query.count() > len(timeline_media)}
@@ -224,6 +265,7 @@ def relationships_unfollow(self, userid):
          (Relationship.from_user == self) &
          (Relationship.to_user == user))
      .execute())
+    invalidate_cache('follows:{}'.format(self.id), 'follows:{}'.format(user.id))
     unpush_notification('follow', user, user=self.id)
     return get_relationship_info(self, user)
 
@@ -240,7 +282,7 @@ def profile_search(self):
             "id": result.id,
             "username": result.username,
             "full_name": result.full_name,
-            "followers_count": len(result.followers())
+            "followers_count": result.followers_count()
         })
     return {
         "users": results
@@ -275,11 +317,13 @@ def edit_profile(user):
     if username != user.username:
         try:
             User.update(username=username).where(User.id == user.id).execute()
+            invalidate_cache('user:{}'.format(user.id))
         except IntegrityError:
             raise ValueError('that username is already taken')
     full_name = data['full_name'] or username
     if full_name != user.full_name:
         User.update(full_name=full_name).where(User.id == user.id).execute()
+        invalidate_cache('user:{}'.format(user.id))
     kwargs = {}
     if 'website' in data:
         website = data['website'].strip().replace(' ', '%20')
@@ -303,6 +347,7 @@ def edit_profile(user):
         biography=data['biography'],
         **kwargs
     ).where(UserProfile.user == user).execute()
+    invalidate_cache('user:{}'.format(user.id))
     return {}
 
 @bp.route('/request_edit/<int:id>')
@@ -323,6 +368,8 @@ def save_edit(self, id):
         raise ValueError('Attempt to edit a message from another')
     data = request.get_json(True)
     Message.update(text=data['text'], privacy=data['privacy']).where(Message.id == id).execute()
+    # new in 0.9
+    update_mentions(message, data['text'])
     return {}
 
 # no validate access for this endpoint!
@@ -353,16 +400,6 @@ def create_account():
     except Exception as e:
         return jsonify({'message': str(e), 'status': 'fail'})
 
-def get_notification_info(notification):
-    obj = {
-        "id": notification.id,
-        "type": notification.type,
-        "timestamp": notification.pub_date.timestamp(),
-        "seen": notification.seen
-    }
-    obj.update(json.loads(notification.detail))
-    return obj
-
 @bp.route('/notifications/count')
 @validate_access
 def notifications_count(self):
@@ -386,7 +423,7 @@ def notifications(self):
         .select()
         .where((Notification.target == self) & (Notification.seen == 0)))
     for notification in query:
-        items.append(get_notification_info(query))
+        items.append(get_notification_info(notification))
     return {
         "notifications": {
             "items": items,
@@ -394,6 +431,20 @@ def notifications(self):
         }
     }
 
+# New in 0.9.
+# Not wrapped by validate_access, since the response is streamed.
+@bp.route('/notifications/stream')
+def notifications_stream():
+    '''
+    Live notifications, as Server-Sent Events.
+    '''
+    if not is_stream_enabled():
+        return jsonify({'message': 'live notifications are disabled', 'status': 'fail'}), 404
+    user, error = get_request_user()
+    if user is None:
+        return jsonify({'message': error, 'status': 'fail'})
+    return notification_stream_response(user)
+
 @bp.route('/notifications/seen', methods=['POST'])
 @validate_access
 def notifications_seen(self):
@@ -407,27 +458,188 @@ def notifications_seen(self):
 @bp.route('/score/message/<int:id>/add', methods=['POST'])
 @validate_access
 def score_message_add(self, id):
+    # changed in 0.9: upvotes are buffered (see `app.upvotes`)
     message = Message[id]
-    MessageUpvote.create(
-        message=message,
-        user=self,
-        created_date=datetime.datetime.now()
-    )
+    upvote_buffer.set(message.id, self.id, True)
     return {
-        'score': len(message.upvotes)
+        'score': upvote_buffer.score(message.id)
     }
 
 @bp.route('/score/message/<int:id>/remove', methods=['POST'])
 @validate_access
 def score_message_remove(self, id):
     message = Message[id]
-    (MessageUpvote
-     .delete()
-     .where(
-        (MessageUpvote.message == message) &
-        (MessageUpvote.user == self))
-     .execute()
-    )
+    upvote_buffer.set(message.id, self.id, False)
     return {
-        'score': len(message.upvotes)
+        'score': upvote_buffer.score(message.id)
     }
+
+# New in 0.9.
+@bp.route('/batch', methods=['POST'])
+@validate_access
+def batch(self):
+    '''
+    Execute many API calls in one HTTP round trip.
+
+    The body is a JSON object with a "requests" list; each item has a
+    "path" (relative to /api/V1), and optionally "method", "args" and
+    "body". Sub-requests share the access token check and the database
+    connection of the batch request, and results are returned in order.
+    '''
+    data = request.get_json(True)
+    subrequests = data['requests']
+    max_requests = current_app.config.get('API_BATCH_MAX_REQUESTS', 20)
+    if len(subrequests) > max_requests:
+        raise ValueError('too many requests in batch (max. {})'.format(max_requests))
+    access_token = request.args['access_token']
+    results = []
+    # calls reading after a write in the same batch have to see it
+    writes = any(x.get('method', 'GET').upper() != 'GET' for x in subrequests)
+    with database.read_your_writes() if writes else nullcontext():
+        for subrequest in subrequests:
+            results.append(dispatch_subrequest(self, access_token, subrequest))
+    return {'results': results}
+
+@contextmanager
+def subrequest_context(environ):
+    '''
+    Swap the request of the batch request's context for one made from
+    environ, for the duration of the block. Unlike a new request context,
+    leaving runs no teardown hook, which would clean up `g` (the identity
+    map included) of the batch request; the session is shared too.
+    '''
+    ctx = request_ctx._get_current_object()
+    saved = ctx.request, ctx.url_adapter
+    ctx.request = current_app.request_class(environ)
+    ctx.url_adapter = current_app.create_url_adapter(ctx.request)
+    try:
+        yield ctx
+    finally:
+        ctx.request.close()
+        ctx.request, ctx.url_adapter = saved
+
+def dispatch_subrequest(user, access_token, subrequest):
+    # imported here, as it's slow to import
+    from werkzeug.test import EnvironBuilder
+    args = dict(subrequest.get('args') or {})
+    args['access_token'] = access_token
+    builder = EnvironBuilder(
+        path='/api/V1/' + subrequest['path'].lstrip('/'),
+        base_url=request.url_root,
+        method=subrequest.get('method', 'GET').upper(),
+        query_string=args,
+        json=subrequest.get('body'),
+        # for the rate limit of anonymous calls
+        environ_overrides={'REMOTE_ADDR': request.remote_addr})
+    try:
+        environ = builder.get_environ()
+    finally:
+        builder.close()
+    # the app context (and so the database connection) of the batch
+    # request is reused, since it's already pushed.
+    with subrequest_context(environ) as ctx:
+        try:
+            rule, view_args = ctx.url_adapter.match(return_rule=True)
+        except HTTPException as e:
+            return {'message': e.description, 'status': 'fail'}
+        # as Flask does, for request.endpoint and request.blueprint
+        ctx.request.url_rule, ctx.request.view_args = rule, view_args
+        endpoint = rule.endpoint
+        func = getattr(current_app.view_functions[endpoint], '__wrapped__', None)
+        if func is None or endpoint == 'api.batch':
+            return {'message': 'endpoint not allowed in batch', 'status': 'fail'}
+        # every call counts against the rate limit
+        retry_after = check_limit(endpoint)
+        if retry_after is not None:
+            return {'message': 'rate limit exceeded', 'retry_after': retry_after,
+                'status': 'fail'}
+        return call_api(func, user, **view_args)
+
+def get_ids_arg():
+    try:
+        ids = [int(x) for x in request.args['ids'].split(',') if x]
+    except ValueError:
+        raise ValueError('ids should be a comma-separated list of integers')
+    max_ids = current_app.config.get('API_MULTIGET_MAX_IDS', 100)
+    if len(ids) > max_ids:
+        raise ValueError('too many ids (max. {})'.format(max_ids))
+    return list(dict.fromkeys(ids))
+
+# New in 0.9.
+@bp.route('/messages')
+@validate_access
+def messages_multiget(self):
+    '''
+    Get many messages by id, in a fixed number of queries.
+    Messages not existing or not visible to the user are null.
+    '''
+    ids = get_ids_arg()
+    result = dict.fromkeys(ids)
+    messages = filter_visible(Message
+        .select(Message, User)
+        .join(User)
+        .where(Message.id << ids), self)
+    if messages:
+        message_ids = [m.id for m in messages]
+        media = {}
+        for upload in (Upload
+                .select()
+                .where(Upload.message << message_ids)
+                .order_by(Upload.id.desc())):
+            # the first upload wins, as in get_message_info()
+            media[upload.message_id] = upload.url()
+        scores = dict(MessageUpvote
+            .select(MessageUpvote.message, fn.COUNT(MessageUpvote.id))
+            .where(MessageUpvote.message << message_ids)
+            .group_by(MessageUpvote.message)
+            .tuples())
+        upvoted = {x for x, in MessageUpvote
+            .select(MessageUpvote.message)
+            .where((MessageUpvote.message << message_ids) & (MessageUpvote.user == self))
+            .tuples()}
+        for message in messages:
+            result[message.id] = make_message_info(message,
+                media.get(message.id), scores.get(message.id, 0),
+                message.id in upvoted)
+    return {'messages': result}
+
+# New in 0.9.
+@bp.route('/users')
+@validate_access
+def users_multiget(self):
+    '''
+    Get many user profiles by id, in one query.
+    Users not existing or disabled are null.
+    '''
+    ids = get_ids_arg()
+    result = dict.fromkeys(ids)
+    if ids:
+        for profile in get_profile_views((User.id << ids) & (User.is_disabled == 0),
+                viewer=self):
+            result[profile.id] = make_profile_info(profile,
+                get_view_relationships(self, profile))
+    return {'users': result}
+
+# New in 0.9.
+# Not wrapped by validate_access, since the response is streamed.
+@bp.route('/export')
+def export():
+    '''
+    Stream all the data of the account as NDJSON.
+    Pass gzip=1 to get it gzip-compressed.
+    '''
+    user, error = get_request_user()
+    if user is None:
+        return jsonify({'message': error, 'status': 'fail'})
+    compress = request.args.get('gzip') == '1'
+    dumps = current_app.json.dumps
+    def generate():
+        # the request connection is closed before streaming starts
+        with database.connection_context():
+            yield from export_ndjson(user, compress=compress, dumps=dumps)
+    filename = 'coriplus-{}.ndjson'.format(user.username)
+    if compress:
+        filename += '.gz'
+    return Response(generate(),
+        mimetype='application/gzip' if compress else 'application/x-ndjson',
+        headers={'Content-Disposition': 'attachment; filename=' + filename})
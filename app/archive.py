@@ -0,0 +1,110 @@
+'''
+Archival of old messages.
+
+Messages older than a threshold are moved, with their uploads and
+upvotes, into the same tables of an archive database, attached as
+"archive" (set its path with the `ARCHIVE_DATABASE` config value). The
+hot tables and their indexes only hold recent messages, while profile
+pages and the `profile_info/feed` API endpoint still reach archived ones,
+merging both tables by date. Archived messages are read-only.
+
+Messages are moved in batches, each one in its own transaction. The main
+database is in WAL mode, so a crash may leave a batch copied into the
+archive but not deleted from the hot tables; messages are copied with
+their ids, so running again completes the move, and reads skip the
+duplicates in the meantime. Message and upload ids are never reused
+(see migration 10), so that new rows never take the id of an archived
+one; archiving refuses to run before that migration.
+
+New in 0.9.
+'''
+
+import heapq, time
+from .models import Message, Upload, MessageUpvote, ArchivedMessage, ArchivedUpload, \
+    ArchivedUpvote, database, is_archive_enabled
+
+def create_archive_tables():
+    database.create_tables([ArchivedMessage, ArchivedUpload, ArchivedUpvote])
+
+def copy_rows(model, archived_model, condition, with_id=True):
+    fields = [f for f in model._meta.sorted_fields
+        if with_id or f is not model._meta.primary_key]
+    (archived_model
+     .insert_from(model.select(*fields).where(condition),
+        [archived_model._meta.fields[f.name] for f in fields])
+     .on_conflict_replace()
+     .execute())
+
+def get_archivable_ids(before, after_id, batch_size):
+    return [x for x, in Message
+        .select(Message.id)
+        .where((Message.pub_date < before) & (Message.id > after_id))
+        .order_by(Message.id)
+        .limit(batch_size)
+        .tuples()]
+
+def archive_messages(before, batch_size=500, pause=0.0, progress=None):
+    '''
+    Move messages published before the given datetime into the archive.
+    Return how many were moved. Raise RuntimeError if message or upload
+    ids may still be reused.
+    '''
+    from .migrations import Migrator
+    migrator = Migrator()
+    if not (migrator.has_autoincrement('message') and migrator.has_autoincrement('upload')):
+        raise RuntimeError('message ids may be reused: run `flask --app app migrate` first')
+    create_archive_tables()
+    count = 0
+    last_id = 0
+    while True:
+        ids = get_archivable_ids(before, last_id, batch_size)
+        if not ids:
+            break
+        with database.atomic():
+            copy_rows(Message, ArchivedMessage, Message.id << ids)
+            copy_rows(Upload, ArchivedUpload, Upload.message << ids)
+            # upvote ids are not referenced anywhere, and may be reused
+            copy_rows(MessageUpvote, ArchivedUpvote, MessageUpvote.message << ids,
+                with_id=False)
+            MessageUpvote.delete().where(MessageUpvote.message << ids).execute()
+            Upload.delete().where(Upload.message << ids).execute()
+            Message.delete().where(Message.id << ids).execute()
+        count += len(ids)
+        last_id = ids[-1]
+        if progress:
+            progress(count)
+        if pause:
+            time.sleep(pause)
+    return count
+
+class MergedQuery(object):
+    '''
+    Iterate over many queries ordered by descending date, as one.
+    Messages found in more than one query are yielded once.
+    '''
+    def __init__(self, *queries):
+        self.queries = queries
+
+    def __iter__(self):
+        seen = set()
+        for message in heapq.merge(*self.queries, key=lambda x: x.pub_date,
+                reverse=True):
+            if message.id not in seen:
+                seen.add(message.id)
+                yield message
+
+def user_messages(user, before=None):
+    '''
+    Return the messages of user, archived ones included, newest first;
+    only the ones published before the given datetime, if given.
+    '''
+    query = Message.select().where(Message.user == user)
+    if before is not None:
+        query = query.where(Message.pub_date < before)
+    query = query.order_by(Message.pub_date.desc())
+    if not is_archive_enabled():
+        return query
+    archived = ArchivedMessage.select().where(ArchivedMessage.user == user)
+    if before is not None:
+        archived = archived.where(ArchivedMessage.pub_date < before)
+    return MergedQuery(query, archived.order_by(ArchivedMessage.pub_date.desc()))
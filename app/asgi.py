@@ -0,0 +1,249 @@
+'''
+Async (ASGI) serving mode.
+
+`application` is an ASGI application wrapping the Flask app. Request
+bodies are read, and responses sent, asynchronously, so that slow clients
+don't hold a thread; the Flask app itself (and so every database call)
+runs into a bounded thread pool, whose size is set by the
+`ASYNC_MAX_WORKERS` config value (defaults to 16). The JSON contract of
+the API is unchanged, since the very same views are run.
+
+Streaming endpoints (the `ASYNC_STREAM_ENDPOINTS` config value: the
+notification streams and the account export) hold their thread for as
+long as the response is sent, so they run into a pool of their own, of
+`ASYNC_MAX_STREAMS` threads (defaults to 64): open streams can't starve
+the other requests. When that pool is full, further streams get a 503
+response with `Retry-After`, instead of waiting.
+
+Meant for the public API (`/api/V1/*`), but it can serve the whole site.
+Run it with any ASGI server, e.g. `uvicorn app.asgi:application`.
+
+New in 0.9.
+'''
+
+import asyncio, io, sys, threading
+from concurrent.futures import ThreadPoolExecutor
+from . import create_app
+
+default_stream_endpoints = frozenset((
+    'api.export',
+    'api.notifications_stream',
+    'website.notifications_stream',
+))
+
+class AsyncApp(object):
+    '''
+    Run a WSGI app from ASGI, into bounded thread pools: one for streaming
+    endpoints, one for the rest.
+    '''
+    def __init__(self, wsgi_app, max_workers=16, max_body_size=16 * 1024 * 1024,
+            queue_size=8, max_streams=64, stream_endpoints=default_stream_endpoints):
+        self.wsgi_app = wsgi_app
+        self.max_workers = max_workers
+        self.max_body_size = max_body_size
+        # how many response chunks may wait for a slow client
+        self.queue_size = queue_size
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='coriplus-async')
+        self.max_streams = max_streams
+        self.stream_endpoints = frozenset(stream_endpoints)
+        self.stream_executor = ThreadPoolExecutor(max_streams,
+            thread_name_prefix='coriplus-stream')
+        # only changed from the event loop
+        self.streams = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.handle_http(scope, receive, send)
+        else:
+            raise RuntimeError('unsupported scope type: ' + scope['type'])
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                self.stream_executor.shutdown(wait=False, cancel_futures=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_body(self, receive):
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > self.max_body_size:
+                raise ValueError('request body too large')
+            chunks.append(chunk)
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    def is_stream(self, environ):
+        '''
+        Whether the request is for a streaming endpoint.
+        '''
+        url_map = getattr(self.wsgi_app, 'url_map', None)
+        if url_map is None or not self.stream_endpoints:
+            return False
+        try:
+            endpoint, _ = url_map.bind_to_environ(environ).match()
+        except Exception:
+            # not found, redirects and so on
+            return False
+        return endpoint in self.stream_endpoints
+
+    async def handle_http(self, scope, receive, send):
+        try:
+            body = await self.read_body(receive)
+        except ValueError:
+            await send_plain(send, 413, b'Request Entity Too Large')
+            return
+        if body is None:
+            return
+        environ = build_environ(scope, body)
+        if self.is_stream(environ):
+            if self.streams >= self.max_streams:
+                await send_plain(send, 503, b'Service Unavailable',
+                    [(b'retry-after', b'5')])
+                return
+            self.streams += 1
+            try:
+                await self.run_in_executor(self.stream_executor, environ, receive, send)
+            finally:
+                self.streams -= 1
+        else:
+            await self.run_in_executor(self.executor, environ, receive, send)
+
+    async def run_in_executor(self, executor, environ, receive, send):
+        '''
+        Run the WSGI app into executor, sending the response as it comes.
+        '''
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(self.queue_size)
+        disconnected = threading.Event()
+        worker = loop.run_in_executor(executor, self.run_wsgi,
+            environ, loop, queue, disconnected)
+        async def watch_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+        watcher = asyncio.ensure_future(watch_disconnect())
+        finished = False
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    finished = True
+                    break
+                await send(item)
+        finally:
+            disconnected.set()
+            watcher.cancel()
+            # let the worker thread run to its end
+            while not finished:
+                finished = await queue.get() is None
+            await worker
+
+    def run_wsgi(self, environ, loop, queue, disconnected):
+        '''
+        Run the WSGI app in a worker thread. The whole request, including
+        the iteration of the response, runs on the same thread, since
+        database connections are per thread.
+        '''
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+        response_start = {}
+        def start_response(status, headers, exc_info=None):
+            response_start.update(
+                type='http.response.start',
+                status=int(status.split(' ', 1)[0]),
+                headers=[(k.lower().encode('latin-1'), v.encode('latin-1'))
+                    for k, v in headers])
+        started = False
+        try:
+            iterable = self.wsgi_app(environ, start_response)
+            try:
+                for chunk in iterable:
+                    if not started:
+                        put(response_start)
+                        started = True
+                    if chunk:
+                        put({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                    if disconnected.is_set():
+                        break
+                if not started:
+                    put(response_start)
+                put({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+        except Exception:
+            sys.excepthook(*sys.exc_info())
+            if not started:
+                put({'type': 'http.response.start', 'status': 500,
+                    'headers': [(b'content-type', b'text/plain')]})
+                put({'type': 'http.response.body', 'body': b'Internal Server Error'})
+        finally:
+            put(None)
+
+async def send_plain(send, status, body, headers=()):
+    await send({'type': 'http.response.start', 'status': status,
+        'headers': [(b'content-type', b'text/plain'),
+            (b'content-length', str(len(body)).encode())] + list(headers)})
+    await send({'type': 'http.response.body', 'body': body})
+
+def build_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'CONTENT_LENGTH':
+            continue
+        else:
+            key = 'HTTP_' + name
+            environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+def create_asgi_app(config=None):
+    app = create_app(config)
+    return AsyncApp(app, max_workers=app.config.get('ASYNC_MAX_WORKERS', 16),
+        max_streams=app.config.get('ASYNC_MAX_STREAMS', 64),
+        stream_endpoints=app.config.get('ASYNC_STREAM_ENDPOINTS', default_stream_endpoints))
+
+def __getattr__(name):
+    # made on first use, since create_app() points the database at its
+    # config: importing AsyncApp must not
+    if name == 'application':
+        global application
+        application = create_asgi_app()
+        return application
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
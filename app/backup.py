@@ -0,0 +1,154 @@
+'''
+Online backups of the databases.
+
+Databases are copied with the SQLite online backup API, `BACKUP_PAGES`
+pages at a time (defaults to 1024), sleeping `BACKUP_SLEEP` seconds
+between steps (defaults to 0.01), so that the copy never holds the
+database for long and writers keep going. The copy reads from a single
+snapshot: with the database in WAL mode, a read transaction is kept open
+on the source during the whole copy, otherwise every commit of another
+connection would restart it from the first page.
+
+Every copy is checked with `PRAGMA integrity_check` before being kept,
+and gzipped if `BACKUP_COMPRESS` is set. Backups are named after the
+database and the time, e.g. `coriplus-20260101-120000.sqlite.gz`, in
+`BACKUP_DIRECTORY` (defaults to `backups` in the package's parent
+directory); only the newest `BACKUP_KEEP` ones (defaults to 7) of every
+database are kept. The timings of every backup are appended to
+`backups.jsonl` in the same directory.
+
+Run `flask --app app backup`, with `--every` to back up periodically.
+
+New in 0.9.
+'''
+
+import datetime, gzip, json, os, re, shutil, sqlite3, statistics, time
+from .models import BASE_DIR, database, is_archive_enabled
+
+def get_databases():
+    '''
+    Return a dict mapping names to the paths of the databases to back up.
+    '''
+    paths = {'main': database.database}
+    if is_archive_enabled():
+        paths['archive'] = database._attached['archive']
+    return paths
+
+def backup_name(path, now):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return '{}-{}.sqlite'.format(stem, now.strftime('%Y%m%d-%H%M%S'))
+
+def backup_database(path, output, pages=1024, sleep=0.01, compress=False, verify=True,
+        progress=None):
+    '''
+    Copy the database at path to output (output.gz if compress is set),
+    in steps of pages pages, sleeping sleep seconds in between. Return
+    the stats of the copy, as a dict. The copy is removed if its integrity
+    check fails, raising RuntimeError.
+
+    progress is called after every step with the number of pages left
+    and the total.
+    '''
+    tmp_path = output + '.tmp'
+    step_times = []
+    last = time.perf_counter()
+    def on_step(status, remaining, total):
+        nonlocal last
+        step_times.append(time.perf_counter() - last)
+        if progress:
+            progress(remaining, total)
+        # backup() itself only sleeps when the source is locked
+        if remaining and sleep:
+            time.sleep(sleep)
+        last = time.perf_counter()
+    start = time.perf_counter()
+    try:
+        source = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True,
+            isolation_level=None)
+        target = sqlite3.connect(tmp_path)
+        try:
+            # one snapshot for the whole copy
+            source.execute('BEGIN')
+            source.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+            source.backup(target, pages=pages, progress=on_step)
+            source.execute('COMMIT')
+            page_count, = target.execute('PRAGMA page_count').fetchone()
+            page_size, = target.execute('PRAGMA page_size').fetchone()
+            copy_time = time.perf_counter() - start
+            integrity = None
+            if verify:
+                integrity = [x for x, in target.execute('PRAGMA integrity_check')]
+        finally:
+            target.close()
+            source.close()
+        if integrity is not None and integrity != ['ok']:
+            raise RuntimeError('integrity check failed: {}'.format('; '.join(integrity[:10])))
+        if compress:
+            with open(tmp_path, 'rb') as f, gzip.open(output + '.gz.tmp', 'wb', 6) as out:
+                shutil.copyfileobj(f, out, 1 << 20)
+            os.remove(tmp_path)
+            tmp_path = output + '.gz.tmp'
+            output += '.gz'
+        os.replace(tmp_path, output)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    size = page_count * page_size
+    return {
+        'database': path,
+        'output': output,
+        'pages': page_count,
+        'bytes': size,
+        'output_bytes': os.path.getsize(output),
+        'steps': len(step_times),
+        'copy_seconds': round(copy_time, 3),
+        'total_seconds': round(time.perf_counter() - start, 3),
+        # excluding the sleeps
+        'throughput_mb_s': round(size / 1e6 / sum(step_times), 1) if sum(step_times) else None,
+        'step_p50_ms': round(statistics.median(step_times) * 1000, 3) if step_times else None,
+        'step_max_ms': round(max(step_times) * 1000, 3) if step_times else None,
+        'integrity': 'ok' if integrity else None,
+    }
+
+def rotate_backups(directory, stem, keep):
+    '''
+    Remove all but the newest keep backups of the database named stem.
+    Return the removed paths.
+    '''
+    name_re = re.compile(r'^{}-\d{{8}}-\d{{6}}\.sqlite(\.gz)?$'.format(re.escape(stem)))
+    names = sorted(x for x in os.listdir(directory) if name_re.match(x))
+    removed = []
+    for name in names[:-keep] if keep > 0 else []:
+        os.remove(os.path.join(directory, name))
+        removed.append(os.path.join(directory, name))
+    return removed
+
+def run_backups(directory, pages=1024, sleep=0.01, compress=False, verify=True, keep=7,
+        progress=None):
+    '''
+    Back up every database into directory, rotating old backups. Return
+    the list of the stats of every copy, also appended to backups.jsonl.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    now = datetime.datetime.now()
+    results = []
+    for name, path in get_databases().items():
+        output = os.path.join(directory, backup_name(path, now))
+        stats = backup_database(path, output, pages=pages, sleep=sleep, compress=compress,
+            verify=verify, progress=progress and (lambda *args: progress(name, *args)))
+        stats['name'] = name
+        stats['date'] = now.isoformat(timespec='seconds')
+        stats['removed'] = rotate_backups(directory,
+            os.path.splitext(os.path.basename(path))[0], keep)
+        with open(os.path.join(directory, 'backups.jsonl'), 'a') as f:
+            f.write(json.dumps(stats) + '\n')
+        results.append(stats)
+    return results
+
+def init_app(app):
+    app.config.setdefault('BACKUP_DIRECTORY', os.path.join(BASE_DIR, 'backups'))
+    app.config.setdefault('BACKUP_PAGES', 1024)
+    app.config.setdefault('BACKUP_SLEEP', 0.01)
+    app.config.setdefault('BACKUP_COMPRESS', False)
+    app.config.setdefault('BACKUP_KEEP', 7)
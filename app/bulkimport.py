@@ -0,0 +1,228 @@
+'''
+Bulk import of users, follows and messages.
+
+Input is either JSONL, where every line is an object like
+{"type": "user", "data": {...}} (types are "user", "follow" and
+"message"), or CSV, holding records of a single type with a header row.
+
+Fields are:
+* user - username, full_name, email, birthday, join_date, and either
+  password (plain text) or password_hash
+* follow - from_user, to_user (usernames), created_date
+* message - user (username), text, pub_date, privacy
+
+Records are inserted with insert_many() in batches, one transaction per
+batch. The position in the input is saved along with each batch, so an
+interrupted import can be resumed. Users already existing are skipped.
+Usernames are case insensitive, as on sign up.
+
+With drop_indexes, secondary indexes of messages and follows are dropped
+during the import, which makes it faster but the live site slow until
+they are rebuilt at the end: only use it on a database not in use.
+
+New in 0.9.
+'''
+
+import csv, datetime, json, os, time
+from peewee import CharField, IntegerField
+from .models import BaseModel, User, Message, Relationship, database
+from .cache import cache
+from .profiles import backfill_profiles
+from .utils import pwdhash
+
+RECORD_TYPES = ('user', 'follow', 'message')
+
+# Secondary indexes of these models are dropped during the import, if
+# asked to, and rebuilt at the end.
+INDEXED_MODELS = (Message, Relationship)
+
+class ImportProgress(BaseModel):
+    '''
+    Position reached by an import, committed along with every batch.
+    '''
+    source = CharField(primary_key=True)
+    position = IntegerField(default=0)
+
+def read_jsonl(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            record = json.loads(line)
+            yield record['type'], record['data']
+
+def read_csv(f, record_type):
+    for row in csv.DictReader(f):
+        yield record_type, {k: v for k, v in row.items() if v != ''}
+
+def _datetime(value, default=None):
+    if value is None:
+        return default
+    return datetime.datetime.fromisoformat(value)
+
+def _date(value):
+    return datetime.date.fromisoformat(value[:10])
+
+def tune_connection():
+    '''
+    Trade some durability for speed. An interrupted import is resumed
+    from the last committed batch anyway.
+    '''
+    database.execute_sql('PRAGMA synchronous = OFF')
+    database.execute_sql('PRAGMA temp_store = MEMORY')
+    database.execute_sql('PRAGMA cache_size = -65536')
+
+def drop_secondary_indexes():
+    for model in INDEXED_MODELS:
+        table = model._meta.table_name
+        for name, sql in database.execute_sql(
+                "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND "
+                "tbl_name = ? AND sql IS NOT NULL AND sql NOT LIKE 'CREATE UNIQUE%'",
+                (table,)).fetchall():
+            database.execute_sql('DROP INDEX "%s"' % name)
+
+def rebuild_derived_data():
+    '''
+    Create missing profiles and indexes, and refresh planner statistics.
+    '''
+    backfill_profiles()
+    for model in INDEXED_MODELS:
+        model._schema.create_indexes(safe=True)
+    database.execute_sql('ANALYZE')
+    # follower counts changed behind the back of the cache
+    cache.clear()
+
+class Importer(object):
+    '''
+    Import records, flushing them every batch_size records.
+    '''
+    def __init__(self, source, batch_size=1000, resume=True, drop_indexes=False,
+            progress=None):
+        self.source = source
+        self.batch_size = batch_size
+        self.resume = resume
+        self.drop_indexes = drop_indexes
+        self.progress = progress
+        self.counts = dict.fromkeys(RECORD_TYPES, 0)
+        self.buffers = {t: [] for t in RECORD_TYPES}
+        self.position = 0
+        self.user_ids = {}
+
+    def run(self, records):
+        database.create_tables([ImportProgress])
+        tune_connection()
+        start_position = 0
+        if self.resume:
+            start_position = (ImportProgress
+                .select(ImportProgress.position)
+                .where(ImportProgress.source == self.source)
+                .scalar()) or 0
+        if self.drop_indexes:
+            # faster, but makes the live site slow until the end
+            drop_secondary_indexes()
+        self.start_time = time.perf_counter()
+        buffered = 0
+        try:
+            for record_type, data in records:
+                self.position += 1
+                if self.position <= start_position:
+                    continue
+                if record_type not in self.buffers:
+                    raise ValueError('unknown record type at #{}: {!r}'.format(
+                        self.position, record_type))
+                self.buffers[record_type].append(data)
+                buffered += 1
+                if buffered >= self.batch_size:
+                    self.flush()
+                    buffered = 0
+            self.flush()
+        finally:
+            # even on failure, don't leave the site without indexes
+            rebuild_derived_data()
+        return self.counts, time.perf_counter() - self.start_time
+
+    def flush(self):
+        with database.atomic():
+            # users first, as they are referenced by the others
+            self.insert_users(self.buffers['user'])
+            self.insert_follows(self.buffers['follow'])
+            self.insert_messages(self.buffers['message'])
+            (ImportProgress
+             .insert(source=self.source, position=self.position)
+             .on_conflict_replace()
+             .execute())
+        for t in RECORD_TYPES:
+            self.counts[t] += len(self.buffers[t])
+            self.buffers[t] = []
+        if self.progress:
+            self.progress(self)
+
+    def resolve_users(self, usernames):
+        '''
+        Return a dict mapping the given usernames to user ids.
+        '''
+        # lowercased, as by insert_users()
+        missing = {x.lower() for x in usernames} - set(self.user_ids)
+        if missing:
+            self.user_ids.update(User
+                .select(User.username, User.id)
+                .where(User.username << list(missing))
+                .tuples())
+        for username in usernames:
+            if username.lower() not in self.user_ids:
+                raise ValueError('unknown user: ' + username)
+        return {x: self.user_ids[x.lower()] for x in usernames}
+
+    def insert_users(self, rows):
+        if not rows:
+            return
+        now = datetime.datetime.now()
+        User.insert_many([{
+            'username': row['username'].lower(),
+            'full_name': row.get('full_name') or row['username'],
+            'password': row.get('password_hash') or pwdhash(row['password']),
+            'email': row['email'],
+            'birthday': _date(row['birthday']),
+            'join_date': _datetime(row.get('join_date'), now),
+            'is_disabled': int(row.get('is_disabled', 0)),
+        } for row in rows]).on_conflict_ignore().execute()
+
+    def insert_follows(self, rows):
+        if not rows:
+            return
+        now = datetime.datetime.now()
+        user_ids = self.resolve_users(
+            [row['from_user'] for row in rows] + [row['to_user'] for row in rows])
+        Relationship.insert_many([{
+            'from_user': user_ids[row['from_user']],
+            'to_user': user_ids[row['to_user']],
+            'created_date': _datetime(row.get('created_date'), now),
+        } for row in rows]).on_conflict_ignore().execute()
+
+    def insert_messages(self, rows):
+        if not rows:
+            return
+        now = datetime.datetime.now()
+        user_ids = self.resolve_users([row['user'] for row in rows])
+        Message.insert_many([{
+            'user': user_ids[row['user']],
+            'text': row['text'],
+            'pub_date': _datetime(row.get('pub_date'), now),
+            'privacy': int(row.get('privacy', 0)),
+        } for row in rows]).execute()
+
+def import_file(path, format=None, record_type=None, **kwargs):
+    '''
+    Import a JSONL or CSV file. The format is guessed from the extension,
+    if not given. CSV files need a record_type.
+    '''
+    if format is None:
+        format = 'csv' if path.endswith('.csv') else 'jsonl'
+    importer = Importer(os.path.abspath(path), **kwargs)
+    with open(path, encoding='utf-8', newline='') as f:
+        if format == 'csv':
+            if record_type not in RECORD_TYPES:
+                raise ValueError('CSV import requires a record type')
+            records = read_csv(f, record_type)
+        else:
+            records = read_jsonl(f)
+        return importer.run(records)
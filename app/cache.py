@@ -0,0 +1,269 @@
+'''
+Caching of model lookups.
+
+Values are pickled and kept in a backend, for up to `CACHE_TTL` seconds
+(defaults to 60), along with tags naming the rows they were read from,
+e.g. "user:1". When a row is saved or deleted, the tags of its model
+instance (see `BaseModel.cache_tags()`) are invalidated once the
+transaction commits, dropping every value tagged with them. Writes done
+with update or delete queries invalidate their tags explicitly.
+
+Values are kept in memory, in a LRU of up to `CACHE_MAX_ENTRIES` entries
+(defaults to 1000), so every worker process has its own and only sees its
+own invalidations. Set `CACHE_STORAGE` to the path of a SQLite file to
+share them between processes. Set `CACHE_ENABLED` to false to disable
+caching.
+
+New in 0.9.
+'''
+
+from peewee import SqliteDatabase
+from collections import OrderedDict
+from functools import wraps
+import os, pickle, threading, time
+
+class MemoryBackend(object):
+    '''
+    Entries kept in an ordered dict, least recently used first. The
+    oldest ones are dropped once there are more than max_entries.
+    '''
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        # key -> (value, expiry time, tags)
+        self.entries = OrderedDict()
+        # tag -> set of keys
+        self.tags = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, now):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= now:
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, expires, tags):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = value, expires, tags
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            evicted = 0
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+                evicted += 1
+            return evicted
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def _remove(self, key):
+        value, expires, tags = self.entries.pop(key)
+        for tag in tags:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+    def invalidate(self, tags):
+        with self.lock:
+            for tag in tags:
+                for key in list(self.tags.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tags.clear()
+
+class SQLiteBackend(object):
+    '''
+    Entries kept in a SQLite file, shared between processes. Expired
+    entries are dropped every prune_every writes, and then the ones
+    expiring first, down to max_entries.
+    '''
+    def __init__(self, path, max_entries=10000, prune_every=1000):
+        self.database = SqliteDatabase(path, pragmas={'journal_mode': 'wal'})
+        self.max_entries = max_entries
+        self.prune_every = prune_every
+        self.writes = 0
+        with self.database.connection_context():
+            self.database.execute_sql('CREATE TABLE IF NOT EXISTS entry ('
+                'key TEXT PRIMARY KEY, value BLOB, expires REAL)')
+            self.database.execute_sql('CREATE TABLE IF NOT EXISTS tag ('
+                'tag TEXT, key TEXT, PRIMARY KEY (tag, key)) WITHOUT ROWID')
+
+    def reset(self):
+        self.database._state.reset()
+
+    def __len__(self):
+        return self.database.execute_sql('SELECT COUNT(*) FROM entry').fetchone()[0]
+
+    def get(self, key, now):
+        row = self.database.execute_sql('SELECT value FROM entry '
+            'WHERE key = ? AND expires > ?', (key, now)).fetchone()
+        return row and row[0]
+
+    def set(self, key, value, expires, tags):
+        with self.database.atomic('IMMEDIATE'):
+            self.database.execute_sql('INSERT OR REPLACE INTO entry '
+                '(key, value, expires) VALUES (?, ?, ?)', (key, value, expires))
+            for tag in tags:
+                self.database.execute_sql('INSERT OR IGNORE INTO tag (tag, key) '
+                    'VALUES (?, ?)', (tag, key))
+            self.writes += 1
+            if self.writes % self.prune_every == 0:
+                return self.prune(time.time())
+        return 0
+
+    def prune(self, now):
+        self.database.execute_sql('DELETE FROM entry WHERE expires <= ?', (now,))
+        evicted = self.database.execute_sql('DELETE FROM entry WHERE key IN '
+            '(SELECT key FROM entry ORDER BY expires DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,)).rowcount
+        self.database.execute_sql('DELETE FROM tag WHERE key NOT IN '
+            '(SELECT key FROM entry)')
+        return evicted
+
+    def delete(self, key):
+        self.database.execute_sql('DELETE FROM entry WHERE key = ?', (key,))
+
+    def invalidate(self, tags):
+        tags = list(tags)
+        if not tags:
+            return
+        marks = ', '.join('?' * len(tags))
+        with self.database.atomic('IMMEDIATE'):
+            self.database.execute_sql('DELETE FROM entry WHERE key IN '
+                '(SELECT key FROM tag WHERE tag IN ({}))'.format(marks), tags)
+            self.database.execute_sql('DELETE FROM tag WHERE tag IN ({})'
+                .format(marks), tags)
+
+    def clear(self):
+        with self.database.atomic():
+            self.database.execute_sql('DELETE FROM entry')
+            self.database.execute_sql('DELETE FROM tag')
+
+class Cache(object):
+    '''
+    The front of a backend: pickles values and counts hits and misses.
+    With no backend, nothing is cached.
+    '''
+    def __init__(self, backend=None, ttl=60):
+        self.backend = backend
+        self.ttl = ttl
+        self.reset_stats()
+
+    def reset(self):
+        if self.backend is not None:
+            self.backend.reset()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def stats(self):
+        '''
+        Return the hit and miss counts of this process, as a dict.
+        '''
+        lookups = self.hits + self.misses
+        return {
+            'enabled': self.backend is not None,
+            'backend': type(self.backend).__name__ if self.backend is not None else None,
+            'entries': len(self.backend) if self.backend is not None else 0,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+    def get(self, key, default=None):
+        if self.backend is None:
+            return default
+        value = self.backend.get(key, time.time())
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return pickle.loads(value)
+
+    def set(self, key, value, ttl=None, tags=()):
+        if self.backend is None:
+            return
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        self.evictions += self.backend.set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+            expires, tuple(tags))
+
+    def delete(self, key):
+        if self.backend is not None:
+            self.backend.delete(key)
+
+    def invalidate(self, *tags):
+        '''
+        Drop every value tagged with any of tags.
+        '''
+        if self.backend is not None and tags:
+            self.invalidations += 1
+            self.backend.invalidate(tags)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    def memoize(self, tags=None, ttl=None):
+        '''
+        Cache the return values of a function, by its positional
+        arguments (their repr). tags is a function taking the same
+        arguments and returning the tags of the value. Exceptions are not
+        cached.
+        '''
+        def decorator(func):
+            prefix = '{}.{}:'.format(func.__module__, func.__qualname__)
+            missing = object()
+            @wraps(func)
+            def wrapper(*args):
+                if self.backend is None:
+                    return func(*args)
+                key = prefix + repr(args)
+                value = self.get(key, missing)
+                if value is missing:
+                    value = func(*args)
+                    self.set(key, value, ttl, tags(*args) if tags else ())
+                return value
+            wrapper.uncached = func
+            return wrapper
+        return decorator
+
+cache = Cache()
+os.register_at_fork(after_in_child=cache.reset)
+
+def init_app(app):
+    app.config.setdefault('CACHE_ENABLED', True)
+    app.config.setdefault('CACHE_STORAGE', None)
+    app.config.setdefault('CACHE_MAX_ENTRIES', 1000)
+    app.config.setdefault('CACHE_TTL', 60)
+    cache.ttl = app.config['CACHE_TTL']
+    cache.reset_stats()
+    if not app.config['CACHE_ENABLED']:
+        cache.backend = None
+        return
+    path = app.config['CACHE_STORAGE']
+    if path:
+        cache.backend = SQLiteBackend(path, app.config['CACHE_MAX_ENTRIES'])
+    else:
+        cache.backend = MemoryBackend(app.config['CACHE_MAX_ENTRIES'])
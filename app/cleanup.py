@@ -0,0 +1,212 @@
+'''
+Cascading deletion of content, and garbage collection of orphans.
+
+Deleting a message deletes its upvotes, uploads (files included) and
+the notifications about it, archived ones included (see `app.archive`).
+The garbage collector finds rows pointing to deleted messages or users,
+and upload files without a row, walking tables in bounded chunks of ids,
+with optional pauses between chunks so that it never stalls the live site.
+
+New in 0.9.
+'''
+
+import os, time
+from peewee import chunked
+from .models import User, Message, Relationship, Upload, Notification, MessageUpvote, \
+    Mention, ArchivedMessage, ArchivedUpload, ArchivedUpvote, database, is_archive_enabled, \
+    notification_message_id
+from .storage import storage, remove_upload_files
+
+def get_upload_files(model, condition):
+    # what remove_upload_files() needs
+    return list(model.select(model.id, model.type, model.digest).where(condition).tuples())
+
+def delete_messages(message_ids, batch_size=100):
+    '''
+    Delete messages, along with everything depending on them.
+    Every batch of messages is deleted in its own transaction; files
+    are removed once the transaction is committed.
+    '''
+    message_ids = list(message_ids)
+    for i in range(0, len(message_ids), batch_size):
+        batch = message_ids[i:i+batch_size]
+        with database.atomic():
+            files = get_upload_files(Upload, Upload.message << batch)
+            Upload.delete().where(Upload.message << batch).execute()
+            MessageUpvote.delete().where(MessageUpvote.message << batch).execute()
+            Mention.delete().where(Mention.message << batch).execute()
+            (Notification
+             .delete()
+             .where(notification_message_id << batch)
+             .execute())
+            Message.delete().where(Message.id << batch).execute()
+            if is_archive_enabled():
+                files += get_upload_files(ArchivedUpload, ArchivedUpload.message << batch)
+                ArchivedUpload.delete().where(ArchivedUpload.message << batch).execute()
+                ArchivedUpvote.delete().where(ArchivedUpvote.message << batch).execute()
+                ArchivedMessage.delete().where(ArchivedMessage.id << batch).execute()
+        remove_upload_files(files)
+
+class GarbageCollector(object):
+    '''
+    Find and delete orphan rows and upload files.
+
+    In dry run mode, orphans are only counted. chunk_size is the width of
+    the id ranges examined at once, pause the seconds waited after every
+    chunk. Upload files newer than grace_period seconds are left alone,
+    as they may belong to a message being posted.
+    '''
+    def __init__(self, dry_run=False, chunk_size=1000, pause=0.0,
+            grace_period=3600, progress=None):
+        self.dry_run = dry_run
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.grace_period = grace_period
+        self.progress = progress
+        self.counts = {}
+
+    def sleep(self):
+        if self.pause:
+            time.sleep(self.pause)
+
+    def collect_rows(self, name, model, orphan_condition, get_files=None):
+        '''
+        Walk the table of model by id ranges, deleting rows matching
+        orphan_condition. get_files, if given, returns the upload files
+        of the orphans, as (id, type, digest) tuples, to remove once they
+        are deleted.
+        '''
+        max_id = model.select(model.id).order_by(model.id.desc()).scalar() or 0
+        count = 0
+        for start in range(0, max_id, self.chunk_size):
+            files = []
+            with database.atomic():
+                orphans = [x for x, in model
+                    .select(model.id)
+                    .where((model.id > start) & (model.id <= start + self.chunk_size) &
+                        orphan_condition)
+                    .tuples()]
+                if orphans and not self.dry_run:
+                    if get_files:
+                        files = get_files(orphans)
+                    model.delete().where(model.id << orphans).execute()
+            # after commit, when shared files are no longer referenced by
+            # the deleted rows
+            remove_upload_files(files)
+            count += len(orphans)
+            self.sleep()
+        self.counts[name] = count
+        if self.progress:
+            self.progress(name, count)
+
+    def _existing(self, field, values):
+        # the values of an Upload field found in the upload tables
+        models = (Upload, ArchivedUpload) if is_archive_enabled() else (Upload,)
+        existing = set()
+        for model in models:
+            column = getattr(model, field.name)
+            query = model.select(column).where(column << values)
+            if field.name == 'id':
+                # migrated uploads have their file elsewhere
+                query = query.where(model.digest.is_null())
+            existing.update(x for x, in query.tuples())
+        return existing
+
+    def _collect_files(self, files, key, field):
+        # files yields (name, path) tuples; key gives the value of field
+        # naming the file
+        count = 0
+        for chunk in chunked(files, self.chunk_size):
+            existing = self._existing(field, [key(name) for name, path in chunk])
+            for name, path in chunk:
+                if key(name) not in existing:
+                    count += 1
+                    if not self.dry_run:
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            pass
+            self.sleep()
+        return count
+
+    def collect_upload_files(self):
+        '''
+        Remove upload files without an Upload row, and temporary files
+        left by interrupted uploads. Changed in 0.9: files are stored
+        by digest (see `app.storage`).
+        '''
+        count = 0
+        if not os.path.isdir(storage.root):
+            self.counts['upload files'] = count
+            return
+        now = time.time()
+        def legacy_files():
+            # files stored before 0.9, named by upload id
+            with os.scandir(storage.root) as it:
+                for entry in it:
+                    if not entry.is_file() or not entry.name.split('.')[0].isdigit():
+                        continue
+                    if now - entry.stat().st_mtime < self.grace_period:
+                        continue
+                    yield entry.name, entry.path
+        def stored_files():
+            nonlocal count
+            for digest, path, mtime in storage.iter_files():
+                if now - mtime < self.grace_period:
+                    continue
+                if digest is not None:
+                    yield digest, path
+                    continue
+                # a temporary file
+                count += 1
+                if not self.dry_run:
+                    os.remove(path)
+        count += self._collect_files(legacy_files(), lambda name: int(name.split('.')[0]),
+            Upload.id)
+        # stored_files() counts temporary files as it goes
+        stored = self._collect_files(stored_files(), lambda name: name, Upload.digest)
+        count += stored
+        self.counts['upload files'] = count
+        if self.progress:
+            self.progress('upload files', count)
+
+    def run(self):
+        existing_messages = Message.select(Message.id)
+        existing_users = User.select(User.id)
+        archived = is_archive_enabled()
+        if archived:
+            # notifications may be about archived messages
+            all_messages = existing_messages | ArchivedMessage.select(ArchivedMessage.id)
+        else:
+            all_messages = existing_messages
+        def get_files(upload_ids):
+            return get_upload_files(Upload, Upload.id << upload_ids)
+        self.collect_rows('messages', Message, Message.user.not_in(existing_users))
+        self.collect_rows('upvotes', MessageUpvote,
+            MessageUpvote.message.not_in(existing_messages) |
+            MessageUpvote.user.not_in(existing_users))
+        self.collect_rows('uploads', Upload, Upload.message.not_in(existing_messages),
+            get_files=get_files)
+        self.collect_rows('mentions', Mention,
+            Mention.message.not_in(all_messages) | Mention.user.not_in(existing_users))
+        self.collect_rows('relationships', Relationship,
+            Relationship.from_user.not_in(existing_users) |
+            Relationship.to_user.not_in(existing_users))
+        self.collect_rows('notifications', Notification,
+            Notification.target.not_in(existing_users) |
+            (notification_message_id.is_null(False) &
+                notification_message_id.not_in(all_messages)))
+        if archived:
+            existing_archived = ArchivedMessage.select(ArchivedMessage.id)
+            def get_archived_files(upload_ids):
+                return get_upload_files(ArchivedUpload, ArchivedUpload.id << upload_ids)
+            self.collect_rows('archived messages', ArchivedMessage,
+                ArchivedMessage.user.not_in(existing_users))
+            self.collect_rows('archived upvotes', ArchivedUpvote,
+                ArchivedUpvote.message.not_in(existing_archived) |
+                ArchivedUpvote.user.not_in(existing_users))
+            self.collect_rows('archived uploads', ArchivedUpload,
+                ArchivedUpload.message.not_in(existing_archived),
+                get_files=get_archived_files)
+        self.collect_upload_files()
+        return self.counts
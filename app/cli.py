@@ -0,0 +1,307 @@
+'''
+Command line tools, available through `flask`.
+
+Run `flask --app app --help` in the package's parent directory
+to list them.
+
+The modules implementing commands are imported by the commands
+themselves, not to slow down the start of the app.
+
+New in 0.9.
+'''
+
+from flask import Blueprint, current_app
+import click, datetime, time
+from .models import User, database, create_tables
+
+# commands are at the top level, i.e. `flask export-user`
+bp = Blueprint('cli', __name__, cli_group=None)
+
+@bp.cli.command('export-user')
+@click.argument('username')
+@click.option('-o', '--output', type=click.File('wb'), default='-',
+    help='The output file. Defaults to standard output.')
+@click.option('--gzip', 'compress', is_flag=True,
+    help='Compress the output with gzip.')
+def export_user(username, output, compress):
+    '''
+    Export all the data of an account as NDJSON.
+    '''
+    from .export import export_ndjson
+    with database.connection_context():
+        try:
+            user = User.get(User.username == username)
+        except User.DoesNotExist:
+            raise click.ClickException('no such user: ' + username)
+        for chunk in export_ndjson(user, compress=compress, dumps=current_app.json.dumps):
+            output.write(chunk)
+
+@bp.cli.command('import-data')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', type=click.Choice(['jsonl', 'csv']),
+    help='The input format. Guessed from the extension if not given.')
+@click.option('--type', 'record_type', type=click.Choice(['user', 'follow', 'message']),
+    help='The type of the records, for CSV input.')
+@click.option('--batch-size', type=int, default=1000, show_default=True,
+    help='How many records are inserted per transaction.')
+@click.option('--restart', is_flag=True,
+    help='Start from the beginning, instead of resuming a previous import.')
+@click.option('--drop-indexes', is_flag=True,
+    help='Drop indexes during the import, and rebuild them at the end. Faster, '
+    'but makes a live site slow meanwhile.')
+def import_data(path, format, record_type, batch_size, restart, drop_indexes):
+    '''
+    Bulk import users, follows and messages from JSONL or CSV.
+    '''
+    from .bulkimport import import_file
+    def progress(importer):
+        total = sum(importer.counts.values())
+        elapsed = time.perf_counter() - importer.start_time
+        click.echo('#{}: {} rows, {:.0f} rows/s'.format(
+            importer.position, total, total / elapsed if elapsed else 0), err=True)
+    with database.connection_context():
+        try:
+            counts, elapsed = import_file(path, format=format, record_type=record_type,
+                batch_size=batch_size, resume=not restart, drop_indexes=drop_indexes,
+                progress=progress)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    total = sum(counts.values())
+    for record_type, count in counts.items():
+        click.echo('{}: {} rows'.format(record_type, count))
+    click.echo('Imported {} rows in {:.1f}s ({:.0f} rows/s)'.format(
+        total, elapsed, total / elapsed if elapsed else 0))
+
+@bp.cli.command('migrate')
+@click.option('--chunk-size', type=int, default=1000, show_default=True,
+    help='How many rows are copied per transaction when rebuilding tables.')
+@click.option('--pause', type=float, default=0.05, show_default=True,
+    help='Seconds to wait between chunks, to let writers in.')
+@click.option('--status', is_flag=True,
+    help='Only show the schema version and the pending migrations.')
+def migrate(chunk_size, pause, status):
+    '''
+    Upgrade the database schema, while the site is running.
+    '''
+    from .migrations import Migrator
+    def progress(table, copied, total):
+        click.echo('{}: {}/{} rows copied'.format(table, copied, total), err=True)
+    migrator = Migrator(chunk_size=chunk_size, pause=pause, progress=progress)
+    with database.connection_context():
+        if status:
+            click.echo('Schema version: {}'.format(
+                migrator.get_version() or migrator.guess_version()))
+            for m in migrator.pending():
+                click.echo('Pending: {} - {}'.format(m.version, m.description))
+            return
+        for m in migrator.run():
+            click.echo('Applied: {} - {}'.format(m.version, m.description))
+    create_tables()
+    click.echo('Schema version: {}'.format(migrator.get_version()))
+
+@bp.cli.command('gc')
+@click.option('--dry-run', is_flag=True,
+    help='Only count orphans, without deleting them.')
+@click.option('--chunk-size', type=int, default=1000, show_default=True,
+    help='How many rows or files are examined at once.')
+@click.option('--pause', type=float, default=0.05, show_default=True,
+    help='Seconds to wait between chunks, to limit the load.')
+@click.option('--every', type=float,
+    help='Run forever, every given seconds.')
+def gc(dry_run, chunk_size, pause, every):
+    '''
+    Delete orphan rows and upload files left by deleted content.
+    '''
+    from .cleanup import GarbageCollector
+    def progress(name, count):
+        click.echo('{}: {} orphans{}'.format(name, count,
+            ' (dry run)' if dry_run else ' deleted'))
+    while True:
+        with database.connection_context():
+            GarbageCollector(dry_run=dry_run, chunk_size=chunk_size, pause=pause,
+                progress=progress).run()
+        if not every:
+            break
+        time.sleep(every)
+
+@bp.cli.command('archive')
+@click.option('--days', type=int,
+    help='Archive messages older than this many days. Defaults to the '
+    'ARCHIVE_AFTER_DAYS config value, or 365.')
+@click.option('--batch-size', type=int, default=500, show_default=True,
+    help='How many messages are moved per transaction.')
+@click.option('--pause', type=float, default=0.05, show_default=True,
+    help='Seconds to wait between batches, to limit the load.')
+def archive(days, batch_size, pause):
+    '''
+    Move old messages into the archive database.
+    '''
+    from .archive import archive_messages
+    from .models import is_archive_enabled
+    if not is_archive_enabled():
+        raise click.ClickException('set ARCHIVE_DATABASE to archive messages')
+    if days is None:
+        days = current_app.config.get('ARCHIVE_AFTER_DAYS', 365)
+    before = datetime.datetime.now() - datetime.timedelta(days=days)
+    def progress(count):
+        click.echo('{} messages archived'.format(count))
+    with database.connection_context():
+        try:
+            count = archive_messages(before, batch_size=batch_size, pause=pause,
+                progress=progress)
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+    click.echo('Done, {} messages older than {} archived.'.format(count, before.date()))
+
+@bp.cli.command('migrate-uploads')
+@click.option('--batch-size', type=int, default=100, show_default=True,
+    help='How many uploads are moved per transaction.')
+@click.option('--pause', type=float, default=0.05, show_default=True,
+    help='Seconds to wait between batches, to limit the load.')
+def migrate_uploads_command(batch_size, pause):
+    '''
+    Move upload files stored before 0.9 into the sharded, content-addressed
+    layout.
+    '''
+    from .storage import migrate_uploads
+    def progress(moved, missing):
+        click.echo('{} files moved, {} missing'.format(moved, missing))
+    with database.connection_context():
+        moved, missing = migrate_uploads(batch_size=batch_size, pause=pause,
+            progress=progress)
+    click.echo('Done, {} files moved, {} missing.'.format(moved, missing))
+
+@bp.cli.command('backfill-mentions')
+@click.option('--batch-size', type=int, default=1000, show_default=True,
+    help='How many messages are indexed per transaction.')
+@click.option('--pause', type=float, default=0.05, show_default=True,
+    help='Seconds to wait between batches, to limit the load.')
+def backfill_mentions_command(batch_size, pause):
+    '''
+    Index the mentions of messages posted before 0.9.
+    '''
+    from .mentions import backfill_mentions
+    def progress(count):
+        click.echo('{} messages indexed'.format(count))
+    with database.connection_context():
+        count = backfill_mentions(batch_size=batch_size, pause=pause, progress=progress)
+    click.echo('Done, {} mentions added.'.format(count))
+
+@bp.cli.command('prune-notifications')
+@click.option('--days', type=int,
+    help='Delete seen notifications older than this many days. Defaults to '
+    'the NOTIFICATION_RETENTION_DAYS config value.')
+@click.option('--batch-size', type=int, default=500, show_default=True,
+    help='How many notifications are deleted per transaction.')
+@click.option('--pause', type=float, default=0.05, show_default=True,
+    help='Seconds to wait between batches, to limit the load.')
+@click.option('--every', type=float,
+    help='Run forever, every given seconds.')
+def prune_notifications_command(days, batch_size, pause, every):
+    '''
+    Delete old seen notifications, and merge the ones pushed one by one.
+    '''
+    from .notifications import prune_notifications, compact_notifications
+    if days is None:
+        days = current_app.config['NOTIFICATION_RETENTION_DAYS']
+    def progress(count):
+        click.echo('{} notifications deleted'.format(count))
+    while True:
+        before = datetime.datetime.now() - datetime.timedelta(days=days)
+        with database.connection_context():
+            pruned = prune_notifications(before, batch_size=batch_size, pause=pause,
+                progress=progress)
+            compacted = compact_notifications(
+                window=current_app.config['NOTIFICATION_AGGREGATE_WINDOW'],
+                max_users=current_app.config['NOTIFICATION_AGGREGATE_MAX'],
+                pause=pause)
+        click.echo('Done, {} notifications older than {} deleted, {} merged.'.format(
+            pruned, before.date(), compacted))
+        if not every:
+            break
+        time.sleep(every)
+
+@bp.cli.command('backup')
+@click.option('-o', '--output-dir', type=click.Path(file_okay=False),
+    help='Where to write backups. Defaults to the BACKUP_DIRECTORY config value.')
+@click.option('--pages', type=int,
+    help='How many pages are copied per step. Defaults to the BACKUP_PAGES '
+    'config value.')
+@click.option('--sleep', type=float,
+    help='Seconds to wait between steps. Defaults to the BACKUP_SLEEP config value.')
+@click.option('--gzip/--no-gzip', 'compress', default=None,
+    help='Compress backups. Defaults to the BACKUP_COMPRESS config value.')
+@click.option('--keep', type=int,
+    help='How many backups of every database are kept. Defaults to the '
+    'BACKUP_KEEP config value.')
+@click.option('--no-verify', is_flag=True,
+    help='Skip the integrity check of the copies.')
+@click.option('--every', type=float,
+    help='Run forever, every given seconds.')
+def backup_command(output_dir, pages, sleep, compress, keep, no_verify, every):
+    '''
+    Back up the databases while the site is live.
+    '''
+    from .backup import run_backups
+    config = current_app.config
+    def default(value, key):
+        return config[key] if value is None else value
+    while True:
+        try:
+            results = run_backups(default(output_dir, 'BACKUP_DIRECTORY'),
+                pages=default(pages, 'BACKUP_PAGES'), sleep=default(sleep, 'BACKUP_SLEEP'),
+                compress=default(compress, 'BACKUP_COMPRESS'), verify=not no_verify,
+                keep=default(keep, 'BACKUP_KEEP'))
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+        for stats in results:
+            click.echo('{}: {} pages copied to {} in {} steps, {}s ({} MB/s), '
+                'integrity {}; {} old backups removed'.format(stats['name'], stats['pages'],
+                stats['output'], stats['steps'], stats['copy_seconds'],
+                stats['throughput_mb_s'], stats['integrity'] or 'not checked',
+                len(stats['removed'])))
+        if not every:
+            break
+        time.sleep(every)
+
+@bp.cli.command('check-query-plans')
+@click.option('-v', '--verbose', is_flag=True,
+    help='Print the plans of all queries, not only the failing ones.')
+def check_query_plans_command(verbose):
+    '''
+    Check that the hot queries use their indexes.
+    '''
+    from .queryplans import check_query_plans
+    results = check_query_plans()
+    failed = 0
+    for name, plan, problems in results:
+        click.echo('{}: {}'.format(name, 'FAIL' if problems else 'ok'))
+        for problem in problems:
+            click.echo('  ' + problem)
+        if problems or verbose:
+            for line in plan:
+                click.echo('    | ' + line)
+        failed += bool(problems)
+    if failed:
+        raise click.ClickException('{} of {} queries failed'.format(failed, len(results)))
+
+@bp.cli.command('compile-templates')
+def compile_templates():
+    '''
+    Compile all templates into the bytecode cache.
+    '''
+    env = current_app.jinja_env
+    names = env.list_templates()
+    for name in names:
+        env.get_template(name)
+    click.echo('{} templates compiled'.format(len(names)))
+
+@bp.cli.command('clear-cache')
+def clear_cache():
+    '''
+    Drop all the cached values, e.g. after editing the database by hand.
+    Only useful with a shared `CACHE_STORAGE`.
+    '''
+    from .cache import cache
+    cache.clear()
+    click.echo('cache cleared')
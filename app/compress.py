@@ -0,0 +1,50 @@
+'''
+Negotiated gzip compression of responses.
+
+Only responses whose type is in `COMPRESS_MIMETYPES` and whose size is
+at least `COMPRESS_MIN_SIZE` bytes are compressed, and only if the client
+accepts gzip. Streamed responses are left alone.
+
+New in 0.9.
+'''
+
+from flask import request
+import gzip
+
+default_mimetypes = frozenset((
+    'application/json', 'text/html', 'text/css', 'text/plain',
+    'application/javascript', 'image/svg+xml'))
+
+def should_compress(app, request, response):
+    if not request.accept_encodings['gzip']:
+        return False
+    if response.direct_passthrough or response.is_streamed:
+        return False
+    if not (200 <= response.status_code < 300) or response.status_code == 204:
+        return False
+    if 'Content-Encoding' in response.headers:
+        return False
+    if response.mimetype not in app.config['COMPRESS_MIMETYPES']:
+        return False
+    return response.content_length is None or \
+        response.content_length >= app.config['COMPRESS_MIN_SIZE']
+
+def compress_response(app, request, response):
+    response.vary.add('Accept-Encoding')
+    if not should_compress(app, request, response):
+        return response
+    data = response.get_data()
+    if len(data) < app.config['COMPRESS_MIN_SIZE']:
+        return response
+    response.set_data(gzip.compress(data, app.config['COMPRESS_LEVEL']))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+def init_app(app):
+    app.config.setdefault('COMPRESS_MIMETYPES', default_mimetypes)
+    app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+    app.config.setdefault('COMPRESS_LEVEL', 6)
+
+    @app.after_request
+    def _compress(response):
+        return compress_response(app, request, response)
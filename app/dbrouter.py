@@ -0,0 +1,136 @@
+'''
+Read/write routing of database queries.
+
+Read-only queries (plain SELECTs outside of transactions) run on a pool
+of read-only connections, while writes, transactions and everything else
+run on the writer connection of the thread, the usual peewee one. With the
+database in WAL mode, readers see the last committed snapshot and never
+block (or wait for) the writer.
+
+The writer connection is opened only when needed, so a request that only
+reads never takes it; SQLite allows one writer at a time anyway, and
+other writers wait up to the busy timeout.
+
+New in 0.9.
+'''
+
+from peewee import SqliteDatabase
+from contextlib import contextmanager
+import sqlite3, threading
+
+class RoutingSqliteDatabase(SqliteDatabase):
+    '''
+    A SQLite database routing read-only queries to a pool of readers.
+
+    `readers` is the maximum number of idle reader connections kept in
+    the pool; 0 disables routing, so every query goes to the writer.
+    '''
+    def init(self, database, readers=4, **kwargs):
+        self.readers = readers
+        self._reset_readers()
+        super().init(database, **kwargs)
+
+    def _reset_readers(self):
+        # forget (without closing) all reader connections; used on init
+        # and after fork.
+        self._reader_lock = threading.Lock()
+        self._idle_readers = []
+        self._local = threading.local()
+
+    @property
+    def routing_enabled(self):
+        # every connection to an in-memory database is a different database
+        return self.readers > 0 and self.database not in (None, ':memory:', '')
+
+    def _initialize_connection(self, conn):
+        # the writer turns WAL on (it's persistent), so readers don't block it
+        conn.execute('PRAGMA journal_mode = wal')
+
+    def _connect_reader(self):
+        # pooled connections move between threads, but they are used by
+        # one thread at a time
+        params = dict(self.connect_params, check_same_thread=False)
+        conn = sqlite3.connect(self.database, timeout=self._timeout,
+            isolation_level=None, **params)
+        self._add_conn_hooks(conn)
+        # a misrouted write fails instead of taking the write lock
+        conn.execute('PRAGMA query_only = 1')
+        return conn
+
+    def reader_connection(self):
+        '''
+        Return the reader connection of the thread, taking one from the
+        pool (or opening it) if needed.
+        '''
+        conn = getattr(self._local, 'reader', None)
+        if conn is None:
+            with self._reader_lock:
+                if self._idle_readers:
+                    conn = self._idle_readers.pop()
+            if conn is None:
+                conn = self._connect_reader()
+            self._local.reader = conn
+        return conn
+
+    def release_reader(self):
+        '''
+        Give back the reader connection of the thread to the pool.
+        '''
+        conn = getattr(self._local, 'reader', None)
+        if conn is None:
+            return
+        self._local.reader = None
+        with self._reader_lock:
+            if len(self._idle_readers) < self.readers:
+                self._idle_readers.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+
+    def close_readers(self):
+        '''
+        Close all the idle reader connections.
+        '''
+        with self._reader_lock:
+            idle, self._idle_readers = self._idle_readers, []
+        for conn in idle:
+            conn.close()
+
+    @contextmanager
+    def read_your_writes(self):
+        '''
+        Run all the queries in the block on the writer connection, so
+        they see the writes done just before, e.g. to read back a message
+        after posting it.
+        '''
+        self._local.pinned = getattr(self._local, 'pinned', 0) + 1
+        try:
+            yield
+        finally:
+            self._local.pinned -= 1
+
+    def is_read_query(self, sql):
+        return sql.lstrip()[:6].upper() == 'SELECT'
+
+    def _use_reader(self, sql):
+        return (self.routing_enabled and not getattr(self._local, 'pinned', 0)
+            and not self.in_transaction() and self.is_read_query(sql))
+
+    def execute_sql(self, sql, params=None):
+        if not self._use_reader(sql):
+            return super().execute_sql(sql, params)
+        self._local.routed = True
+        try:
+            return self._execute_cursor(sql, params)
+        finally:
+            self._local.routed = False
+
+    def cursor(self, named_cursor=None):
+        if getattr(self._local, 'routed', False):
+            return self.reader_connection().cursor()
+        return super().cursor(named_cursor)
+
+    def close(self):
+        # the reader goes back to the pool together with the writer
+        self.release_reader()
+        return super().close()
@@ -0,0 +1,166 @@
+'''
+Live notifications through Server-Sent Events.
+
+Notifications are published into an in-process broker, which dispatches
+them to the connections of their target. Every connection has a bounded
+buffer: if a client is too slow and the buffer overflows, the oldest
+events are dropped and an "overflow" event is sent, so that the client
+knows it should reload. Event ids are notification ids, so that a client
+reconnecting with `Last-Event-ID` gets the notifications it missed.
+
+Since the broker is in-process, with many worker processes clients only
+get live events published by the same worker; missed ones are delivered
+on reconnection.
+
+Every open stream holds a worker thread for as long as the client stays
+connected, so with a sync or threaded server (e.g. gunicorn's default
+workers) a few open tabs take the whole pool. Streams are thus disabled
+unless `SSE_ENABLED` is set: only set it with a server that can hold
+many idle connections, e.g. gunicorn with gevent workers, or the ASGI
+mode (see `app.asgi`), where streams get a pool of their own. When
+disabled, the stream endpoints answer 404 and pages don't open them.
+
+New in 0.9.
+'''
+
+from flask import Response, current_app, request
+from collections import deque
+import os, threading
+from .models import Notification, database
+
+class Subscription(object):
+    def __init__(self, key, maxlen):
+        self.key = key
+        self.events = deque(maxlen=maxlen)
+        self.overflow = False
+        self.condition = threading.Condition()
+
+    def put(self, event):
+        with self.condition:
+            if len(self.events) == self.events.maxlen:
+                self.overflow = True
+            self.events.append(event)
+            self.condition.notify()
+
+    def wait(self, timeout):
+        '''
+        Wait up to timeout seconds for events. Return the events, and
+        whether some were dropped in the meantime.
+        '''
+        with self.condition:
+            if not self.events and not self.overflow:
+                self.condition.wait(timeout)
+            events = list(self.events)
+            self.events.clear()
+            overflow, self.overflow = self.overflow, False
+        return events, overflow
+
+class Broker(object):
+    '''
+    A simple in-process publish/subscribe hub, keyed by user id.
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+
+    def subscribe(self, key, maxlen=100):
+        subscription = Subscription(key, maxlen)
+        with self.lock:
+            self.subscriptions.setdefault(key, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.key)
+            if subscriptions:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.subscriptions[subscription.key]
+
+    def publish(self, key, event):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(key, ()))
+        for subscription in subscriptions:
+            subscription.put(event)
+
+broker = Broker()
+
+# subscriptions belong to the parent process
+os.register_at_fork(after_in_child=broker.reset)
+
+def format_event(event, data, id=None):
+    lines = []
+    if id is not None:
+        lines.append('id: {}'.format(id))
+    lines.append('event: {}'.format(event))
+    for line in data.splitlines() or ['']:
+        lines.append('data: ' + line)
+    return '\n'.join(lines) + '\n\n'
+
+def get_missed_notifications(user, last_event_id, limit=100):
+    '''
+    The notifications created after the one with id last_event_id.
+    '''
+    try:
+        last_event_id = int(last_event_id)
+    except (TypeError, ValueError):
+        return []
+    return list(Notification
+        .select()
+        .where((Notification.target == user) & (Notification.id > last_event_id))
+        .order_by(Notification.id)
+        .limit(limit))
+
+def notification_stream(user_id, last_event_id, dumps, heartbeat=15, maxlen=100):
+    '''
+    Generate the event stream of the notifications of a user, starting
+    with the ones missed since last_event_id. A comment is sent as
+    heartbeat after heartbeat seconds of inactivity.
+
+    The subscription is made on first iteration, and dropped when the
+    generator is closed, so that a response never sent subscribes nothing.
+    '''
+    from .utils import get_notification_info
+    # before loading the missed ones, so that none is lost in between
+    subscription = broker.subscribe(user_id, maxlen)
+    try:
+        last_id = 0
+        yield 'retry: 5000\n\n'
+        with database.connection_context():
+            missed = get_missed_notifications(user_id, last_event_id)
+        for notification in missed:
+            last_id = notification.id
+            yield format_event('notification', dumps(get_notification_info(notification)),
+                notification.id)
+        while True:
+            events, overflow = subscription.wait(heartbeat)
+            if overflow:
+                yield format_event('overflow', '{}')
+            if not events and not overflow:
+                yield ': heartbeat\n\n'
+            for id, info in events:
+                # skip the ones already sent with missed
+                if id > last_id:
+                    last_id = id
+                    yield format_event('notification', dumps(info), id)
+    finally:
+        broker.unsubscribe(subscription)
+
+def is_stream_enabled():
+    return current_app.config.get('SSE_ENABLED', False)
+
+def notification_stream_response(user):
+    '''
+    Return the event stream response of the live notifications of user.
+    The buffer size and the heartbeat interval are set by the
+    `SSE_BUFFER_SIZE` and `SSE_HEARTBEAT` config values.
+    '''
+    return Response(
+        notification_stream(user.id, request.headers.get('Last-Event-ID'),
+            current_app.json.dumps, current_app.config.get('SSE_HEARTBEAT', 15),
+            current_app.config.get('SSE_BUFFER_SIZE', 100)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
@@ -0,0 +1,145 @@
+'''
+Export of all the data of an account, as NDJSON.
+
+Every line is a JSON object with a "type" field ("profile", "message",
+"upload", "following", "follower", "upvote" or "notification") and a
+"data" field. Tables are walked in chunks by primary key, so memory
+stays flat whatever the size of the account is.
+
+New in 0.9.
+'''
+
+import json, zlib
+from .models import User, UserProfile, Message, Upload, Relationship, Notification, \
+    MessageUpvote, ArchivedMessage, ArchivedUpload, ArchivedUpvote, is_archive_enabled
+
+def iter_chunked(query, key, chunk_size=500):
+    '''
+    Iterate over a query, fetching chunk_size rows at a time, using the
+    key field (usually the primary key) as cursor.
+    '''
+    last = None
+    while True:
+        chunk = query if last is None else query.where(key > last)
+        rows = list(chunk.order_by(key).limit(chunk_size))
+        if not rows:
+            return
+        yield from rows
+        last = getattr(rows[-1], key.name)
+        if len(rows) < chunk_size:
+            return
+
+def _date(d):
+    return d.isoformat() if d is not None else None
+
+def export_records(user, chunk_size=500):
+    '''
+    Yield the records of the export of user, as (type, data) tuples.
+    '''
+    try:
+        profile = UserProfile.get(UserProfile.user == user)
+    except UserProfile.DoesNotExist:
+        profile = UserProfile(user=user)
+    yield 'profile', {
+        'id': user.id,
+        'username': user.username,
+        'full_name': user.full_name,
+        'email': user.email,
+        'birthday': _date(user.birthday),
+        'join_date': _date(user.join_date),
+        'biography': profile.biography,
+        'location': profile.location,
+        'year': profile.year,
+        'website': profile.website,
+        'instagram': profile.instagram,
+        'facebook': profile.facebook,
+        'telegram': profile.telegram,
+    }
+    # archived messages, uploads and upvotes too
+    message_models = [(Message, Upload, MessageUpvote)]
+    if is_archive_enabled():
+        message_models.append((ArchivedMessage, ArchivedUpload, ArchivedUpvote))
+    for message_model, upload_model, upvote_model in message_models:
+        for message in iter_chunked(
+                message_model.select().where(message_model.user == user),
+                message_model.id, chunk_size):
+            yield 'message', {
+                'id': message.id,
+                'text': message.text,
+                'pub_date': _date(message.pub_date),
+                'privacy': message.privacy,
+            }
+    for message_model, upload_model, upvote_model in message_models:
+        for upload in iter_chunked(
+                upload_model.select().join(message_model).where(message_model.user == user),
+                upload_model.id, chunk_size):
+            yield 'upload', {
+                'id': upload.id,
+                'message': upload.message_id,
+                'filename': upload.filename(),
+            }
+    for rel in iter_chunked(
+            Relationship.select(Relationship, User)
+                .join(User, on=Relationship.to_user)
+                .where(Relationship.from_user == user),
+            Relationship.id, chunk_size):
+        yield 'following', {
+            'user': rel.to_user.id,
+            'username': rel.to_user.username,
+            'created_date': _date(rel.created_date),
+        }
+    for rel in iter_chunked(
+            Relationship.select(Relationship, User)
+                .join(User, on=Relationship.from_user)
+                .where(Relationship.to_user == user),
+            Relationship.id, chunk_size):
+        yield 'follower', {
+            'user': rel.from_user.id,
+            'username': rel.from_user.username,
+            'created_date': _date(rel.created_date),
+        }
+    for message_model, upload_model, upvote_model in message_models:
+        for upvote in iter_chunked(
+                upvote_model.select().where(upvote_model.user == user),
+                upvote_model.id, chunk_size):
+            yield 'upvote', {
+                'message': upvote.message_id,
+                'created_date': _date(upvote.created_date),
+            }
+    for notification in iter_chunked(
+            Notification.select().where(Notification.target == user),
+            Notification.id, chunk_size):
+        yield 'notification', {
+            'id': notification.id,
+            'type': notification.type,
+            'detail': json.loads(notification.detail),
+            'pub_date': _date(notification.pub_date),
+            'seen': notification.seen,
+        }
+
+def export_ndjson(user, compress=False, chunk_size=500, dumps=json.dumps,
+        buffer_size=65536):
+    '''
+    Yield the export of user as NDJSON bytes, optionally gzip-compressed.
+    Output is buffered up to buffer_size bytes.
+    '''
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    buf = []
+    buf_len = 0
+    for type, data in export_records(user, chunk_size):
+        line = (dumps({'type': type, 'data': data}) + '\n').encode('utf-8')
+        buf.append(line)
+        buf_len += len(line)
+        if buf_len >= buffer_size:
+            chunk = b''.join(buf)
+            buf = []
+            buf_len = 0
+            if compressor:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+    chunk = b''.join(buf)
+    if compressor:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
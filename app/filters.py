@@ -4,10 +4,8 @@ Filter functions used in the website templates.
 
 from markupsafe import Markup
 import html, datetime, re, time
-from .utils import tokenize, inline_svg as _inline_svg
-from . import app
+from .utils import tokenize, locations, inline_svg as _inline_svg
 
-@app.template_filter()
 def human_date(date):
     timestamp = date.timestamp()
     today = int(time.time())
@@ -41,7 +39,6 @@ _enrich_symbols = [
     (r'.', 'TEXT')
 ]
 
-@app.template_filter()
 def enrich(s):
     tokens = tokenize(s, _enrich_symbols)
     r = []
@@ -56,12 +53,16 @@ def enrich(s):
             r.append('<br>')
     return Markup(''.join(r))
 
-@app.template_filter('is_following')
 def is_following(from_user, to_user):
     return from_user.is_following(to_user)
 
-@app.template_filter('locationdata')
 def locationdata(key):
     if key > 0:
         return locations[str(key)]
 
+# changed in 0.9: filters are registered by the app factory
+def init_app(app):
+    app.add_template_filter(human_date)
+    app.add_template_filter(enrich)
+    app.add_template_filter(is_following)
+    app.add_template_filter(locationdata)
@@ -0,0 +1,105 @@
+'''
+Request-scoped identity map.
+
+Within a request, rows fetched by primary key (`User[id]`,
+`Message.get_by_id(id)`, foreign key traversals such as `message.user`,
+and `get_user()`) are kept by model and id, so that loading the same row
+again returns the instance already loaded instead of running a query.
+The map lives in `flask.g` and is dropped at the end of the request;
+outside of requests (e.g. command line tools) nothing is kept.
+
+Instances are shared within the request: changes made to one of them
+are seen by every holder. Rows changed through update queries are not,
+so the map is dropped whenever cached values are invalidated (see
+`app.models.invalidate_cache()`).
+
+The number of loads saved is logged at debug level at the end of every
+request, and counted for the admin homepage.
+
+New in 0.9.
+'''
+
+from flask import g, has_request_context
+import os, threading
+
+class IdentityMap(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        # for the whole process
+        self.requests = self.loads = self.hits = 0
+
+    def _get_map(self, create=False):
+        if not has_request_context():
+            return None
+        identities = g.get('_identity_map')
+        if identities is None and create:
+            identities = g._identity_map = {}
+            g._identity_map_hits = 0
+        return identities
+
+    def get(self, model, pk):
+        '''
+        Return the instance of model with the given primary key loaded in
+        this request, or None.
+        '''
+        identities = self._get_map()
+        if not identities:
+            return None
+        instance = identities.get((model, pk))
+        if instance is not None:
+            g._identity_map_hits += 1
+        return instance
+
+    def add(self, instance):
+        '''
+        Keep instance for the rest of the request, and return it.
+        '''
+        identities = self._get_map(create=True)
+        if identities is not None:
+            identities[type(instance), instance._pk] = instance
+        return instance
+
+    def discard(self, instance):
+        identities = self._get_map()
+        if identities:
+            identities.pop((type(instance), instance._pk), None)
+
+    def clear(self):
+        '''
+        Drop the instances loaded in this request.
+        '''
+        identities = self._get_map()
+        if identities:
+            identities.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'loads': self.loads,
+                'hits': self.hits,
+            }
+
+    def teardown(self, exc=None):
+        identities = g.pop('_identity_map', None)
+        hits = g.pop('_identity_map_hits', 0)
+        if identities is None:
+            return
+        with self.lock:
+            self.requests += 1
+            self.loads += len(identities)
+            self.hits += hits
+        return len(identities), hits
+
+identity_map = IdentityMap()
+os.register_at_fork(after_in_child=identity_map.reset)
+
+def init_app(app):
+    @app.teardown_request
+    def _teardown_identity_map(exc=None):
+        counts = identity_map.teardown(exc)
+        if counts is not None:
+            app.logger.debug('identity map: %d rows loaded, %d loads saved', *counts)
@@ -0,0 +1,63 @@
+'''
+JSON provider for the application.
+
+Uses orjson, if installed, which is way faster than the standard library
+when serializing feeds; falls back to the standard library otherwise.
+The provider can be forced with the `JSON_PROVIDER` config value, either
+"orjson" or "stdlib"; the default is "auto".
+
+New in 0.9.
+'''
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class FastJSONProvider(DefaultJSONProvider):
+    '''
+    A JSON provider using orjson. Types not known to orjson (including
+    dates, for consistency) are passed to the default Flask handler.
+    '''
+    if orjson is not None:
+        option = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME |
+            orjson.OPT_PASSTHROUGH_DATACLASS)
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            # custom formatting is only supported by the standard library
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self.option).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            # pretty printing
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=self.option) + b'\n',
+            mimetype=self.mimetype)
+
+def get_json_provider_class(name='auto'):
+    if name == 'stdlib':
+        return DefaultJSONProvider
+    elif name == 'orjson':
+        if orjson is None:
+            raise RuntimeError('JSON_PROVIDER is "orjson", but orjson is not installed')
+        return FastJSONProvider
+    elif name == 'auto':
+        return DefaultJSONProvider if orjson is None else FastJSONProvider
+    else:
+        raise ValueError('unknown JSON provider: {!r}'.format(name))
+
+def init_app(app):
+    provider_class = get_json_provider_class(app.config.get('JSON_PROVIDER', 'auto'))
+    app.json_provider_class = provider_class
+    app.json = provider_class(app)
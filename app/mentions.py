@@ -0,0 +1,134 @@
+'''
+Index of mentions.
+
+Every +username found in the text of a message is stored as a Mention
+row, when the message is posted or edited, so that the messages
+mentioning a user are found through an index instead of scanning every
+text. `flask --app app backfill-mentions` indexes messages posted before
+0.9. Mentions of the author and of unknown users are not stored.
+
+The mentions timeline only shows the messages the viewer is allowed to
+see, as any other timeline. It is paginated by date: every page reads a
+few rows more than it shows, never the whole mention history.
+
+New in 0.9.
+'''
+
+import itertools, re, time
+from peewee import chunked
+from .models import User, Message, ArchivedMessage, Mention, database, is_archive_enabled
+from .archive import MergedQuery
+
+mention_re = re.compile(r'\+([A-Za-z0-9_]+(?:\.[A-Za-z0-9_]+)*)')
+
+def parse_mentions(text):
+    '''
+    Return the set of usernames mentioned in text.
+    '''
+    return {mo.group(1) for mo in mention_re.finditer(text)}
+
+def resolve_usernames(usernames):
+    '''
+    Return a dict mapping the existing usernames to user ids.
+    '''
+    result = {}
+    for batch in chunked(usernames, 500):
+        result.update(User
+            .select(User.username, User.id)
+            .where(User.username << batch)
+            .tuples())
+    return result
+
+def update_mentions(message, text=None):
+    '''
+    Replace the mentions of message with the ones in text (defaults to
+    the text of the message).
+    '''
+    if text is None:
+        text = message.text
+    user_ids = set(resolve_usernames(parse_mentions(text)).values())
+    user_ids.discard(message.user_id)
+    with database.atomic():
+        Mention.delete().where(Mention.message == message.id).execute()
+        if user_ids:
+            (Mention
+             .insert_many([(message.id, x) for x in user_ids],
+                fields=[Mention.message, Mention.user])
+             .execute())
+
+def backfill_mentions(batch_size=1000, pause=0.0, progress=None):
+    '''
+    Index the mentions of every message, archived ones included. Mentions
+    already indexed are kept. Return how many were added.
+    '''
+    before = Mention.select().count()
+    scanned = 0
+    models = (Message, ArchivedMessage) if is_archive_enabled() else (Message,)
+    for model in models:
+        last_id = 0
+        while True:
+            messages = list(model
+                .select(model.id, model.user, model.text)
+                .where((model.id > last_id) & model.text.contains('+'))
+                .order_by(model.id)
+                .limit(batch_size)
+                .tuples())
+            if not messages:
+                break
+            last_id = messages[-1][0]
+            mentioned = {x[0]: parse_mentions(x[2]) for x in messages}
+            user_ids = resolve_usernames(set().union(*mentioned.values()))
+            rows = [(message_id, user_ids[name])
+                for message_id, author_id, text in messages
+                for name in mentioned[message_id]
+                if name in user_ids and user_ids[name] != author_id]
+            with database.atomic():
+                for batch in chunked(rows, 300):
+                    (Mention
+                     .insert_many(batch, fields=[Mention.message, Mention.user])
+                     .on_conflict_ignore()
+                     .execute())
+            scanned += len(messages)
+            if progress:
+                progress(scanned)
+            if pause:
+                time.sleep(pause)
+    return Mention.select().count() - before
+
+def get_mentions_query(user, before=None, limit=None):
+    '''
+    Return the messages mentioning user, archived ones included, newest
+    first; only the ones published before the given datetime, if given,
+    and the limit newest ones, if given. Messages are not filtered by
+    visibility.
+    '''
+    def query(model):
+        q = (model
+            .select()
+            .join(Mention, on=(Mention.message == model.id))
+            .where(Mention.user == user))
+        if before is not None:
+            q = q.where(model.pub_date < before)
+        q = q.order_by(model.pub_date.desc())
+        return q.limit(limit) if limit is not None else q
+    if not is_archive_enabled():
+        return query(Message)
+    return MergedQuery(query(Message), query(ArchivedMessage))
+
+def get_mentions_page(user, before=None, page_size=20):
+    '''
+    Return the messages mentioning user visible to them, newest first,
+    published before the given datetime (if given): at most page_size of
+    them, and whether there are more.
+    '''
+    from .utils import filter_visible
+    messages = []
+    fetch = page_size + 1
+    while len(messages) <= page_size:
+        # each query is limited, so the first rows of the merge are right
+        chunk = list(itertools.islice(get_mentions_query(user, before, fetch), fetch))
+        messages += filter_visible(chunk, user)
+        if len(chunk) < fetch:
+            break
+        before = chunk[-1].pub_date
+    return messages[:page_size], len(messages) > page_size
@@ -0,0 +1,360 @@
+'''
+Versioned schema migrations.
+
+The schema version of the database is stored into `PRAGMA user_version`.
+Migrations are run in order, each one bumping the version in the same
+transaction as its last step. Tables are rebuilt online: rows are copied
+in small chunks, each one in its own transaction, while triggers keep
+the new table in sync with writes to the old one; the position reached
+is saved, so an interrupted migration is resumed.
+
+Databases created before 0.9 have no version. Their version is guessed
+through the `is_applied` check of every migration.
+
+Replaces the `migrate_*.py` scripts. New in 0.9.
+'''
+
+import time
+from peewee import CharField, IntegerField
+from .models import BaseModel, Message, Upload, Report, ReportSummary, Mention, \
+    ArchivedMessage, ArchivedUpload, database, is_archive_enabled
+from .moderation import rebuild_summaries
+from .profiles import backfill_profiles
+
+MIGRATIONS = []
+
+def migration(version, description, is_applied):
+    '''
+    Register a migration function, taking a Migrator as argument.
+    is_applied takes a Migrator too, and tells whether the schema
+    already has the change.
+    '''
+    def decorator(func):
+        func.version = version
+        func.description = description
+        func.is_applied = is_applied
+        MIGRATIONS.append(func)
+        MIGRATIONS.sort(key=lambda x: x.version)
+        return func
+    return decorator
+
+class MigrationProgress(BaseModel):
+    '''
+    Position reached when copying a table.
+    '''
+    name = CharField(primary_key=True)
+    position = IntegerField(default=0)
+
+class Migrator(object):
+    def __init__(self, db=database, chunk_size=1000, pause=0.0, progress=None):
+        self.db = db
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.progress = progress
+
+    def execute(self, sql, params=()):
+        return self.db.execute_sql(sql, params)
+
+    def table_exists(self, table):
+        return table in self.db.get_tables()
+
+    def column_exists(self, table, column):
+        return any(c.name == column for c in self.db.get_columns(table))
+
+    def index_exists(self, table, index):
+        return any(i.name == index for i in self.db.get_indexes(table))
+
+    def has_autoincrement(self, table):
+        row = self.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (table,)).fetchone()
+        return row is not None and 'AUTOINCREMENT' in row[0].upper()
+
+    def get_version(self):
+        return self.execute('PRAGMA user_version').fetchone()[0]
+
+    def set_version(self, version):
+        self.execute('PRAGMA user_version = %d' % int(version))
+
+    def add_column(self, table, column, definition):
+        if not self.column_exists(table, column):
+            self.execute('ALTER TABLE "%s" ADD COLUMN "%s" %s' % (table, column, definition))
+
+    def rebuild_table(self, table, columns, create_sql, key='id'):
+        '''
+        Rebuild a table online with a new schema.
+
+        columns maps every column of the new table to a SQL expression,
+        where `{row}` stands for the row of the old table (this way the
+        same expressions are used in both copy and triggers). create_sql
+        creates the new table, named "new_<table>".
+        '''
+        new_table = 'new_' + table
+        names = ', '.join('"%s"' % c for c in columns)
+        def exprs(row):
+            return ', '.join(e.format(row=row) for e in columns.values())
+        self.execute(create_sql.replace('CREATE TABLE', 'CREATE TABLE IF NOT EXISTS', 1))
+        # mirror writes done during the copy
+        self.execute(
+            'CREATE TRIGGER IF NOT EXISTS "{t}_mig_ins" AFTER INSERT ON "{t}" BEGIN '
+            'INSERT OR REPLACE INTO "{n}" ({c}) VALUES ({v}); END'
+            .format(t=table, n=new_table, c=names, v=exprs('NEW')))
+        self.execute(
+            'CREATE TRIGGER IF NOT EXISTS "{t}_mig_upd" AFTER UPDATE ON "{t}" BEGIN '
+            'DELETE FROM "{n}" WHERE "{k}" = OLD."{k}"; '
+            'INSERT OR REPLACE INTO "{n}" ({c}) VALUES ({v}); END'
+            .format(t=table, n=new_table, k=key, c=names, v=exprs('NEW')))
+        self.execute(
+            'CREATE TRIGGER IF NOT EXISTS "{t}_mig_del" AFTER DELETE ON "{t}" BEGIN '
+            'DELETE FROM "{n}" WHERE "{k}" = OLD."{k}"; END'
+            .format(t=table, n=new_table, k=key))
+        # copy rows which were there before the triggers
+        self.copy_rows(table, new_table, names, exprs('t'), key)
+        # swap tables; triggers are dropped along with the old table
+        with self.db.atomic():
+            self.execute('DROP TABLE "%s"' % table)
+            self.execute('ALTER TABLE "%s" RENAME TO "%s"' % (new_table, table))
+            MigrationProgress.delete().where(MigrationProgress.name == table).execute()
+
+    def copy_rows(self, table, new_table, names, exprs, key):
+        position = (MigrationProgress
+            .select(MigrationProgress.position)
+            .where(MigrationProgress.name == table)
+            .scalar()) or 0
+        total = self.execute('SELECT COUNT(*) FROM "%s" WHERE "%s" > ?' % (table, key),
+            (position,)).fetchone()[0]
+        copied = 0
+        while True:
+            with self.db.atomic():
+                end = self.execute(
+                    'SELECT MAX("{k}") FROM (SELECT "{k}" FROM "{t}" WHERE "{k}" > ? '
+                    'ORDER BY "{k}" LIMIT ?)'.format(k=key, t=table),
+                    (position, self.chunk_size)).fetchone()[0]
+                if end is None:
+                    return
+                cursor = self.execute(
+                    'INSERT OR IGNORE INTO "{n}" ({c}) SELECT {e} FROM "{t}" AS t '
+                    'WHERE t."{k}" > ? AND t."{k}" <= ?'.format(
+                        n=new_table, c=names, e=exprs, t=table, k=key),
+                    (position, end))
+                copied += cursor.rowcount
+                position = end
+                (MigrationProgress
+                 .insert(name=table, position=position)
+                 .on_conflict_replace()
+                 .execute())
+            if self.progress:
+                self.progress(table, copied, total)
+            if self.pause:
+                # let writers in
+                time.sleep(self.pause)
+
+    def guess_version(self):
+        '''
+        Guess the version of a database created before 0.9.
+        '''
+        if not self.table_exists('user'):
+            # a new database; tables are created from the models
+            return MIGRATIONS[-1].version
+        version = 0
+        for m in MIGRATIONS:
+            if not m.is_applied(self):
+                break
+            version = m.version
+        return version
+
+    def pending(self):
+        version = self.get_version() or self.guess_version()
+        return [m for m in MIGRATIONS if m.version > version]
+
+    def run(self):
+        '''
+        Run all pending migrations, and return them.
+        '''
+        self.db.create_tables([MigrationProgress])
+        if not self.get_version():
+            self.set_version(self.guess_version())
+        pending = self.pending()
+        for m in pending:
+            m(self)
+            with self.db.atomic():
+                self.set_version(m.version)
+        return pending
+
+### MIGRATIONS ###
+
+@migration(1, 'Merge message privacy into the message table (0.4 to 0.5)',
+    lambda m: not m.table_exists('messageprivacy'))
+def merge_message_privacy(m):
+    if not m.table_exists('messageprivacy'):
+        return
+    m.rebuild_table('message', {
+        'id': '{row}.id',
+        'user_id': '{row}.user_id',
+        'text': '{row}.text',
+        'pub_date': '{row}.pub_date',
+        'privacy': 'COALESCE((SELECT value FROM messageprivacy '
+            'WHERE message_id = {row}.id), 0)',
+    }, 'CREATE TABLE "new_message" ("id" INTEGER NOT NULL PRIMARY KEY, '
+        '"user_id" INTEGER NOT NULL, "text" TEXT NOT NULL, "pub_date" DATETIME NOT NULL, '
+        '"privacy" INTEGER NOT NULL DEFAULT 0, '
+        'FOREIGN KEY ("user_id") REFERENCES "user" ("id"))')
+    m.execute('DROP TABLE IF EXISTS messageprivacy')
+    m.execute('CREATE INDEX IF NOT EXISTS "message_user_id" ON "message" ("user_id")')
+
+@migration(2, 'Add telegram to user profiles (0.6 to 0.7)',
+    lambda m: m.column_exists('userprofile', 'telegram'))
+def add_profile_telegram(m):
+    m.add_column('userprofile', 'telegram', 'TEXT')
+
+@migration(3, 'Move full_name from user profiles to users (0.7 to 0.8)',
+    lambda m: m.column_exists('user', 'full_name') and
+        not m.column_exists('userprofile', 'full_name'))
+def move_full_name(m):
+    # every step is skipped if already done, in case of resume
+    if not m.column_exists('user', 'full_name'):
+        m.rebuild_table('user', {
+            'id': '{row}.id',
+            'username': '{row}.username',
+            'full_name': 'COALESCE((SELECT full_name FROM userprofile '
+                'WHERE user_id = {row}.id), {row}.username)',
+            'password': '{row}.password',
+            'email': '{row}.email',
+            'birthday': '{row}.birthday',
+            'join_date': '{row}.join_date',
+            'is_disabled': '{row}.is_disabled',
+        }, 'CREATE TABLE "new_user" ("id" INTEGER NOT NULL PRIMARY KEY, '
+            '"username" VARCHAR(255) NOT NULL, "full_name" TEXT NOT NULL, '
+            '"password" VARCHAR(255) NOT NULL, "email" VARCHAR(255) NOT NULL, '
+            '"birthday" DATE NOT NULL, "join_date" DATETIME NOT NULL, '
+            '"is_disabled" INTEGER NOT NULL)')
+        m.execute('CREATE UNIQUE INDEX IF NOT EXISTS "user_username" ON "user" ("username")')
+    if m.column_exists('userprofile', 'full_name'):
+        m.rebuild_table('userprofile', {
+            'user_id': '{row}.user_id',
+            'biography': '{row}.biography',
+            'location': '{row}.location',
+            'year': '{row}.year',
+            'website': '{row}.website',
+            'instagram': '{row}.instagram',
+            'facebook': '{row}.facebook',
+            'telegram': '{row}.telegram',
+        }, 'CREATE TABLE "new_userprofile" ("user_id" INTEGER NOT NULL PRIMARY KEY, '
+            '"biography" TEXT NOT NULL, "location" INTEGER, "year" INTEGER, "website" TEXT, '
+            '"instagram" TEXT, "facebook" TEXT, "telegram" TEXT, '
+            'FOREIGN KEY ("user_id") REFERENCES "user" ("id"))', key='user_id')
+
+def has_report_summaries(m):
+    # the table alone is created by `create_tables()` on startup, so
+    # check that every reported target has its summary
+    if not m.table_exists('reportsummary') or \
+            not m.index_exists('report', 'report_media_type_media_id'):
+        return False
+    return not m.execute('SELECT 1 FROM report WHERE NOT EXISTS (SELECT 1 FROM reportsummary '
+        'WHERE reportsummary.media_type = report.media_type AND '
+        'reportsummary.media_id = report.media_id) LIMIT 1').fetchone()
+
+@migration(4, 'Add report target index and report summaries', has_report_summaries)
+def add_report_summaries(m):
+    m.db.create_tables([Report, ReportSummary])
+    m.execute('CREATE INDEX IF NOT EXISTS "report_media_type_media_id" '
+        'ON "report" ("media_type", "media_id")')
+    m.db.create_tables([ReportSummary])
+    rebuild_summaries()
+
+def has_hot_indexes(m):
+    # the indexes alone are created by `create_tables()` on startup, so
+    # check that the planner has their statistics too
+    if not m.index_exists('notification', 'notification_target_id_seen_pub_date'):
+        return False
+    if not m.execute('SELECT 1 FROM notification LIMIT 1').fetchone():
+        # nothing to analyze
+        return True
+    return m.table_exists('sqlite_stat1') and bool(m.execute(
+        "SELECT 1 FROM sqlite_stat1 WHERE idx = 'notification_target_id_seen_pub_date'"
+        ).fetchone())
+
+@migration(5, 'Add indexes for feeds, logins by email and notifications', has_hot_indexes)
+def add_hot_indexes(m):
+    m.execute('CREATE INDEX IF NOT EXISTS "user_email" ON "user" ("email")')
+    m.execute('CREATE INDEX IF NOT EXISTS "message_user_id_pub_date" '
+        'ON "message" ("user_id", "pub_date")')
+    m.execute('CREATE INDEX IF NOT EXISTS "message_privacy_pub_date" '
+        'ON "message" ("privacy", "pub_date")')
+    m.execute('CREATE INDEX IF NOT EXISTS "notification_target_id_seen_pub_date" '
+        'ON "notification" ("target_id", "seen", "pub_date")')
+    # let the query planner know about them
+    m.execute('ANALYZE')
+
+@migration(6, 'Create missing user profiles',
+    lambda m: not m.execute('SELECT 1 FROM user WHERE id NOT IN '
+        '(SELECT user_id FROM userprofile) LIMIT 1').fetchone())
+def add_missing_profiles(m):
+    # profiles used to be created on first read
+    backfill_profiles()
+
+@migration(7, 'Add upload digests',
+    lambda m: m.column_exists('upload', 'digest'))
+def add_upload_digest(m):
+    m.add_column('upload', 'digest', 'VARCHAR(255)')
+    m.execute('CREATE INDEX IF NOT EXISTS "upload_digest" ON "upload" ("digest")')
+    if is_archive_enabled() and 'upload' in m.db.get_tables(schema='archive'):
+        if not any(c.name == 'digest' for c in m.db.get_columns('upload', schema='archive')):
+            m.execute('ALTER TABLE "archive"."upload" ADD COLUMN "digest" VARCHAR(255)')
+        m.execute('CREATE INDEX IF NOT EXISTS "archive"."archivedupload_digest" '
+            'ON "upload" ("digest")')
+
+@migration(8, 'Add the mention index',
+    lambda m: m.table_exists('mention'))
+def add_mentions(m):
+    # filled by `flask --app app backfill-mentions`
+    m.db.create_tables([Mention])
+
+@migration(9, 'Add the index of notifications by message',
+    lambda m: m.index_exists('notification', 'notification_message'))
+def add_notification_message_index(m):
+    # so that deleting a message doesn't scan every notification
+    m.execute('CREATE INDEX IF NOT EXISTS "notification_message" '
+        'ON "notification" (json_extract("detail", \'$.message\'))')
+
+@migration(10, 'Never reuse message and upload ids',
+    lambda m: m.has_autoincrement('message') and m.has_autoincrement('upload'))
+def add_id_autoincrement(m):
+    # archived messages and uploads keep their ids, which SQLite would
+    # give again to new rows once the newest one is deleted
+    if not m.has_autoincrement('message'):
+        m.rebuild_table('message', {
+            'id': '{row}.id',
+            'user_id': '{row}.user_id',
+            'text': '{row}.text',
+            'pub_date': '{row}.pub_date',
+            'privacy': '{row}.privacy',
+        }, 'CREATE TABLE "new_message" ("id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, '
+            '"user_id" INTEGER NOT NULL, "text" TEXT NOT NULL, "pub_date" DATETIME NOT NULL, '
+            '"privacy" INTEGER NOT NULL DEFAULT 0, '
+            'FOREIGN KEY ("user_id") REFERENCES "user" ("id"))')
+    if not m.has_autoincrement('upload'):
+        m.rebuild_table('upload', {
+            'id': '{row}.id',
+            'type': '{row}.type',
+            'message_id': '{row}.message_id',
+            'digest': '{row}.digest',
+        }, 'CREATE TABLE "new_upload" ("id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, '
+            '"type" TEXT NOT NULL, "message_id" INTEGER NOT NULL, "digest" VARCHAR(255), '
+            'FOREIGN KEY ("message_id") REFERENCES "message" ("id"))')
+    # dropped along with the old tables
+    Message._schema.create_indexes(safe=True)
+    Upload._schema.create_indexes(safe=True)
+    # start after every id given so far, archived ones included
+    for model, archived_model in ((Message, ArchivedMessage), (Upload, ArchivedUpload)):
+        table = model._meta.table_name
+        max_ids = [model.select(model.id).order_by(model.id.desc()).scalar() or 0]
+        if is_archive_enabled() and table in m.db.get_tables(schema='archive'):
+            max_ids.append(archived_model.select(archived_model.id)
+                .order_by(archived_model.id.desc()).scalar() or 0)
+        with m.db.atomic():
+            row = m.execute('SELECT seq FROM sqlite_sequence WHERE name = ?',
+                (table,)).fetchone()
+            max_ids.append(row[0] if row else 0)
+            m.execute('DELETE FROM sqlite_sequence WHERE name = ?', (table,))
+            m.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)',
+                (table, max(max_ids)))
@@ -9,20 +9,115 @@ The tables are:
 * relationship - a follow relationship between users
 * upload - a file upload attached to a message; new in 0.2
 * notification - a in-site notification to a user; new in 0.3
+* report - a report of a user or a message; new in 0.8
+* reportsummary - reports aggregated per reported user or message; new in 0.9
+* messageupvote - a +1 to a message; new in 0.9
+* mention - a user mentioned in a message; new in 0.9
+
+Since 0.9, old messages, uploads and upvotes may be moved into tables of
+the same names in an attached "archive" database.
 '''
 
 from flask import request
 from peewee import *
+from peewee import Expression, Node
+from playhouse.sqlite_ext import AutoIncrementField
+from .dbrouter import RoutingSqliteDatabase
+# not exported by `from .models import *`, which would shadow `app.cache`
+from .cache import cache as _cache
+from .identity import identity_map
 import os
 # here should go `from .utils import get_current_user`, but it will cause
 # import errors. It's instead imported at function level.
 
-database = SqliteDatabase('coriplus.sqlite')
+# The parent directory of the package.
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Changed in 0.9: the database is initialized by the app factory, and
+# read-only queries are routed to a pool of readers (see `app.dbrouter`).
+database = RoutingSqliteDatabase(None)
+
+def init_database(path, readers=4, archive=None):
+    database.init(path, readers=readers)
+    # new in 0.9: old messages can be moved into an attached database
+    database.detach('archive')
+    if archive:
+        database.attach(archive, 'archive')
+
+def is_archive_enabled():
+    return 'archive' in database._attached
+
+def _reset_after_fork():
+    # never share a SQLite connection with the parent process: forget them
+    # (without closing them), and let the child open its own.
+    database._state.reset()
+    database._reset_readers()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def invalidate_cache(*tags):
+    '''
+    Drop the cached values tagged with any of tags, once the current
+    transaction (if any) commits. New in 0.9.
+    '''
+    database.after_commit(lambda: _cache.invalidate(*tags))
+    # rows changed by queries are stale in the identity map too
+    identity_map.clear()
 
 class BaseModel(Model):
     class Meta:
         database = database
 
+    # new in 0.9: rows fetched by primary key are loaded once per request
+    # (see `app.identity`)
+    @classmethod
+    def get(cls, *query, **filters):
+        pk = cls._get_pk_lookup(query, filters)
+        if pk is None:
+            return super().get(*query, **filters)
+        instance = identity_map.get(cls, pk)
+        if instance is None:
+            instance = identity_map.add(super().get(*query, **filters))
+        return instance
+
+    @classmethod
+    def _get_pk_lookup(cls, query, filters):
+        # the id looked up by `get(Model.id == x)`, `get(x)`, `Model[x]`
+        # and foreign keys, or None
+        primary_key = cls._meta.primary_key
+        if filters or len(query) != 1 or not isinstance(primary_key, AutoField):
+            return None
+        expr = query[0]
+        if isinstance(expr, Expression) and expr.op == OP.EQ and expr.lhs is primary_key \
+                and not isinstance(expr.rhs, Node):
+            expr = expr.rhs
+        elif not isinstance(expr, int):
+            return None
+        try:
+            return int(expr)
+        except (TypeError, ValueError):
+            return None
+
+    # new in 0.9: cached values read from a row are dropped when it's
+    # saved or deleted (see `app.cache`)
+    def cache_tags(self):
+        return ()
+
+    def save(self, *args, **kwargs):
+        result = super().save(*args, **kwargs)
+        tags = self.cache_tags()
+        if tags:
+            invalidate_cache(*tags)
+        return result
+
+    def delete_instance(self, *args, **kwargs):
+        tags = self.cache_tags()
+        identity_map.discard(self)
+        result = super().delete_instance(*args, **kwargs)
+        if tags:
+            invalidate_cache(*tags)
+        return result
+
 # A user. The user is separated from its page.
 class User(BaseModel):
     # The unique username.
@@ -31,8 +126,8 @@ class User(BaseModel):
     full_name = TextField()
     # The password hash.
     password = CharField()
-    # An email address.
-    email = CharField()
+    # An email address. Indexed since 0.9, for logins by email.
+    email = CharField(index=True)
     # The date of birth (required because of Terms of Service)
     birthday = DateField()
     # The date joined
@@ -40,6 +135,9 @@ class User(BaseModel):
     # A disabled flag. 0 = active, 1 = disabled by user, 2 = banned
     is_disabled = IntegerField(default=0)
 
+    def cache_tags(self):
+        return ('user:{}'.format(self.id),)
+
     # Helpers for flask_login
     def get_id(self):
         return str(self.id)
@@ -70,6 +168,13 @@ class User(BaseModel):
                 .where(Relationship.to_user == self)
                 .order_by(User.username))
 
+    # new in 0.9: cached counts
+    def followers_count(self):
+        return get_follow_counts(self.id)[0]
+
+    def following_count(self):
+        return get_follow_counts(self.id)[1]
+
     def is_following(self, user):
         return (Relationship
                 .select()
@@ -89,14 +194,42 @@ class User(BaseModel):
     def is_admin(self):
         return UserAdminship.select().where(UserAdminship.user == self).exists()
     # user profile info; new in 0.6
+    # changed in 0.9: cached, and no longer created on reads (see
+    # `app.profiles`)
     @property
     def profile(self):
-        # lazy initialization; I don't want (and don't know how) 
-        # to do schema changes.
-        try:
-            return UserProfile.get(UserProfile.user == self)
-        except UserProfile.DoesNotExist:
-            return UserProfile.create(user=self, full_name=self.username)
+        return get_profile(self.id)
+
+@_cache.memoize(tags=lambda user_id: ('user:{}'.format(user_id),))
+def _load_user(user_id):
+    return User.get_by_id(user_id)
+
+def get_user(user_id):
+    '''
+    Return a user by id, from the identity map or the cache if possible.
+    New in 0.9.
+    '''
+    user = identity_map.get(User, user_id)
+    if user is None:
+        user = identity_map.add(_load_user(user_id))
+    return user
+
+@_cache.memoize(tags=lambda user_id: ('user:{}'.format(user_id),))
+def get_profile(user_id):
+    try:
+        return UserProfile.get(UserProfile.user == user_id)
+    except UserProfile.DoesNotExist:
+        # not backfilled yet
+        return UserProfile(user=user_id, biography='')
+
+@_cache.memoize(tags=lambda user_id: ('follows:{}'.format(user_id),))
+def get_follow_counts(user_id):
+    '''
+    Return the (followers, following) counts of a user. New in 0.9.
+    '''
+    followers = Relationship.select().where(Relationship.to_user == user_id).count()
+    following = Relationship.select().where(Relationship.from_user == user_id).count()
+    return followers, following
 
 # User adminship.
 # A very high privilege where users can review posts.
@@ -116,6 +249,10 @@ class UserProfile(BaseModel):
     instagram = TextField(null=True)
     facebook = TextField(null=True)
     telegram = TextField(null=True)
+
+    def cache_tags(self):
+        return ('user:{}'.format(self.user_id),)
+
     @property
     def full_name(self):
         '''
@@ -132,6 +269,9 @@ MSGPRV_ONLYME = 3 # only the poster
 # A single public message.
 # New in v0.5: removed type and info fields; added privacy field. 
 class Message(BaseModel):
+    # new in 0.9: ids of deleted messages are never given again, since
+    # archived messages keep theirs (see `app.archive`)
+    id = AutoIncrementField()
     # The user who posted the message.
     user = ForeignKeyField(User, backref='messages')
     # The text of the message.
@@ -141,6 +281,13 @@ class Message(BaseModel):
     # Info about privacy of the message.
     privacy = IntegerField(default=MSGPRV_PUBLIC)
 
+    class Meta:
+        # new in 0.9: for feeds, profiles and the public timeline
+        indexes = (
+            (('user', 'pub_date'), False),
+            (('privacy', 'pub_date'), False),
+        )
+
     def is_visible(self, is_public_timeline=False):
         from .utils import get_current_user
         user = self.user
@@ -188,17 +335,25 @@ class Relationship(BaseModel):
             (('from_user', 'to_user'), True),
         )
 
+    def cache_tags(self):
+        return ('follows:{}'.format(self.from_user_id), 'follows:{}'.format(self.to_user_id))
 
-UPLOAD_DIRECTORY = os.path.join(os.path.split(os.path.dirname(__file__))[0], 'uploads')
+
+UPLOAD_DIRECTORY = os.path.join(BASE_DIR, 'uploads')
 
 class Upload(BaseModel):
+    # new in 0.9: never reused, as message ids
+    id = AutoIncrementField()
     # the extension of the media
     type = TextField()
     # the message bound to this media
     message = ForeignKeyField(Message, backref='uploads')
+    # the SHA-256 digest of the file, which names it (see `app.storage`);
+    # null for files stored before 0.9 and not migrated yet. New in 0.9.
+    digest = CharField(null=True, index=True)
     # helper to retrieve contents
     def filename(self):
-        return str(self.id) + '.' + self.type
+        return (self.digest or str(self.id)) + '.' + self.type
     def url(self):
         return request.host_url + 'uploads/' + self.filename()
 
@@ -208,6 +363,19 @@ class Notification(BaseModel):
     detail = TextField()
     pub_date = DateTimeField()
     seen = IntegerField(default=0)
+
+    class Meta:
+        # new in 0.9: for notification lists and unseen counts
+        indexes = (
+            (('target', 'seen', 'pub_date'), False),
+        )
+
+# new in 0.9: the message a notification is about, if any, indexed for
+# the deletion of messages. The path is inlined: SQLite doesn't match
+# expressions with parameters against an index
+notification_message_id = fn.json_extract(Notification.detail, SQL("'$.message'"))
+Notification.add_index(ModelIndex(Notification, (notification_message_id,),
+    name='notification_message'))
     
 REPORT_MEDIA_USER = 1
 REPORT_MEDIA_MESSAGE = 2
@@ -252,6 +420,11 @@ class Report(BaseModel):
     reason = IntegerField()
     status = IntegerField(default=REPORT_STATUS_DELIVERED)
     created_date = DateTimeField()
+
+    class Meta:
+        indexes = (
+            (('media_type', 'media_id'), False),
+        )
     
     @property
     def media(self):
@@ -263,6 +436,24 @@ class Report(BaseModel):
         except DoesNotExist:
             return
 
+# Reports aggregated per reported user or message, for the moderation
+# queue. Kept up to date by `app.moderation`.
+# New in 0.9.
+class ReportSummary(BaseModel):
+    media_type = IntegerField()
+    media_id = IntegerField()
+    report_count = IntegerField(default=0)
+    # how many reports are still to be reviewed
+    pending_count = IntegerField(default=0)
+    last_report_id = IntegerField()
+    last_date = DateTimeField()
+
+    class Meta:
+        indexes = (
+            (('media_type', 'media_id'), True),
+            (('pending_count', 'last_date'), False),
+        )
+
 # New in 0.9.
 class MessageUpvote(BaseModel):
     message = ForeignKeyField(Message, backref='upvotes')
@@ -274,10 +465,70 @@ class MessageUpvote(BaseModel):
             (('message', 'user'), True),
         )
 
+# New in 0.9.
+# An index of the +username mentions in message texts (see `app.mentions`).
+# Mentions of archived messages are kept.
+class Mention(BaseModel):
+    message = ForeignKeyField(Message, backref='mentions')
+    user = ForeignKeyField(User, backref='mentions')
+
+    class Meta:
+        indexes = (
+            (('user', 'message'), True),
+        )
+
+class ArchiveForeignKeyField(ForeignKeyField):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # SQLite has no foreign keys across attached databases, so the
+        # constraint is left out of the table
+        self.deferred = True
+
+# Messages moved into the archive database, along with their uploads
+# and upvotes (see `app.archive`). Ids of messages and uploads are kept,
+# since they are linked to and name files. New in 0.9.
+class ArchivedMessage(Message):
+    user = ArchiveForeignKeyField(User, backref='archived_messages')
+    def upvoted_by_self(self):
+        from .utils import get_current_user
+        user = get_current_user()
+        return (ArchivedUpvote
+         .select()
+         .where((ArchivedUpvote.message == self) & (ArchivedUpvote.user == user))
+         .exists()
+        )
+
+    class Meta:
+        schema = 'archive'
+        table_name = 'message'
+        indexes = (
+            (('user', 'pub_date'), False),
+        )
+
+class ArchivedUpload(Upload):
+    message = ArchiveForeignKeyField(ArchivedMessage, backref='uploads')
+
+    class Meta:
+        schema = 'archive'
+        table_name = 'upload'
+
+class ArchivedUpvote(MessageUpvote):
+    message = ArchiveForeignKeyField(ArchivedMessage, backref='upvotes')
+    user = ArchiveForeignKeyField(User, backref='archived_upvotes')
+
+    class Meta:
+        schema = 'archive'
+        table_name = 'messageupvote'
+        indexes = (
+            (('message', 'user'), True),
+        )
+
 def create_tables():
     with database:
         database.create_tables([
             User, UserAdminship, UserProfile, Message, Relationship, 
-            Upload, Notification, Report, MessageUpvote])
+            Upload, Notification, Report, ReportSummary, MessageUpvote, Mention])
+        if is_archive_enabled():
+            database.create_tables([ArchivedMessage, ArchivedUpload, ArchivedUpvote])
     if not os.path.isdir(UPLOAD_DIRECTORY):
         os.makedirs(UPLOAD_DIRECTORY)
@@ -0,0 +1,123 @@
+'''
+The moderation queue.
+
+Reports are aggregated per reported user or message into the
+`reportsummary` table, which is refreshed every time a report is
+filed or reviewed. A page of the queue is rendered in a constant
+number of queries, whatever the number of reports is.
+
+New in 0.9.
+'''
+
+import datetime
+from peewee import fn
+from .models import User, Message, Report, ReportSummary, database, \
+    REPORT_MEDIA_USER, REPORT_MEDIA_MESSAGE, REPORT_STATUS_DELIVERED
+
+def refresh_summary(media_type, media_id):
+    '''
+    Recompute the summary of the reports of a target, using the
+    (media_type, media_id) index of reports.
+    '''
+    report_count, pending_count, last_report_id, last_date = (Report
+        .select(
+            fn.COUNT(Report.id),
+            fn.SUM(Report.status == REPORT_STATUS_DELIVERED),
+            fn.MAX(Report.id),
+            fn.MAX(Report.created_date))
+        .where((Report.media_type == media_type) & (Report.media_id == media_id))
+        .tuples()
+        .get())
+    if not report_count:
+        (ReportSummary
+         .delete()
+         .where((ReportSummary.media_type == media_type) &
+            (ReportSummary.media_id == media_id))
+         .execute())
+        return
+    (ReportSummary
+     .insert(
+        media_type=media_type,
+        media_id=media_id,
+        report_count=report_count,
+        pending_count=pending_count,
+        last_report_id=last_report_id,
+        last_date=last_date)
+     .on_conflict_replace()
+     .execute())
+
+def rebuild_summaries():
+    '''
+    Rebuild the whole summary table from reports.
+    '''
+    with database.atomic():
+        ReportSummary.delete().execute()
+        ReportSummary.insert_from(
+            Report.select(
+                Report.media_type,
+                Report.media_id,
+                fn.COUNT(Report.id),
+                fn.SUM(Report.status == REPORT_STATUS_DELIVERED),
+                fn.MAX(Report.id),
+                fn.MAX(Report.created_date))
+            .group_by(Report.media_type, Report.media_id),
+            [ReportSummary.media_type, ReportSummary.media_id,
+             ReportSummary.report_count, ReportSummary.pending_count,
+             ReportSummary.last_report_id, ReportSummary.last_date]
+        ).execute()
+
+def create_report(media_type, media_id, sender, reason):
+    with database.atomic():
+        report = Report.create(
+            media_type=media_type,
+            media_id=media_id,
+            sender=sender,
+            reason=reason,
+            created_date=datetime.datetime.now()
+        )
+        refresh_summary(media_type, media_id)
+    return report
+
+def get_queue_query():
+    '''
+    The targets with pending reports come first.
+    '''
+    return (ReportSummary
+        .select()
+        .order_by(ReportSummary.pending_count.desc(), ReportSummary.last_date.desc()))
+
+def load_queue_page(summaries):
+    '''
+    Load, in bulk, the reported users and messages of a page of summaries,
+    and the reason breakdowns. Return a list of (summary, media, reasons)
+    tuples, where reasons is a list of (reason, count) tuples.
+    '''
+    summaries = list(summaries)
+    user_ids = [s.media_id for s in summaries if s.media_type == REPORT_MEDIA_USER]
+    message_ids = [s.media_id for s in summaries if s.media_type == REPORT_MEDIA_MESSAGE]
+    media = {}
+    if user_ids:
+        for user in User.select().where(User.id << user_ids):
+            media[REPORT_MEDIA_USER, user.id] = user
+    if message_ids:
+        for message in (Message
+                .select(Message, User)
+                .join(User)
+                .where(Message.id << message_ids)):
+            media[REPORT_MEDIA_MESSAGE, message.id] = message
+    reasons = {}
+    if summaries:
+        targets = (
+            ((Report.media_type == REPORT_MEDIA_USER) &
+                (Report.media_id << (user_ids or [0]))) |
+            ((Report.media_type == REPORT_MEDIA_MESSAGE) &
+                (Report.media_id << (message_ids or [0]))))
+        for media_type, media_id, reason, count in (Report
+                .select(Report.media_type, Report.media_id, Report.reason, fn.COUNT(Report.id))
+                .where(targets)
+                .group_by(Report.media_type, Report.media_id, Report.reason)
+                .order_by(fn.COUNT(Report.id).desc())
+                .tuples()):
+            reasons.setdefault((media_type, media_id), []).append((reason, count))
+    return [(s, media.get((s.media_type, s.media_id)), reasons.get((s.media_type, s.media_id), []))
+        for s in summaries]
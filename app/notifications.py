@@ -0,0 +1,193 @@
+'''
+Aggregation and retention of notifications.
+
+Notifications of the types in `aggregated_types` are aggregated when
+pushed: a new one is merged with the latest unseen one of the same type
+for the same user, if that was pushed in the last
+`NOTIFICATION_AGGREGATE_WINDOW` seconds (defaults to a day) and names
+fewer than `NOTIFICATION_AGGREGATE_MAX` users (defaults to 50). So "A and
+12 others started following you" is one row instead of 13. The detail of
+an aggregated notification lists the users in "users", newest first,
+along with their "count"; "user" is the newest one.
+
+The merged notification replaces the previous one with a new id, so that
+clients of the event stream (see `app.events`) get it as a new event; its
+detail names the replaced one in "replaces", which was unseen, so that
+clients don't count it twice.
+Unfollowing removes the user from the notification, and deletes it once
+no user is left.
+
+`flask --app app prune-notifications` deletes seen notifications older
+than `NOTIFICATION_RETENTION_DAYS` days (defaults to 90), in small
+batches, and compacts the ones pushed one by one before 0.9.
+
+New in 0.9.
+'''
+
+import datetime, json, time
+from peewee import fn
+from .models import Notification, database
+
+aggregated_types = frozenset(('follow',))
+
+def get_users(detail):
+    return detail.get('users') or [detail['user']]
+
+def make_detail(users, detail):
+    return dict(detail, user=users[0], users=users, count=len(users))
+
+def aggregate_notification(type, target, detail, window=86400, max_users=50):
+    '''
+    Push a notification, merged with the latest unseen one of the same
+    type if recent and not full. Return the notification and the id of the
+    one it replaces, or None.
+    '''
+    now = datetime.datetime.now()
+    users = [detail['user']]
+    # nobody else may merge into the same notification meanwhile
+    with database.atomic('IMMEDIATE'):
+        previous = (Notification
+            .select()
+            .where(
+                (Notification.target == target) &
+                (Notification.seen == 0) &
+                (Notification.pub_date >= now - datetime.timedelta(seconds=window)) &
+                (Notification.type == type))
+            .order_by(Notification.pub_date.desc())
+            .first())
+        if previous is not None:
+            previous_users = get_users(json.loads(previous.detail))
+            if len(previous_users) < max_users:
+                users += [x for x in previous_users if x != detail['user']]
+                detail = dict(detail, replaces=previous.id)
+            else:
+                previous = None
+        notification = Notification.create(
+            type=type,
+            target=target,
+            detail=json.dumps(make_detail(users, detail)),
+            pub_date=now)
+        # only now, or the new one could reuse its id
+        if previous is not None:
+            previous.delete_instance()
+    return notification, previous.id if previous is not None else None
+
+def remove_aggregated_user(type, target, user_id):
+    '''
+    Remove a user from the notifications of type, deleting the ones left
+    without users.
+    '''
+    with database.atomic('IMMEDIATE'):
+        notifications = (Notification
+            .select()
+            .where(
+                (Notification.target == target) &
+                (Notification.type == type) &
+                # narrowed down in Python
+                Notification.detail.contains(str(user_id))))
+        for notification in notifications:
+            detail = json.loads(notification.detail)
+            users = get_users(detail)
+            if user_id not in users:
+                continue
+            users.remove(user_id)
+            if not users:
+                notification.delete_instance()
+            else:
+                (Notification
+                 .update(detail=json.dumps(make_detail(users, detail)))
+                 .where(Notification.id == notification.id)
+                 .execute())
+
+def prune_notifications(before, batch_size=500, pause=0.0, progress=None):
+    '''
+    Delete the seen notifications pushed before the given datetime, in
+    batches of ids, each in its own transaction. Return how many were
+    deleted.
+    '''
+    deleted = 0
+    last_id = 0
+    while True:
+        ids = [x for x, in Notification
+            .select(Notification.id)
+            .where(
+                (Notification.id > last_id) &
+                (Notification.seen == 1) &
+                (Notification.pub_date < before))
+            .order_by(Notification.id)
+            .limit(batch_size)
+            .tuples()]
+        if not ids:
+            break
+        last_id = ids[-1]
+        with database.atomic():
+            deleted += Notification.delete().where(Notification.id << ids).execute()
+        if progress:
+            progress(deleted)
+        if pause:
+            time.sleep(pause)
+    return deleted
+
+def compact_target(target_id, type, seen, window=86400, max_users=50):
+    '''
+    Merge the notifications of type of one user, as if they had been
+    aggregated when pushed. Return how many rows were removed.
+    '''
+    notifications = list(Notification
+        .select()
+        .where(
+            (Notification.target == target_id) &
+            (Notification.seen == seen) &
+            (Notification.type == type))
+        .order_by(Notification.pub_date.desc()))
+    groups = []
+    for notification in notifications:
+        users = get_users(json.loads(notification.detail))
+        group = groups[-1] if groups else None
+        if group is None or len(group[1]) + len(users) > max_users or \
+                group[0][0].pub_date - notification.pub_date > datetime.timedelta(seconds=window):
+            groups.append(([notification], list(users)))
+        else:
+            group[0].append(notification)
+            group[1].extend(x for x in users if x not in group[1])
+    removed = 0
+    for merged, users in groups:
+        if len(merged) < 2:
+            continue
+        newest = merged[0]
+        detail = json.loads(newest.detail)
+        detail.pop('replaces', None)
+        # created first, not to reuse the id of a deleted one
+        Notification.create(type=type, target=target_id, seen=seen, pub_date=newest.pub_date,
+            detail=json.dumps(make_detail(users, detail)))
+        Notification.delete().where(Notification.id << [x.id for x in merged]).execute()
+        removed += len(merged) - 1
+    return removed
+
+def compact_notifications(window=86400, max_users=50, batch_size=100, pause=0.0,
+        progress=None):
+    '''
+    Merge the notifications of aggregated types pushed one by one, for
+    batch_size users per transaction. Return how many rows were removed.
+    '''
+    groups = list(Notification
+        .select(Notification.target, Notification.type, Notification.seen)
+        .where(Notification.type << list(aggregated_types))
+        .group_by(Notification.target, Notification.type, Notification.seen)
+        .having(fn.COUNT(Notification.id) > 1)
+        .tuples())
+    removed = 0
+    for i in range(0, len(groups), batch_size):
+        with database.atomic():
+            for target_id, type, seen in groups[i:i+batch_size]:
+                removed += compact_target(target_id, type, seen, window, max_users)
+        if progress:
+            progress(removed)
+        if pause:
+            time.sleep(pause)
+    return removed
+
+def init_app(app):
+    app.config.setdefault('NOTIFICATION_AGGREGATE_WINDOW', 86400)
+    app.config.setdefault('NOTIFICATION_AGGREGATE_MAX', 50)
+    app.config.setdefault('NOTIFICATION_RETENTION_DAYS', 90)
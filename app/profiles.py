@@ -0,0 +1,98 @@
+'''
+Profile headers, assembled in one query.
+
+`get_profile_views()` loads users together with their profile, their
+message, follower and following counts and, if a viewer is given, whether
+the viewer follows them and is followed back: counts and relationships are
+subqueries, so a profile page header costs one query. Profiles are
+returned as read-only `ProfileView` tuples.
+
+Profiles are not created on reads anymore: every user gets one at signup,
+and `backfill_profiles()` (run by migration 6 and after bulk imports)
+creates the missing ones. Users still missing a profile get empty fields.
+
+New in 0.9.
+'''
+
+from peewee import JOIN, fn
+from collections import namedtuple
+from .models import User, UserProfile, Message, ArchivedMessage, Relationship, database, \
+    is_archive_enabled
+
+ProfileView = namedtuple('ProfileView', [
+    'id', 'username', 'full_name', 'join_date', 'is_disabled',
+    'biography', 'location', 'year', 'website', 'instagram', 'facebook', 'telegram',
+    'messages_count', 'followers_count', 'following_count',
+    # None if there is no viewer
+    'following', 'followed_by',
+])
+
+def backfill_profiles():
+    '''
+    Create the missing profiles. Return how many were created.
+    '''
+    with database.atomic():
+        return database.execute_sql(
+            "INSERT INTO userprofile (user_id, biography) "
+            "SELECT id, '' FROM user WHERE id NOT IN (SELECT user_id FROM userprofile)"
+        ).rowcount
+
+def _count(query):
+    return fn.COALESCE(query.select(fn.COUNT(1)), 0)
+
+def get_profile_query(condition, viewer=None):
+    '''
+    Return the query behind get_profile_views(), yielding dicts.
+    '''
+    messages_count = _count(Message.select().where(Message.user == User.id))
+    if is_archive_enabled():
+        messages_count = messages_count + _count(ArchivedMessage
+            .select()
+            .where(ArchivedMessage.user == User.id))
+    columns = [
+        User.id, User.username, User.full_name, User.join_date, User.is_disabled,
+        fn.COALESCE(UserProfile.biography, '').alias('biography'),
+        UserProfile.location, UserProfile.year, UserProfile.website,
+        UserProfile.instagram, UserProfile.facebook, UserProfile.telegram,
+        messages_count.alias('messages_count'),
+        _count(Relationship.select().where(Relationship.to_user == User.id))
+            .alias('followers_count'),
+        _count(Relationship.select().where(Relationship.from_user == User.id))
+            .alias('following_count'),
+    ]
+    if viewer is not None:
+        columns += [
+            fn.EXISTS(Relationship.select().where(
+                (Relationship.from_user == viewer) & (Relationship.to_user == User.id)))
+                .alias('following'),
+            fn.EXISTS(Relationship.select().where(
+                (Relationship.from_user == User.id) & (Relationship.to_user == viewer)))
+                .alias('followed_by'),
+        ]
+    return (User
+        .select(*columns)
+        .join(UserProfile, JOIN.LEFT_OUTER, on=(UserProfile.user == User.id))
+        .where(condition)
+        .dicts())
+
+def get_profile_views(condition, viewer=None):
+    '''
+    Return the profiles of the users matching condition, as a list of
+    ProfileView. Relationships are the ones of viewer, if given.
+    '''
+    views = []
+    for row in get_profile_query(condition, viewer):
+        if viewer is None:
+            row['following'] = row['followed_by'] = None
+        else:
+            row['following'] = bool(row['following'])
+            row['followed_by'] = bool(row['followed_by'])
+        views.append(ProfileView(**row))
+    return views
+
+def get_profile_view(condition, viewer=None):
+    '''
+    Return the profile of the user matching condition, or None.
+    '''
+    views = get_profile_views(condition, viewer)
+    return views[0] if views else None
@@ -0,0 +1,245 @@
+'''
+Query plan checks for the hot queries of the site.
+
+Every check builds a query the way views do, asks SQLite for its plan
+(`EXPLAIN QUERY PLAN`) and fails if the expected index is not used, or
+if a table is scanned without an index. Run them with
+`flask --app app check-query-plans`, which exits with an error if any
+check fails, so that a change can't silently bring back a full scan.
+
+Plans are made against a scratch in-memory database created from the
+models, with fixed statistics (see `write_stats()`) describing a large
+site, so that the result depends on the code only: not on the data, or
+the statistics, of the database in use.
+
+New in 0.9.
+'''
+
+import datetime
+from contextlib import contextmanager
+from peewee import OperationalError, SqliteDatabase, fn
+from .models import User, UserAdminship, UserProfile, Message, Relationship, Upload, \
+    Notification, Report, ReportSummary, MessageUpvote, Mention, ArchivedMessage, \
+    ArchivedUpload, ArchivedUpvote, REPORT_MEDIA_MESSAGE, is_archive_enabled, \
+    notification_message_id
+from .utils import get_feed_query, get_public_timeline_query
+from .moderation import get_queue_query
+from .archive import MergedQuery, user_messages
+from .profiles import get_profile_query
+from .mentions import get_mentions_query
+
+HOT_QUERIES = []
+
+def hot_query(name, *indexes):
+    '''
+    Register a function building a query, given a user and a date.
+    The plan must use all of the given indexes.
+    '''
+    def decorator(func):
+        func.check_name = name
+        func.indexes = indexes
+        HOT_QUERIES.append(func)
+        return func
+    return decorator
+
+MODELS = [User, UserAdminship, UserProfile, Message, Relationship, Upload, Notification,
+    Report, ReportSummary, MessageUpvote, Mention]
+ARCHIVE_MODELS = [ArchivedMessage, ArchivedUpload, ArchivedUpvote]
+
+# rows of the tables of a large site, and distinct values of the columns
+# with few of them; other columns have a value every 10 rows, unless
+# unique
+TABLE_ROWS = {'user': 100000, 'userprofile': 100000, 'useradminship': 10}
+DEFAULT_ROWS = 10000000
+COLUMN_VALUES = {'privacy': 4, 'seen': 2, 'media_type': 2, 'status': 4, 'type': 4,
+    'reason': 10, 'is_disabled': 2}
+
+def write_stats(db, schema='main'):
+    '''
+    Fill sqlite_stat1 of the schema with the fixed statistics, and have
+    the planner load them.
+    '''
+    db.execute_sql('ANALYZE {}'.format(schema))
+    db.execute_sql('DELETE FROM {}.sqlite_stat1'.format(schema))
+    tables = [x for x, in db.execute_sql("SELECT name FROM {}.sqlite_master "
+        "WHERE type = 'table' AND name NOT LIKE 'sqlite_%'".format(schema))]
+    for table in tables:
+        rows = TABLE_ROWS.get(table, DEFAULT_ROWS)
+        db.execute_sql('INSERT INTO {}.sqlite_stat1 VALUES (?, NULL, ?)'.format(schema),
+            (table, str(rows)))
+        for _, index, unique, *rest in db.execute_sql(
+                'PRAGMA {}.index_list("{}")'.format(schema, table)):
+            columns = [x[2] for x in db.execute_sql(
+                'PRAGMA {}.index_info("{}")'.format(schema, index))]
+            stat = [rows]
+            values = 1
+            for column in columns:
+                values = min(rows, values * COLUMN_VALUES.get(column, rows // 10))
+                stat.append(max(1, rows // values))
+            if unique:
+                stat[-1] = 1
+            db.execute_sql('INSERT INTO {}.sqlite_stat1 VALUES (?, ?, ?)'.format(schema),
+                (table, index, ' '.join(map(str, stat))))
+    # reloads the statistics
+    db.execute_sql('ANALYZE {}.sqlite_master'.format(schema))
+
+@contextmanager
+def scratch_database():
+    '''
+    Bind the models to an in-memory database with their schema and the
+    fixed statistics, for the duration of the block.
+    '''
+    db = SqliteDatabase(':memory:')
+    models = MODELS + (ARCHIVE_MODELS if is_archive_enabled() else [])
+    with db.bind_ctx(models):
+        if is_archive_enabled():
+            db.attach(':memory:', 'archive')
+        db.connect()
+        try:
+            db.create_tables(models)
+            write_stats(db)
+            if is_archive_enabled():
+                write_stats(db, 'archive')
+            yield db
+        finally:
+            db.close()
+
+def explain(query):
+    '''
+    Return the plan of a query, as a list of lines.
+    '''
+    sql, params = query.sql()
+    return [row[3] for row in query.model._meta.database.execute_sql(
+        'EXPLAIN QUERY PLAN ' + sql, params)]
+
+def check_plan(plan, indexes):
+    '''
+    Return the problems with a plan, as a list of messages.
+    '''
+    problems = []
+    for line in plan:
+        # "SCAN t1 USING INDEX ..." walks an index in order, e.g. for
+        # pagination; "SCAN t1" reads the whole table
+        if line.startswith('SCAN ') and ' INDEX ' not in line:
+            problems.append('full scan: ' + line)
+    for index in indexes:
+        if not any(' INDEX {} '.format(index) in line + ' ' for line in plan):
+            problems.append('index not used: ' + index)
+    return problems
+
+def check_query_plans():
+    '''
+    Run all the checks, against a scratch database. Return a list of
+    (name, plan, problems) tuples.
+    '''
+    user = User(id=1)
+    date = datetime.datetime.now()
+    results = []
+    with scratch_database():
+        for func in HOT_QUERIES:
+            query = func(user, date)
+            if query is None:
+                # not applicable
+                continue
+            try:
+                plan = explain(query)
+            except OperationalError as e:
+                results.append((func.check_name, [], [str(e)]))
+                continue
+            results.append((func.check_name, plan, check_plan(plan, func.indexes)))
+    return results
+
+@hot_query('feed', 'message_user_id_pub_date', 'relationship_from_user_id_to_user_id')
+def feed_query(user, date):
+    return get_feed_query(user, date)
+
+@hot_query('public timeline', 'message_privacy_pub_date')
+def public_timeline_query(user, date):
+    return get_public_timeline_query(date)
+
+@hot_query('profile messages', 'message_user_id_pub_date')
+def profile_messages_query(user, date):
+    query = user_messages(user, date)
+    return query.queries[0] if isinstance(query, MergedQuery) else query
+
+@hot_query('archived profile messages', 'archivedmessage_user_id_pub_date')
+def archived_profile_messages_query(user, date):
+    query = user_messages(user, date)
+    if isinstance(query, MergedQuery):
+        return query.queries[1]
+
+@hot_query('profile header', 'user_username', 'relationship_to_user_id',
+    'relationship_from_user_id_to_user_id')
+def profile_header_query(user, date):
+    return get_profile_query(User.username == 'username', user)
+
+@hot_query('mentions', 'mention_user_id_message_id')
+def mentions_query(user, date):
+    query = get_mentions_query(user, date)
+    return query.queries[0] if isinstance(query, MergedQuery) else query
+
+@hot_query('login by username', 'user_username')
+def login_username_query(user, date):
+    return User.select().where(User.username == 'username')
+
+@hot_query('login by email', 'user_email')
+def login_email_query(user, date):
+    return User.select().where(User.email == 'user@example.com')
+
+@hot_query('notifications', 'notification_target_id')
+def notifications_query(user, date):
+    return (Notification
+        .select()
+        .where(Notification.target == user)
+        .order_by(Notification.pub_date.desc())
+        .limit(100))
+
+@hot_query('unseen notification count', 'notification_target_id_seen_pub_date')
+def unseen_notifications_query(user, date):
+    return (Notification
+        .select(fn.COUNT(Notification.id))
+        .where((Notification.target == user) & (Notification.seen == 0)))
+
+@hot_query('mark notifications seen', 'notification_target_id_seen_pub_date')
+def notifications_seen_query(user, date):
+    return (Notification
+        .update(seen=1)
+        .where((Notification.target == user) & (Notification.pub_date < date)))
+
+@hot_query('notifications about messages', 'notification_message')
+def message_notifications_query(user, date):
+    return Notification.delete().where(notification_message_id << [1, 2])
+
+@hot_query('followers', 'relationship_to_user_id')
+def followers_query(user, date):
+    return user.followers()
+
+@hot_query('is following', 'relationship_from_user_id_to_user_id')
+def is_following_query(user, date):
+    return (Relationship
+        .select()
+        .where((Relationship.from_user == user) & (Relationship.to_user == 2)))
+
+@hot_query('message score', 'messageupvote_message_id')
+def score_query(user, date):
+    return (MessageUpvote
+        .select(fn.COUNT(MessageUpvote.id))
+        .where(MessageUpvote.message == 1))
+
+@hot_query('message uploads', 'upload_message_id')
+def uploads_query(user, date):
+    return Upload.select().where(Upload.message == 1)
+
+@hot_query('upload file references', 'upload_digest')
+def upload_references_query(user, date):
+    return Upload.select().where(Upload.digest == '0' * 64)
+
+@hot_query('reports of a target', 'report_media_type_media_id')
+def reports_query(user, date):
+    return (Report
+        .select()
+        .where((Report.media_type == REPORT_MEDIA_MESSAGE) & (Report.media_id == 1)))
+
+@hot_query('moderation queue', 'reportsummary_pending_count_last_date')
+def moderation_queue_query(user, date):
+    return get_queue_query().paginate(1, 20)
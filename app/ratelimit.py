@@ -0,0 +1,199 @@
+'''
+Rate limiting of requests, with token buckets.
+
+Limits are set in the `RATELIMITS` config value, a mapping from endpoint
+(e.g. "api.feed") or blueprint (e.g. "api") names to limits, given as
+"<count>/<period>" strings (e.g. "60/minute") or (count, seconds) tuples;
+an endpoint limit takes precedence over the one of its blueprint. Clients
+may do up to <count> requests in a burst, then they're refilled at
+<count> per period.
+
+API clients are told apart by the user of their access token, once
+validated; other clients, and the ones without a valid token, by their IP
+address. Clients over the limit get a 429 response, with a
+`Retry-After` header.
+
+Buckets are kept in memory, so every worker process has its own. Set
+`RATELIMIT_STORAGE` to the path of a SQLite file to share them between
+processes.
+
+New in 0.9.
+'''
+
+from flask import current_app, jsonify, request
+from werkzeug.exceptions import TooManyRequests
+from peewee import SqliteDatabase
+import math, os, threading, time
+from .utils import check_access_token
+
+default_limits = {
+    'api': '300/minute',
+    'api.feed': '60/minute',
+    'ajax.username_availability': '60/minute',
+    'root.send_access_token': '10/minute',
+}
+
+periods = {
+    'second': 1,
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400,
+}
+
+def parse_limit(limit):
+    '''
+    Return a limit as a (count, seconds) tuple.
+    '''
+    if isinstance(limit, str):
+        count, period = limit.split('/')
+        return int(count), periods[period.strip().rstrip('s')]
+    count, seconds = limit
+    return int(count), seconds
+
+class MemoryStorage(object):
+    '''
+    Buckets kept in a dict. Full buckets are dropped once there are more
+    than max_keys of them.
+    '''
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        # key -> [tokens, last update, time when the bucket is full again]
+        self.buckets = {}
+
+    def consume(self, key, capacity, rate, now):
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= self.max_keys:
+                    self.prune(now)
+                tokens = capacity
+            else:
+                tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = [tokens, now, now + (capacity - tokens) / rate]
+            return allowed, tokens
+
+    def prune(self, now):
+        for key in [k for k, v in self.buckets.items() if v[2] <= now]:
+            del self.buckets[key]
+
+class SQLiteStorage(object):
+    '''
+    Buckets kept in a SQLite file, shared between processes. Every check
+    is a short write transaction.
+    '''
+    def __init__(self, path, prune_every=1000):
+        self.database = SqliteDatabase(path, pragmas={'journal_mode': 'wal'})
+        self.prune_every = prune_every
+        self.calls = 0
+        with self.database.connection_context():
+            self.database.execute_sql('CREATE TABLE IF NOT EXISTS bucket ('
+                'key TEXT PRIMARY KEY, tokens REAL, updated REAL, full_at REAL)')
+
+    def reset(self):
+        self.database._state.reset()
+
+    def consume(self, key, capacity, rate, now):
+        with self.database.atomic('IMMEDIATE'):
+            row = self.database.execute_sql(
+                'SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                tokens = capacity
+            else:
+                tokens = min(capacity, row[0] + (now - row[1]) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.database.execute_sql('INSERT OR REPLACE INTO bucket '
+                '(key, tokens, updated, full_at) VALUES (?, ?, ?, ?)',
+                (key, tokens, now, now + (capacity - tokens) / rate))
+            self.calls += 1
+            if self.calls % self.prune_every == 0:
+                self.database.execute_sql('DELETE FROM bucket WHERE full_at <= ?', (now,))
+        return allowed, tokens
+
+class RateLimiter(object):
+    def __init__(self, limits, storage):
+        self.limits = {k: parse_limit(v) for k, v in limits.items()}
+        self.storage = storage
+        os.register_at_fork(after_in_child=storage.reset)
+
+    def get_limit(self, endpoint):
+        '''
+        Return the limit name and the (count, seconds) limit of the
+        endpoint, or None if it's not limited.
+        '''
+        if endpoint is None:
+            return None
+        for name in (endpoint, endpoint.rpartition('.')[0]):
+            if name in self.limits:
+                return name, self.limits[name]
+        return None
+
+    def hit(self, endpoint, client):
+        '''
+        Count a request by the client to the endpoint. Return None if it's
+        allowed, or else the seconds to wait before retrying.
+        '''
+        limit = self.get_limit(endpoint)
+        if limit is None:
+            return None
+        name, (count, seconds) = limit
+        rate = count / seconds
+        allowed, tokens = self.storage.consume('{}:{}'.format(name, client),
+            count, rate, time.time())
+        if allowed:
+            return None
+        return max(1, math.ceil((1 - tokens) / rate))
+
+def get_client_key():
+    # only API requests are authenticated by token, and only a valid one
+    # counts, by its user: otherwise any made-up token (or spelling of a
+    # valid one) would get a fresh bucket
+    if request.blueprint == 'api':
+        access_token = request.args.get('access_token')
+        if access_token:
+            user = check_access_token(access_token)
+            if user is not None:
+                return 'user:{}'.format(user.id)
+    return 'ip:' + str(request.remote_addr)
+
+def check_limit(endpoint):
+    '''
+    Count the current request against the limit of endpoint. Return None
+    if it's allowed, or else the seconds to wait before retrying.
+    '''
+    limiter = current_app.extensions.get('ratelimit')
+    if limiter is None:
+        return None
+    return limiter.hit(endpoint, get_client_key())
+
+def too_many_requests(retry_after):
+    if request.blueprint == 'api':
+        response = jsonify({'message': 'rate limit exceeded', 'status': 'fail'})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+    raise TooManyRequests(retry_after=retry_after)
+
+def init_app(app):
+    app.config.setdefault('RATELIMIT_ENABLED', True)
+    app.config.setdefault('RATELIMITS', default_limits)
+    app.config.setdefault('RATELIMIT_STORAGE', None)
+    if not app.config['RATELIMIT_ENABLED']:
+        return
+    path = app.config['RATELIMIT_STORAGE']
+    storage = SQLiteStorage(path) if path else MemoryStorage()
+    app.extensions['ratelimit'] = RateLimiter(app.config['RATELIMITS'], storage)
+
+    @app.before_request
+    def _check_limit():
+        retry_after = check_limit(request.endpoint)
+        if retry_after is not None:
+            return too_many_requests(retry_after)
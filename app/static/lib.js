@@ -116,3 +116,20 @@ function toggleUpvote(id){
   };
   xhr.send();
 }
+
+function attachNotificationStream(){
+  var counter = document.getElementById('notificationCount');
+  // only if live notifications are enabled on the server
+  if(!counter || !counter.dataset.stream || !window.EventSource) return;
+  var source = new EventSource(counter.dataset.stream);
+  source.addEventListener('notification', function(event){
+    var data = JSON.parse(event.data);
+    // an aggregated notification replacing an unseen one, already counted
+    if(data.seen || data.replaces) return;
+    var strong = counter.getElementsByTagName('strong')[0];
+    strong.innerHTML = parseInt(strong.innerHTML) + 1;
+    counter.style.display = '';
+  });
+}
+
+attachNotificationStream();
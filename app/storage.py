@@ -0,0 +1,218 @@
+'''
+Storage of upload files.
+
+Files are content-addressed: each one is named after the SHA-256 digest
+of its content, in a directory tree sharded by the first characters of
+the digest (e.g. `uploads/3a/7b/3a7b...`), so no directory grows past a
+few thousand entries. Identical uploads share the same file. Files are
+written in chunks to a temporary file, then renamed into place, so a
+file is either complete or missing.
+
+Upload rows keep the digest of their file; the files of uploads posted
+before 0.9 are named `<id>.<ext>`, at the top of the upload directory,
+and have no digest. `flask --app app migrate-uploads` moves them into the
+sharded tree, in batches.
+
+The upload directory is set by the `UPLOAD_DIRECTORY` config value.
+
+New in 0.9.
+'''
+
+from flask import abort, send_from_directory
+import hashlib, os, re, tempfile, time
+from .models import Upload, ArchivedUpload, database, is_archive_enabled, UPLOAD_DIRECTORY
+
+digest_re = re.compile(r'^[0-9a-f]{64}$')
+
+class FileStorage(object):
+    '''
+    Files in a local directory, sharded depth levels deep by the first
+    characters of their digest.
+
+    Files saved again are touched; delete() leaves alone files touched in
+    the last min_age seconds, so that a file being deleted is never lost
+    by a concurrent upload of the same content.
+    '''
+    def __init__(self, root, depth=2, chunk_size=65536, min_age=60):
+        self.root = root
+        self.depth = depth
+        self.chunk_size = chunk_size
+        self.min_age = min_age
+
+    def relpath(self, digest):
+        parts = [digest[2*i:2*i+2] for i in range(self.depth)]
+        return os.path.join(*parts, digest)
+
+    def path(self, digest):
+        return os.path.join(self.root, self.relpath(digest))
+
+    def exists(self, digest):
+        return os.path.isfile(self.path(digest))
+
+    def save(self, stream):
+        '''
+        Write the content of a file object, and return its digest.
+        '''
+        tmpdir = os.path.join(self.root, 'tmp')
+        os.makedirs(tmpdir, exist_ok=True)
+        h = hashlib.sha256()
+        fd, tmppath = tempfile.mkstemp(dir=tmpdir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = stream.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    h.update(chunk)
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            digest = h.hexdigest()
+            path = self.path(digest)
+            if os.path.exists(path):
+                # same content already stored
+                os.utime(path)
+                os.remove(tmppath)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmppath, path)
+        except BaseException:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+        return digest
+
+    def delete(self, digest):
+        '''
+        Remove a file, unless touched recently. Return whether it was
+        removed.
+        '''
+        path = self.path(digest)
+        try:
+            if time.time() - os.stat(path).st_mtime < self.min_age:
+                return False
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def iter_files(self):
+        '''
+        Yield (digest, path, mtime) for every stored file, temporary files
+        included (with a None digest).
+        '''
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            if dirpath == self.root:
+                # legacy files are at the top
+                dirnames[:] = [d for d in dirnames if len(d) == 2 or d == 'tmp']
+                continue
+            tmp = os.path.basename(dirpath) == 'tmp'
+            for name in filenames:
+                if not tmp and not digest_re.match(name):
+                    continue
+                path = os.path.join(dirpath, name)
+                yield (None if tmp else name), path, os.stat(path).st_mtime
+
+    def legacy_path(self, upload):
+        return os.path.join(self.root, '{}.{}'.format(upload.id, upload.type))
+
+storage = FileStorage(UPLOAD_DIRECTORY)
+
+def get_upload(upload_id):
+    for model in (Upload, ArchivedUpload) if is_archive_enabled() else (Upload,):
+        upload = model.get_or_none(model.id == upload_id)
+        if upload is not None:
+            return upload
+
+def send_upload(name, type):
+    '''
+    Respond with the file of `<name>.<type>`, where name is either a
+    digest or the id of an upload posted before 0.9.
+    '''
+    if digest_re.match(name):
+        # the content of a digest never changes
+        return send_from_directory(storage.root, storage.relpath(name),
+            download_name='{}.{}'.format(name, type), max_age=365 * 86400)
+    if name.isdigit():
+        upload = get_upload(int(name))
+        if upload is not None and upload.digest:
+            # an old URL of a migrated file
+            return send_upload(upload.digest, type)
+        return send_from_directory(storage.root, name + '.' + type)
+    abort(404)
+
+def save_upload(file, message):
+    '''
+    Store an uploaded file (a werkzeug FileStorage) and return its Upload.
+    '''
+    ext = file.filename.split('.')[-1]
+    digest = storage.save(file.stream)
+    return Upload.create(type=ext, message=message, digest=digest)
+
+def is_referenced(digest):
+    if Upload.select().where(Upload.digest == digest).exists():
+        return True
+    return is_archive_enabled() and \
+        ArchivedUpload.select().where(ArchivedUpload.digest == digest).exists()
+
+def remove_upload_files(uploads):
+    '''
+    Remove the files of deleted uploads, given as (id, type, digest)
+    tuples; shared files are kept until their last upload is deleted.
+    '''
+    for upload_id, type, digest in uploads:
+        if digest:
+            if not is_referenced(digest):
+                storage.delete(digest)
+            continue
+        try:
+            os.remove(os.path.join(storage.root, '{}.{}'.format(upload_id, type)))
+        except FileNotFoundError:
+            pass
+
+def migrate_uploads(batch_size=100, pause=0.0, progress=None):
+    '''
+    Move the files of uploads posted before 0.9 into the sharded tree.
+    Every batch of uploads is updated in one transaction; old files are
+    removed after it commits, so an interrupted migration can be resumed.
+    Return the (moved, missing) counts.
+    '''
+    moved = missing = 0
+    models = (Upload, ArchivedUpload) if is_archive_enabled() else (Upload,)
+    for model in models:
+        last_id = 0
+        while True:
+            uploads = list(model
+                .select()
+                .where(model.digest.is_null() & (model.id > last_id))
+                .order_by(model.id)
+                .limit(batch_size))
+            if not uploads:
+                break
+            last_id = uploads[-1].id
+            digests = {}
+            for upload in uploads:
+                try:
+                    with open(storage.legacy_path(upload), 'rb') as f:
+                        digests[upload.id] = storage.save(f)
+                except FileNotFoundError:
+                    missing += 1
+            with database.atomic():
+                for upload_id, digest in digests.items():
+                    model.update(digest=digest).where(model.id == upload_id).execute()
+            for upload in uploads:
+                if upload.id in digests:
+                    try:
+                        os.remove(storage.legacy_path(upload))
+                    except FileNotFoundError:
+                        pass
+            moved += len(digests)
+            if progress:
+                progress(moved, missing)
+            if pause:
+                time.sleep(pause)
+    return moved, missing
+
+def init_app(app):
+    app.config.setdefault('UPLOAD_DIRECTORY', UPLOAD_DIRECTORY)
+    storage.root = app.config['UPLOAD_DIRECTORY']
@@ -0,0 +1,183 @@
+'''
+Recording of anonymized traffic.
+
+When `TRAFFIC_LOG` is set to a file path, every request (or a sample of
+them, see `TRAFFIC_SAMPLE_RATE`) is appended to it as a line of JSON,
+e.g.:
+
+    {"t": 1767225600.125, "method": "GET", "endpoint": "api.profile_info",
+     "rule": "/api/V1/profile_info/<userid>", "view_args": {"userid": ["int", 417]},
+     "args": {"offset": "float"}, "body": null, "auth": "token", "user": 82,
+     "status": 200, "duration": 3.2, "size": 512}
+
+No value is recorded, only its shape: "int", "float", "ints:<count>" for
+comma-separated ids, "str:<length>" and so on. View arguments naming rows
+(usernames, ids) are recorded as their shape and a bucket, and so is the
+authenticated user id: buckets are keyed hashes (by the secret key) of the
+values, modulo `TRAFFIC_BUCKETS`, so that the same user maps to the same
+bucket across the trace, but the values can't be recovered. Access tokens
+and form values, passwords included, are never written.
+
+`python -m benchmarks.replay` replays a recorded trace against a local
+instance. Each process appends whole lines to the file, so worker
+processes can share it.
+
+New in 0.9.
+'''
+
+from flask import g, request
+import hashlib, hmac, json, os, random, re, threading, time
+
+# values not identifying anyone, kept as is
+kept_values = frozenset(('self',))
+
+float_re = re.compile(r'^-?[0-9]+\.[0-9]*$')
+ints_re = re.compile(r'^[0-9]+(,[0-9]+)+,?$')
+
+def value_shape(value):
+    '''
+    Return the shape of a request value, which tells its type and size
+    but not its content.
+    '''
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    if isinstance(value, (list, tuple)):
+        return 'list:{}'.format(len(value))
+    if isinstance(value, dict):
+        return 'dict'
+    value = str(value)
+    if value in kept_values or value == '':
+        return value
+    if value.isdigit():
+        return 'int'
+    if float_re.match(value):
+        return 'float'
+    if ints_re.match(value):
+        return 'ints:{}'.format(len([x for x in value.split(',') if x]))
+    if value.startswith('+'):
+        return '+' + value_shape(value[1:])
+    return 'str:{}'.format(len(value))
+
+class TrafficRecorder(object):
+    def __init__(self, path=None, sample_rate=1.0, buckets=1000, key=b''):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.buckets = buckets
+        self.key = key
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        # every process opens its own
+        self.fd = None
+        self.recorded = 0
+
+    def bucket(self, value):
+        digest = hmac.new(self.key, str(value).encode('utf-8'), hashlib.sha256).digest()
+        return int.from_bytes(digest[:8], 'big') % self.buckets
+
+    def view_arg(self, value):
+        shape = value_shape(value)
+        if shape in kept_values:
+            return [shape, None]
+        if isinstance(value, str) and value.startswith('+'):
+            value = value[1:]
+        return [shape, self.bucket(value)]
+
+    def make_record(self, request, response, start, duration, user_id):
+        args = {k: value_shape(v) for k, v in request.args.items() if k != 'access_token'}
+        body = None
+        if request.method not in ('GET', 'HEAD') and request.content_length:
+            if request.is_json:
+                data = request.get_json(silent=True)
+                body = {'type': 'json', 'fields': {k: value_shape(v)
+                    for k, v in data.items()} if isinstance(data, dict) else {}}
+            elif request.mimetype in ('application/x-www-form-urlencoded',
+                    'multipart/form-data'):
+                body = {'type': 'form', 'fields': {k: value_shape(v)
+                    for k, v in request.form.items()},
+                    'files': {k: v.filename.rsplit('.', 1)[-1].lower()
+                    for k, v in request.files.items() if v.filename}}
+            else:
+                body = {'type': request.mimetype, 'fields': {}}
+            body['length'] = request.content_length
+        if 'access_token' in request.args:
+            auth = 'token'
+        elif user_id is not None:
+            auth = 'session'
+        else:
+            auth = None
+        return {
+            't': round(start, 3),
+            'method': request.method,
+            'endpoint': request.endpoint,
+            'rule': request.url_rule.rule if request.url_rule is not None else None,
+            'view_args': {k: self.view_arg(v) for k, v in (request.view_args or {}).items()},
+            'args': args,
+            'body': body,
+            'auth': auth,
+            'user': self.bucket(user_id) if user_id is not None else None,
+            'status': response.status_code,
+            'duration': round(duration * 1000, 3),
+            'size': response.content_length,
+        }
+
+    def write(self, record):
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+        with self.lock:
+            if self.fd is None:
+                self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            # a single write of the whole line, not interleaved with
+            # the ones of other processes
+            os.write(self.fd, line)
+            self.recorded += 1
+
+recorder = TrafficRecorder()
+os.register_at_fork(after_in_child=recorder.reset)
+
+def get_user_id():
+    '''
+    Return the id of the authenticated user, without loading it.
+    '''
+    token = request.args.get('access_token')
+    if token:
+        uid = token.split(':', 1)[0]
+        return int(uid) if uid.isdigit() else None
+    # only if the view loaded it
+    user = g.get('_login_user')
+    if user is not None and user.is_authenticated:
+        return user.id
+    return None
+
+def init_app(app):
+    app.config.setdefault('TRAFFIC_LOG', None)
+    app.config.setdefault('TRAFFIC_SAMPLE_RATE', 1.0)
+    app.config.setdefault('TRAFFIC_BUCKETS', 1000)
+    if not app.config['TRAFFIC_LOG']:
+        return
+    recorder.path = app.config['TRAFFIC_LOG']
+    recorder.sample_rate = app.config['TRAFFIC_SAMPLE_RATE']
+    recorder.buckets = app.config['TRAFFIC_BUCKETS']
+    key = app.config.get('SECRET_KEY') or b''
+    recorder.key = key.encode('utf-8') if isinstance(key, str) else key
+
+    @app.before_request
+    def _start_recording():
+        if recorder.sample_rate >= 1 or random.random() < recorder.sample_rate:
+            g._traffic_start = time.time(), time.perf_counter()
+
+    @app.after_request
+    def _record(response):
+        start = g.pop('_traffic_start', None)
+        if start is not None:
+            duration = time.perf_counter() - start[1]
+            try:
+                recorder.write(recorder.make_record(request, response, start[0],
+                    duration, get_user_id()))
+            except Exception:
+                app.logger.exception('could not record request')
+        return response
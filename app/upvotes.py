@@ -0,0 +1,219 @@
+'''
+Write-behind buffer for upvotes.
+
+Upvote toggles are recorded in memory, keyed by message and user, so
+repeated toggles by the same user collapse into their final state (and
+toggling twice writes nothing). The buffer is written in one transaction
+every `UPVOTE_FLUSH_INTERVAL` seconds (defaults to 1), or as soon as it
+holds `UPVOTE_FLUSH_SIZE` toggles (defaults to 500), by a background
+thread; it's flushed at exit too.
+
+Scores are optimistic: the stored count plus the pending toggles. Until
+a flush, other pages may show the old score.
+
+Toggles still in memory are lost if the process crashes. Set
+`UPVOTE_WRITE_BEHIND` to false to write every toggle at once instead.
+
+New in 0.9.
+'''
+
+from peewee import Tuple, chunked
+import atexit, datetime, os, sys, threading
+from .models import MessageUpvote, database
+
+class UpvoteBuffer(object):
+    def __init__(self, interval=1.0, max_size=500, write_behind=True):
+        self.interval = interval
+        self.max_size = max_size
+        self.write_behind = write_behind
+        self.reset()
+
+    def reset(self):
+        # forget pending toggles and the flusher thread; used after fork,
+        # since they belong to the parent
+        self.lock = threading.Lock()
+        # one flush at a time
+        self.flush_lock = threading.Lock()
+        # (message id, user id) -> [stored state, wanted state, date]
+        self.pending = {}
+        # message id -> score difference of pending toggles
+        self.deltas = {}
+        # toggles being written, not committed yet
+        self.flushing = {}
+        # how many flushes were committed
+        self.flushes = 0
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def _is_stored(self, message_id, user_id):
+        return (MessageUpvote
+            .select()
+            .where((MessageUpvote.message == message_id) & (MessageUpvote.user == user_id))
+            .exists())
+
+    def upvoted(self, message_id, user_id):
+        '''
+        Whether the user upvoted the message, pending toggles included.
+        '''
+        key = message_id, user_id
+        with self.lock:
+            entry = self.pending.get(key) or self.flushing.get(key)
+        if entry is not None:
+            return entry[1]
+        return self._is_stored(message_id, user_id)
+
+    def score(self, message_id):
+        '''
+        The optimistic score of the message.
+        '''
+        count = MessageUpvote.select().where(MessageUpvote.message == message_id).count()
+        with self.lock:
+            return count + self.deltas.get(message_id, 0)
+
+    def set(self, message_id, user_id, upvoted=None):
+        '''
+        Upvote (or remove the upvote, if upvoted is false) the message on
+        behalf of the user; if upvoted is None, toggle it. Return the new
+        state.
+        '''
+        if not self.write_behind:
+            return self._write_through(message_id, user_id, upvoted)
+        key = message_id, user_id
+        stored = flushes = None
+        while True:
+            with self.lock:
+                entry = self.pending.get(key)
+                if entry is None:
+                    if key in self.flushing:
+                        # being written: that will be the stored state
+                        stored = self.flushing[key][1]
+                    elif stored is None or flushes != self.flushes:
+                        # unknown, or read before a flush committed
+                        stored = None
+                        flushes = self.flushes
+                    if stored is not None:
+                        entry = self.pending[key] = [stored, stored, None]
+                if entry is not None:
+                    state, size = self._toggle(key, entry, upvoted)
+                    break
+            # read outside of the lock, then checked again
+            stored = self._is_stored(message_id, user_id)
+        self._start()
+        if size >= self.max_size:
+            self.wakeup.set()
+        return state
+
+    def _toggle(self, key, entry, upvoted):
+        # with the lock held
+        message_id = key[0]
+        before = entry[1]
+        entry[1] = (not before) if upvoted is None else bool(upvoted)
+        entry[2] = datetime.datetime.now()
+        if entry[1] != before:
+            self.deltas[message_id] = self.deltas.get(message_id, 0) + \
+                (1 if entry[1] else -1)
+            if not self.deltas[message_id]:
+                del self.deltas[message_id]
+        if entry[0] == entry[1]:
+            # back to the stored state: nothing to write
+            del self.pending[key]
+        return entry[1], len(self.pending)
+
+    def _write_through(self, message_id, user_id, upvoted):
+        with database.atomic():
+            if upvoted is None:
+                upvoted = not self._is_stored(message_id, user_id)
+            if upvoted:
+                self._write([(message_id, user_id, datetime.datetime.now())], [])
+            else:
+                self._write([], [(message_id, user_id)])
+        return upvoted
+
+    def _write(self, added, removed):
+        # added are (message, user, date) tuples, removed (message, user) ones
+        for batch in chunked(added, 300):
+            (MessageUpvote
+             .insert_many(batch, fields=[MessageUpvote.message, MessageUpvote.user,
+                MessageUpvote.created_date])
+             .on_conflict_ignore()
+             .execute())
+        for batch in chunked(removed, 300):
+            (MessageUpvote
+             .delete()
+             .where(Tuple(MessageUpvote.message, MessageUpvote.user).in_(batch))
+             .execute())
+
+    def flush(self):
+        '''
+        Write all the pending toggles in one transaction. Return how many
+        were written.
+        '''
+        with self.flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self.lock:
+            if not self.pending:
+                return 0
+            pending, self.pending = self.pending, {}
+            self.flushing = pending
+        added = [(m, u, date) for (m, u), (stored, wanted, date) in pending.items()
+            if wanted]
+        removed = [key for key, (stored, wanted, date) in pending.items() if not wanted]
+        try:
+            with database.atomic():
+                self._write(added, removed)
+        except Exception:
+            with self.lock:
+                for key, entry in pending.items():
+                    if key not in self.pending:
+                        self.pending[key] = entry
+                        continue
+                    # toggled again in the meantime, from a state never stored
+                    self.pending[key][0] = entry[0]
+                    if self.pending[key][0] == self.pending[key][1]:
+                        del self.pending[key]
+                self.flushing = {}
+            raise
+        # the toggles are in the stored count now, not before
+        with self.lock:
+            for (message_id, user_id), (stored, wanted, date) in pending.items():
+                delta = self.deltas.get(message_id, 0) - (1 if wanted else -1)
+                if delta:
+                    self.deltas[message_id] = delta
+                else:
+                    self.deltas.pop(message_id, None)
+            self.flushing = {}
+            self.flushes += 1
+        return len(pending)
+
+    def _start(self):
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run,
+                name='upvote-flusher', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                sys.excepthook(*sys.exc_info())
+
+upvote_buffer = UpvoteBuffer()
+os.register_at_fork(after_in_child=upvote_buffer.reset)
+atexit.register(upvote_buffer.flush)
+
+def init_app(app):
+    app.config.setdefault('UPVOTE_FLUSH_INTERVAL', 1.0)
+    app.config.setdefault('UPVOTE_FLUSH_SIZE', 500)
+    app.config.setdefault('UPVOTE_WRITE_BEHIND', True)
+    upvote_buffer.interval = app.config['UPVOTE_FLUSH_INTERVAL']
+    upvote_buffer.max_size = app.config['UPVOTE_FLUSH_SIZE']
+    upvote_buffer.write_behind = app.config['UPVOTE_WRITE_BEHIND']
@@ -2,10 +2,15 @@
 A list of utilities used across modules.
 '''
 
-import datetime, re, base64, hashlib, string, sys, json
-from .models import User, Message, Notification, MSGPRV_PUBLIC, MSGPRV_UNLISTED, \
-    MSGPRV_FRIENDS, MSGPRV_ONLYME
-from flask import abort, render_template, request, session
+import datetime, re, base64, hashlib, string, sys, json, os
+from .models import User, Message, Relationship, Notification, MSGPRV_PUBLIC, \
+    MSGPRV_UNLISTED, MSGPRV_FRIENDS, MSGPRV_ONLYME, BASE_DIR, get_user
+from .events import broker
+from .mentions import parse_mentions, update_mentions
+from .notifications import aggregated_types, aggregate_notification, remove_aggregated_user
+from flask import abort, current_app, render_template, request, session
+from collections.abc import Mapping
+from functools import lru_cache
 from markupsafe import Markup
 
 _forbidden_extensions = 'com net org txt'.split()
@@ -81,9 +86,76 @@ class Visibility(object):
                     yield i
                 counter += 1
 
+def get_feed_query(user, before=None):
+    '''
+    Messages by user and the users they follow, newest first; only the
+    ones published before the given datetime, if given. New in 0.9.
+    '''
+    query = Message.select().where(
+        (Message.user << user.following()) | (Message.user == user))
+    if before is not None:
+        query = query.where(Message.pub_date < before)
+    return query.order_by(Message.pub_date.desc())
+
+def get_public_timeline_query(before=None):
+    '''
+    Messages which may show up in the public timeline, newest first; only
+    the ones published before the given datetime, if given. New in 0.9.
+    '''
+    # only public and friends-only messages can be visible there; the
+    # filter lets the (privacy, pub_date) index be used
+    query = Message.select().where(Message.privacy << (MSGPRV_PUBLIC, MSGPRV_FRIENDS))
+    if before is not None:
+        query = query.where(Message.pub_date < before)
+    return query.order_by(Message.pub_date.desc())
+
+def get_friend_ids(user, user_ids):
+    '''
+    Return the subset of user_ids which are mutual followers of user.
+    Costs at most two queries, whatever the number of ids is.
+    '''
+    user_ids = set(user_ids)
+    if not user_ids or not user:
+        return set()
+    following = (Relationship
+        .select(Relationship.to_user)
+        .where((Relationship.from_user == user) & (Relationship.to_user << user_ids))
+        .tuples())
+    followed_by = (Relationship
+        .select(Relationship.from_user)
+        .where((Relationship.to_user == user) & (Relationship.from_user << user_ids))
+        .tuples())
+    return {x for x, in following} & {x for x, in followed_by}
+
+def filter_visible(messages, cur_user, is_public_timeline=False):
+    '''
+    Bulk version of Message.is_visible(). Messages should be fetched
+    with their user; friend checks are done once for all of them.
+    '''
+    messages = list(messages)
+    cur_user_id = getattr(cur_user, 'id', None)
+    friend_ids = get_friend_ids(cur_user, (
+        m.user_id for m in messages
+        if m.privacy == MSGPRV_FRIENDS and m.user_id != cur_user_id))
+    visible = []
+    for m in messages:
+        if m.user_id == cur_user_id:
+            is_visible = not is_public_timeline
+        elif m.privacy == MSGPRV_PUBLIC:
+            is_visible = True
+        elif m.privacy == MSGPRV_UNLISTED:
+            is_visible = not is_public_timeline
+        elif m.privacy == MSGPRV_FRIENDS:
+            is_visible = m.user_id in friend_ids
+        else:
+            is_visible = False
+        if is_visible:
+            visible.append(m)
+    return visible
+
 def get_locations():
     data = {}
-    with open('locations.txt', encoding='utf-8') as f:
+    with open(os.path.join(BASE_DIR, 'locations.txt'), encoding='utf-8') as f:
         for line in f:
             line = line.rstrip()
             if line.startswith('#'):
@@ -95,10 +167,28 @@ def get_locations():
             data[key] = value
     return data
 
-try:
-    locations = get_locations()
-except OSError:
-    locations = {}
+class LazyLocations(Mapping):
+    '''
+    The locations, read from `locations.txt` on first use. New in 0.9.
+    '''
+    def __init__(self):
+        self._data = None
+    @property
+    def data(self):
+        if self._data is None:
+            try:
+                self._data = get_locations()
+            except OSError:
+                self._data = {}
+        return self._data
+    def __getitem__(self, key):
+        return self.data[key]
+    def __iter__(self):
+        return iter(self.data)
+    def __len__(self):
+        return len(self.data)
+
+locations = LazyLocations()
 
 # get the user from the session
 # changed in 0.5 to comply with flask_login
@@ -106,29 +196,54 @@ def get_current_user():
     # new in 0.7; need a different method to get current user id
     if request.path.startswith('/api/'):
         # assume token validation is already done
-        return User[request.args['access_token'].split(':')[0]]
+        return get_user(int(request.args['access_token'].split(':')[0]))
     else:
-        user_id = session.get('user_id')
+        # flask_login 0.5 and newer store it as `_user_id`
+        user_id = session.get('_user_id', session.get('user_id'))
         if user_id:
-           return User[user_id]
+           return get_user(int(user_id))
 
 def push_notification(type, target, **kwargs):
     try:
         if isinstance(target, str):
             target = User.get(User.username == target)
-        Notification.create(
-            type=type,
-            target=target,
-            detail=json.dumps(kwargs),
-            pub_date=datetime.datetime.now()
-        )
+        if type in aggregated_types:
+            # new in 0.9
+            notification, _ = aggregate_notification(type, target, kwargs,
+                window=current_app.config['NOTIFICATION_AGGREGATE_WINDOW'],
+                max_users=current_app.config['NOTIFICATION_AGGREGATE_MAX'])
+        else:
+            notification = Notification.create(
+                type=type,
+                target=target,
+                detail=json.dumps(kwargs),
+                pub_date=datetime.datetime.now()
+            )
+        # new in 0.9; for live notifications
+        info = get_notification_info(notification)
+        broker.publish(notification.target_id, (notification.id, info))
     except Exception:
         sys.excepthook(*sys.exc_info())
 
+# moved here from api in 0.9
+def get_notification_info(notification):
+    obj = {
+        "id": notification.id,
+        "type": notification.type,
+        "timestamp": notification.pub_date.timestamp(),
+        "seen": notification.seen
+    }
+    obj.update(json.loads(notification.detail))
+    return obj
+
 def unpush_notification(type, target, **kwargs):
     try:
         if isinstance(target, str):
             target = User.get(User.username == target)
+        if type in aggregated_types:
+            # new in 0.9
+            remove_aggregated_user(type, target, kwargs['user'])
+            return
         (Notification
          .delete()
          .where(
@@ -168,8 +283,7 @@ def tokenize(characters, table):
     return tokens
 
 def get_secret_key():
-    from . import app
-    secret_key = app.config['SECRET_KEY']
+    secret_key = current_app.config['SECRET_KEY']
     if isinstance(secret_key, str):
         secret_key = secret_key.encode('utf-8')
     return secret_key
@@ -186,9 +300,11 @@ def generate_access_token(user):
     return str(user.id) + ':' + h.hexdigest()[:32]
 
 def check_access_token(token):
-    uid, hh = token.split(':')
+    uid, _, hh = token.partition(':')
+    if not uid.isdigit():
+        return
     try:
-        user = User[uid]
+        user = get_user(int(uid))
     except User.DoesNotExist:
         return
     h = hashlib.sha256(get_secret_key())
@@ -199,11 +315,15 @@ def check_access_token(token):
     if h.hexdigest()[:32] == hh:
         return user
 
-def create_mentions(cur_user, text, privacy):
+def create_mentions(cur_user, text, privacy, message=None):
     # create mentions
-    mention_usernames = set()
-    for mo in re.finditer(r'\+([A-Za-z0-9_]+(?:\.[A-Za-z0-9_]+)*)', text):
-        mention_usernames.add(mo.group(1))
+    # changed in 0.9: notifications carry the message id, if given
+    detail = {'user': cur_user.id}
+    if message is not None:
+        detail['message'] = message.id
+        # new in 0.9
+        update_mentions(message, text)
+    mention_usernames = parse_mentions(text)
     # to avoid self mention
     mention_usernames.difference_update({cur_user.username})
     for u in mention_usernames:
@@ -213,14 +333,16 @@ def create_mentions(cur_user, text, privacy):
                     (privacy == MSGPRV_FRIENDS and
                     mention_user.is_following(cur_user) and 
                     cur_user.is_following(mention_user)):
-                push_notification('mention', mention_user, user=user.id)
+                push_notification('mention', mention_user, **detail)
         except User.DoesNotExist:
             pass
 
 # New in 0.9
+# Icons are read once, on first use.
+@lru_cache(maxsize=None)
 def inline_svg(name, width=None):
     try:
-        with open('icons/' + name + '-24px.svg') as f:
+        with open(os.path.join(BASE_DIR, 'icons', name + '-24px.svg')) as f:
             data = f.read()
             if isinstance(width, int):
                 data = re.sub(r'( (?:height|width)=")\d+(")', lambda x:x.group(1) + str(width) + x.group(2), data)
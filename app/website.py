@@ -4,6 +4,11 @@ All website hooks, excluding AJAX.
 
 from .utils import *
 from .models import *
+from .events import notification_stream_response, is_stream_enabled
+from .archive import user_messages
+from .profiles import get_profile_view
+from .storage import save_upload
+from .mentions import get_mentions_page
 from . import __version__ as app_version
 from sys import version as python_version
 from flask import Blueprint, abort, flash, redirect, render_template, request, url_for, __version__ as flask_version
@@ -24,18 +29,23 @@ def private_timeline():
     # messages where the person who created the message is someone the current
     # user is following.  these messages are then ordered newest-first.
     user = get_current_user()
-    messages = Visibility(Message
-                .select()
-                .where((Message.user << user.following())
-                       | (Message.user == user))
-                .order_by(Message.pub_date.desc()))
+    messages = Visibility(get_feed_query(user))
     return object_list('feed.html', messages, 'message_list')
 
+# New in 0.9.
+@bp.route('/mentions/')
+@login_required
+def mentions_timeline():
+    # paginated by date, as the API
+    before = request.args.get('before', type=float)
+    messages, has_more = get_mentions_page(get_current_user(),
+        datetime.datetime.fromtimestamp(before) if before is not None else None)
+    return render_template('mentions.html', message_list=messages, has_more=has_more,
+        before=before)
+
 @bp.route('/explore/')
 def public_timeline():
-    messages = Visibility(Message
-                .select()
-                .order_by(Message.pub_date.desc()), True)
+    messages = Visibility(get_public_timeline_query(), True)
     return object_list('explore.html', messages, 'message_list')
 
 @bp.route('/signup/', methods=['GET', 'POST'])
@@ -111,12 +121,15 @@ def logout():
 
 @bp.route('/+<username>/')
 def user_detail(username):
-    user = get_object_or_404(User, User.username == username)
+    # changed in 0.9: the profile header is loaded in one query, as a
+    # ProfileView (see `app.profiles`)
+    user = get_profile_view(User.username == username, viewer=get_current_user())
+    if user is None:
+        abort(404)
 
-    # get all the users messages ordered newest-first -- note how we're accessing
-    # the messages -- user.message_set.  could also have written it as:
-    # Message.select().where(Message.user == user)
-    messages = Visibility(user.messages.order_by(Message.pub_date.desc()))
+    # get all the users messages ordered newest-first; changed in 0.9:
+    # archived messages included
+    messages = Visibility(user_messages(user.id))
     # TODO change to "profile.html"
     return object_list('user_detail.html', messages, 'message_list', user=user)
 
@@ -149,6 +162,7 @@ def user_unfollow(username):
          (Relationship.from_user == cur_user) &
          (Relationship.to_user == user))
      .execute())
+    invalidate_cache('follows:{}'.format(cur_user.id), 'follows:{}'.format(user.id))
     flash('You are no longer following %s' % user.username)
     unpush_notification('follow', user, user=cur_user.id)
     return redirect(url_for('website.user_detail', username=user.username))
@@ -181,14 +195,9 @@ def create():
             privacy=privacy)
         file = request.files.get('file')
         if file:
-            print('Uploading', file.filename)
-            ext = file.filename.split('.')[-1]
-            upload = Upload.create(
-                type=ext,
-                message=message
-            )
-            file.save(UPLOAD_DIRECTORY + str(upload.id) + '.' + ext)
-        create_mentions(user, text, privacy)
+            # changed in 0.9: see `app.storage`
+            save_upload(file, message)
+        create_mentions(user, text, privacy, message)
         flash('Your message has been posted successfully')
         return redirect(url_for('website.user_detail', username=user.username))
     return render_template('create.html')
@@ -210,22 +219,7 @@ def edit(id):
             pub_date=datetime.datetime.now()
         ).where(Message.id == id).execute()
         # edit uploads (skipped for now)
-        # create mentions
-        mention_usernames = set()
-        for mo in re.finditer(r'\+([A-Za-z0-9_]+(?:\.[A-Za-z0-9_]+)*)', text):
-            mention_usernames.add(mo.group(1))
-        # to avoid self mention
-        mention_usernames.difference_update({user.username})
-        for u in mention_usernames:
-            try:
-                mention_user = User.get(User.username == u)
-                if privacy in (MSGPRV_PUBLIC, MSGPRV_UNLISTED) or \
-                        (privacy == MSGPRV_FRIENDS and
-                        mention_user.is_following(user) and 
-                        user.is_following(mention_user)):
-                    push_notification('mention', mention_user, user=user.id)
-            except User.DoesNotExist:
-                pass
+        create_mentions(user, text, privacy, message)
         flash('Your message has been edited successfully')
         return redirect(url_for('website.user_detail', username=user.username))
     return render_template('edit.html', message=message)
@@ -266,12 +260,14 @@ def edit_profile():
         if username != user.username:
             try:
                 User.update(username=username).where(User.id == user.id).execute()
+                invalidate_cache('user:{}'.format(user.id))
             except IntegrityError:
                 flash('That username is already taken')
                 return render_template('edit_profile.html', profile=profile_checkpoint())
         full_name = request.form['full_name'] or username
         if full_name != user.full_name:
             User.update(full_name=full_name).where(User.id == user.id).execute()
+            invalidate_cache('user:{}'.format(user.id))
         website = request.form['website'].strip().replace(' ', '%20')
         if website and not validate_website(website):
             flash('You should enter a valid URL.')
@@ -288,6 +284,7 @@ def edit_profile():
             facebook=request.form['facebook'],
             telegram=request.form['telegram']
         ).where(UserProfile.user == user).execute()
+        invalidate_cache('user:{}'.format(user.id))
         return redirect(url_for('website.user_detail', username=username))
     return render_template('edit_profile.html')
 
@@ -331,6 +328,14 @@ def notifications():
          .execute())
     return object_list('notifications.html', notifications, 'notification_list', json=json, User=User)
 
+# New in 0.9.
+@bp.route('/notifications/stream')
+@login_required
+def notifications_stream():
+    if not is_stream_enabled():
+        abort(404)
+    return notification_stream_response(get_current_user())
+
 @bp.route('/about/')
 def about():
     return render_template('about.html', version=app_version,
@@ -0,0 +1,10 @@
+'''
+Benchmarks for Cori+.
+
+Every benchmark runs against a scratch database seeded with fake data,
+so it never touches `coriplus.sqlite`. Run them from the package's
+parent directory, e.g. `python -m benchmarks.bench_serialization`.
+
+`benchmarks.replay` is the exception: it replays recorded traffic against
+a local instance and its database.
+'''
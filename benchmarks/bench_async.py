@@ -0,0 +1,153 @@
+'''
+Compare the sync (WSGI) and async (ASGI) serving modes under many slow
+clients, with the same number of worker threads.
+
+Every client sends its request slowly and reads the response slowly
+(`--delay` seconds each way). A sync worker is busy during the whole
+exchange, while the async mode only takes a thread while the view runs.
+
+With `--streams`, as many notification streams are kept open during the
+async run, to check that they don't hold up the other requests: they run
+into their own pool of `--max-streams` threads, and the streams over that
+are refused with a 503. They are left out of the sync run, where they
+would hold every worker.
+
+New in 0.9.
+'''
+
+import argparse, asyncio, os, statistics, time
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.test import EnvironBuilder
+from .common import setup_database, seed
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument('-c', '--clients', type=int, default=64,
+    help='How many concurrent clients.')
+arg_parser.add_argument('-n', '--requests', type=int, default=3,
+    help='How many requests per client.')
+arg_parser.add_argument('-w', '--workers', type=int, default=8,
+    help='How many worker threads, in both modes.')
+arg_parser.add_argument('--delay', type=float, default=0.1,
+    help='Seconds a client takes to send the request, and to read the response.')
+arg_parser.add_argument('--path', default='/api/V1/profile_info/self',
+    help='The endpoint to request.')
+arg_parser.add_argument('--streams', type=int, default=16,
+    help='How many notification streams to keep open in the async run.')
+arg_parser.add_argument('--max-streams', type=int, default=8,
+    help='How many streams the async mode serves at once.')
+
+def report(name, wall, latencies):
+    latencies.sort()
+    print('{:<6} {:>6} requests in {:6.2f}s: {:7.1f} req/s, latency p50 {:6.3f}s, '
+        'p95 {:6.3f}s'.format(name, len(latencies), wall, len(latencies) / wall,
+        statistics.median(latencies), latencies[int(len(latencies) * .95) - 1]))
+
+def run_sync(app, args, query_string):
+    def client(start):
+        # the first request waits for a free worker too
+        latencies = []
+        for i in range(args.requests):
+            if i:
+                start = time.perf_counter()
+            time.sleep(args.delay)
+            builder = EnvironBuilder(path=args.path, query_string=query_string)
+            environ = builder.get_environ()
+            builder.close()
+            iterable = app(environ, lambda status, headers, exc_info=None: None)
+            b''.join(iterable)
+            iterable.close()
+            time.sleep(args.delay)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.workers) as executor:
+        futures = [executor.submit(client, start) for i in range(args.clients)]
+        latencies = [x for f in futures for x in f.result()]
+    report('sync', time.perf_counter() - start, latencies)
+
+def run_async(app, args, query_string):
+    from app.asgi import AsyncApp
+    asgi_app = AsyncApp(app, max_workers=args.workers, max_streams=args.max_streams)
+    stream_statuses = []
+    async def stream(closed):
+        sent_body = False
+        async def receive():
+            nonlocal sent_body
+            if not sent_body:
+                sent_body = True
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await closed.wait()
+            return {'type': 'http.disconnect'}
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                stream_statuses.append(message['status'])
+        scope = {'type': 'http', 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': '/api/V1/notifications/stream', 'query_string': query_string.encode(),
+            'headers': [], 'server': ('localhost', 80), 'client': ('127.0.0.1', 12345)}
+        await asgi_app(scope, receive, send)
+    async def request():
+        done = asyncio.Event()
+        sent_body = False
+        async def receive():
+            nonlocal sent_body
+            if not sent_body:
+                await asyncio.sleep(args.delay)
+                sent_body = True
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await done.wait()
+            return {'type': 'http.disconnect'}
+        async def send(message):
+            if message['type'] == 'http.response.body' and not message.get('more_body'):
+                await asyncio.sleep(args.delay)
+        scope = {'type': 'http', 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': args.path, 'query_string': query_string.encode(), 'headers': [],
+            'server': ('localhost', 80), 'client': ('127.0.0.1', 12345)}
+        await asgi_app(scope, receive, send)
+        done.set()
+    async def client():
+        latencies = []
+        for i in range(args.requests):
+            start = time.perf_counter()
+            await request()
+            latencies.append(time.perf_counter() - start)
+        return latencies
+    async def main():
+        closed = asyncio.Event()
+        streams = [asyncio.ensure_future(stream(closed)) for i in range(args.streams)]
+        # every stream is open (or refused) before the clients start
+        while len(stream_statuses) < args.streams:
+            await asyncio.sleep(0.01)
+        results = await asyncio.gather(*[client() for i in range(args.clients)])
+        closed.set()
+        await asyncio.gather(*streams)
+        return [x for r in results for x in r]
+    start = time.perf_counter()
+    latencies = asyncio.run(main())
+    report('async', time.perf_counter() - start, latencies)
+    if args.streams:
+        print('{} streams open meanwhile, {} refused with 503'.format(
+            stream_statuses.count(200), stream_statuses.count(503)))
+    asgi_app.executor.shutdown()
+    asgi_app.stream_executor.shutdown()
+
+def main():
+    args = arg_parser.parse_args()
+    path = setup_database()
+    try:
+        from app import create_app
+        # a short heartbeat, for closed streams to end soon
+        app = create_app({'DATABASE': path, 'SSE_ENABLED': True, 'SSE_HEARTBEAT': 0.5})
+        from app.models import User
+        from app.utils import generate_access_token
+        user_ids = seed(users=20, messages_per_user=20)
+        with app.app_context():
+            query_string = 'access_token=' + generate_access_token(User[user_ids[0]])
+        print('{} clients x {} requests, {} workers, {}s delay each way'.format(
+            args.clients, args.requests, args.workers, args.delay))
+        run_sync(app, args, query_string)
+        run_async(app, args, query_string)
+    finally:
+        os.remove(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+'''
+Measure the serialization and compression cost of the API responses,
+per endpoint: JSON encoding with the standard library and with orjson
+(if installed), and gzip compression of the encoded body.
+
+New in 0.9.
+'''
+
+import argparse, gzip, os
+from .common import setup_database, seed, timeit
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument('-n', '--number', type=int, default=200,
+    help='How many times each operation is repeated.')
+arg_parser.add_argument('--level', type=int, default=6,
+    help='The gzip compression level.')
+
+ENDPOINTS = [
+    ('api.feed', {}),
+    ('api.explore', {}),
+    ('api.profile_info', {'userid': 'self'}),
+    ('api.profile_feed', {'userid': 'self'}),
+    ('api.notifications_count', {}),
+]
+
+def main():
+    args = arg_parser.parse_args()
+    path = setup_database()
+    try:
+        from app import create_app
+        app = create_app({'DATABASE': path})
+        from app.models import User
+        from app.utils import generate_access_token
+        from app.jsonprovider import FastJSONProvider, orjson
+        from flask.json.provider import DefaultJSONProvider
+        user_ids = seed()
+        user = User[user_ids[0]]
+        providers = [('stdlib', DefaultJSONProvider(app))]
+        if orjson is not None:
+            providers.append(('orjson', FastJSONProvider(app)))
+        print('{:<28}{:>8}{:>8}'.format('endpoint', 'bytes', 'gzipped') +
+            ''.join('{:>12}'.format(name + ' us') for name, p in providers) +
+            '{:>12}'.format('gzip us'))
+        for endpoint, view_args in ENDPOINTS:
+            with app.test_request_context(query_string={
+                    'access_token': generate_access_token(user)}):
+                result = app.view_functions[endpoint].__wrapped__(user, **view_args)
+            timings = [timeit(lambda: p.dumps(result), args.number) for n, p in providers]
+            data = providers[0][1].dumps(result).encode('utf-8')
+            compressed = gzip.compress(data, args.level)
+            gzip_time = timeit(lambda: gzip.compress(data, args.level), args.number)
+            print('{:<28}{:>8}{:>8}'.format(endpoint, len(data), len(compressed)) +
+                ''.join('{:>12.1f}'.format(t) for t in timings) +
+                '{:>12.1f}'.format(gzip_time))
+    finally:
+        os.remove(path)
+
+if __name__ == '__main__':
+    main()
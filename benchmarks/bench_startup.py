@@ -0,0 +1,66 @@
+'''
+Measure the cold start of the app: how long it takes a fresh interpreter
+to import the package, to create the app and to serve the first requests.
+
+Each run spawns a new interpreter, so nothing is shared between runs
+except the template bytecode cache (unless `--no-bytecode-cache` is given).
+
+New in 0.9.
+'''
+
+import argparse, json, os, statistics, subprocess, sys, tempfile
+from .common import setup_database
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument('-n', '--runs', type=int, default=10,
+    help='How many fresh interpreters to spawn.')
+arg_parser.add_argument('--no-bytecode-cache', action='store_true',
+    help='Disable the template bytecode cache.')
+
+# Run in the child interpreter; prints timings, in seconds, as JSON.
+CHILD_SCRIPT = '''
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+flask_app = app.create_app()
+created = time.perf_counter()
+client = flask_app.test_client()
+client.get('/login/')
+first_html = time.perf_counter()
+client.get('/api/V1/explore')
+first_api = time.perf_counter()
+print(json.dumps({
+    'import': imported - start,
+    'create_app': created - imported,
+    'first html request': first_html - created,
+    'first api request': first_api - first_html,
+    'total': first_api - start,
+}))
+'''
+
+def main():
+    args = arg_parser.parse_args()
+    path = setup_database()
+    env = dict(os.environ, CORIPLUS_DATABASE=json.dumps(path))
+    if args.no_bytecode_cache:
+        env['CORIPLUS_TEMPLATE_BYTECODE_CACHE'] = 'false'
+    else:
+        env['CORIPLUS_TEMPLATE_CACHE_DIR'] = json.dumps(
+            tempfile.mkdtemp(prefix='coriplus-bench-jinja-'))
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    timings = []
+    try:
+        for i in range(args.runs):
+            output = subprocess.run([sys.executable, '-c', CHILD_SCRIPT], env=env,
+                cwd=root, check=True, capture_output=True, text=True).stdout
+            timings.append(json.loads(output.splitlines()[-1]))
+    finally:
+        os.remove(path)
+    print('median of {} cold starts:'.format(len(timings)))
+    for key in timings[0]:
+        print('{:<20} {:8.1f}ms'.format(key,
+            statistics.median(t[key] for t in timings) * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+'''
+Helpers shared by the benchmarks.
+'''
+
+import datetime, os, random, tempfile, time
+
+def setup_database(path=None):
+    '''
+    Point the app at a scratch database, creating the tables.
+    Return the database path.
+    '''
+    from app.models import init_database, create_tables
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix='.sqlite', prefix='coriplus-bench-')
+        os.close(fd)
+    init_database(path)
+    create_tables()
+    return path
+
+def seed(users=50, messages_per_user=40, follows_per_user=10, seed=42):
+    '''
+    Fill the database with fake users, follows, messages and upvotes.
+    '''
+    from app.models import database, User, UserProfile, Message, Relationship, \
+        MessageUpvote
+    from app.utils import pwdhash
+    rnd = random.Random(seed)
+    now = datetime.datetime.now()
+    with database.atomic():
+        User.insert_many([{
+            'username': 'user%d' % i,
+            'full_name': 'User Number %d' % i,
+            'password': pwdhash('password'),
+            'email': 'user%d@example.com' % i,
+            'birthday': datetime.date(1990, 1, 1),
+            'join_date': now,
+        } for i in range(users)]).execute()
+        user_ids = [x for x, in User.select(User.id).tuples()]
+        UserProfile.insert_many([{'user': x, 'biography': 'Hello, world!'}
+            for x in user_ids]).execute()
+        Relationship.insert_many([{
+            'from_user': x, 'to_user': y, 'created_date': now
+        } for x in user_ids for y in rnd.sample(user_ids, follows_per_user)
+            if x != y]).execute()
+        rows = [{
+            'user': rnd.choice(user_ids),
+            'text': 'Message number %d, mentioning +user%d' % (i, rnd.randrange(users)),
+            'pub_date': now - datetime.timedelta(minutes=i),
+            'privacy': rnd.choice((0, 0, 0, 1, 2, 3)),
+        } for i in range(users * messages_per_user)]
+        for i in range(0, len(rows), 500):
+            Message.insert_many(rows[i:i+500]).execute()
+        message_ids = [x for x, in Message.select(Message.id).tuples()]
+        upvotes = {(rnd.choice(message_ids[:200]), rnd.choice(user_ids))
+            for i in range(users * 10)}
+        MessageUpvote.insert_many([{
+            'message': x, 'user': y, 'created_date': now
+        } for x, y in upvotes]).execute()
+    return user_ids
+
+def timeit(func, number=200):
+    '''
+    Return the mean time of func() in microseconds.
+    '''
+    func()
+    start = time.perf_counter()
+    for i in range(number):
+        func()
+    return (time.perf_counter() - start) / number * 1e6
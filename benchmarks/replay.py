@@ -0,0 +1,301 @@
+'''
+Replay a traffic trace recorded with `TRAFFIC_LOG` (see `app.traffic`)
+against a local instance, and report throughput and latency per route.
+
+Requests are sent at the pace they were recorded, sped up `--speedup`
+times, by `--workers` concurrent threads. The trace holds no values, so
+they are made up: row buckets are mapped to the users and messages of
+the local database, users are authenticated with a token or a session
+cookie, and other values are filled in after their shape.
+
+The local instance is configured as the app would be (`config.py`,
+`CORIPLUS_CONFIG`, `CORIPLUS_*` environment variables), so it must share
+the database and the secret key of the server at `--url`; with
+`--in-process` requests are sent to the app directly, without a server.
+Replaying writes to the database: point it at a copy.
+
+E.g. `python -m benchmarks.replay traffic.jsonl --speedup 10 --workers 16`.
+
+New in 0.9.
+'''
+
+import argparse, http.client, json, statistics, threading, time, urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.test import EnvironBuilder
+from io import BytesIO
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument('trace',
+    help='The JSONL file recorded with TRAFFIC_LOG.')
+arg_parser.add_argument('--url', default='http://127.0.0.1:5000',
+    help='The local instance to send requests to.')
+arg_parser.add_argument('--in-process', action='store_true',
+    help='Send requests to the app directly, instead of --url.')
+arg_parser.add_argument('-s', '--speedup', type=float, default=1.0,
+    help='How many times faster than recorded (0 sends them all at once).')
+arg_parser.add_argument('-w', '--workers', type=int, default=8,
+    help='How many concurrent workers.')
+arg_parser.add_argument('-n', '--limit', type=int, default=None,
+    help='Replay only the first requests of the trace.')
+arg_parser.add_argument('--read-only', action='store_true',
+    help='Skip the requests that are not GET or HEAD.')
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+class Replayer(object):
+    '''
+    Turns the records of a trace into requests against the local
+    database.
+    '''
+    def __init__(self, app):
+        from app.models import User, Message
+        self.app = app
+        self.adapter = app.url_map.bind('localhost')
+        self.users = list(User
+            .select(User.id, User.username, User.password)
+            .where(~User.is_disabled)
+            .order_by(User.id))
+        self.message_ids = [x for x, in Message
+            .select(Message.id)
+            .order_by(Message.id.desc())
+            .limit(10000)
+            .tuples()]
+        if not self.users:
+            raise SystemExit('no users in the local database')
+        self.tokens = {}
+        self.cookies = {}
+
+    def get_user(self, bucket):
+        return self.users[bucket % len(self.users)]
+
+    def get_message_id(self, bucket):
+        if not self.message_ids:
+            return 0
+        return self.message_ids[bucket % len(self.message_ids)]
+
+    def make_value(self, shape, ids=None):
+        '''
+        Return a value of the given shape.
+        '''
+        if not isinstance(shape, str):
+            return shape
+        kind, _, size = shape.partition(':')
+        if kind == 'int':
+            return 1
+        if kind == 'float':
+            return time.time()
+        if kind == 'ints':
+            return ','.join(str(ids(i)) for i in range(int(size)))
+        if kind == 'str':
+            return 'x' * int(size)
+        if kind == 'list':
+            return []
+        if kind == 'dict':
+            return {}
+        return shape
+
+    def make_view_arg(self, name, shape, bucket):
+        if bucket is None:
+            return shape
+        if shape.startswith('+'):
+            return '+' + self.make_view_arg(name, shape[1:], bucket)
+        if name in ('username', 'userid'):
+            user = self.get_user(bucket)
+            return user.id if shape == 'int' else user.username
+        if name == 'id':
+            return self.get_message_id(bucket)
+        return self.make_value(shape)
+
+    def get_auth(self, record):
+        '''
+        Return (query args, headers) authenticating the user of record.
+        '''
+        if record['user'] is None:
+            return {}, {}
+        user = self.get_user(record['user'])
+        if record['auth'] == 'token':
+            if user.id not in self.tokens:
+                from app.utils import generate_access_token
+                with self.app.app_context():
+                    self.tokens[user.id] = generate_access_token(user)
+            return {'access_token': self.tokens[user.id]}, {}
+        if user.id not in self.cookies:
+            serializer = self.app.session_interface.get_signing_serializer(self.app)
+            self.cookies[user.id] = '{}={}'.format(self.app.config['SESSION_COOKIE_NAME'],
+                serializer.dumps({'_user_id': str(user.id), '_fresh': True}))
+        return {}, {'Cookie': self.cookies[user.id]}
+
+    def make_request(self, record):
+        '''
+        Return the WSGI environ of the request of record, or None if it
+        can't be made.
+        '''
+        if record['endpoint'] is None:
+            return None
+        # ids of the same kind as the endpoint's
+        if 'user' in record['endpoint']:
+            ids = lambda i: self.users[i % len(self.users)].id
+        else:
+            ids = lambda i: self.message_ids[i % len(self.message_ids)] \
+                if self.message_ids else 0
+        values = {name: self.make_view_arg(name, shape, bucket)
+            for name, (shape, bucket) in record['view_args'].items()}
+        try:
+            path = self.adapter.build(record['endpoint'], values, method=record['method'])
+        except Exception:
+            return None
+        query, headers = self.get_auth(record)
+        for name, shape in record['args'].items():
+            query[name] = self.make_value(shape, ids)
+        kwargs = {}
+        body = record['body']
+        if body is not None:
+            fields = {name: self.make_value(shape, ids)
+                for name, shape in body['fields'].items()}
+            if body['type'] == 'json':
+                kwargs['json'] = fields
+            elif body['type'] == 'form':
+                for name, ext in body.get('files', {}).items():
+                    fields[name] = (BytesIO(b'\0' * 64), 'replay.' + ext)
+                kwargs['data'] = fields
+        builder = EnvironBuilder(path=path, method=record['method'],
+            query_string=urllib.parse.urlencode(query), headers=headers, **kwargs)
+        try:
+            return builder.get_environ()
+        finally:
+            builder.close()
+
+def send_http(url, local):
+    '''
+    Return a function sending a WSGI environ to the server at url, with a
+    connection per thread.
+    '''
+    netloc = urllib.parse.urlsplit(url).netloc
+    def send(environ):
+        connection = getattr(local, 'connection', None)
+        if connection is None:
+            connection = local.connection = http.client.HTTPConnection(netloc, timeout=60)
+        headers = {k[5:].replace('_', '-').title(): v
+            for k, v in environ.items() if k.startswith('HTTP_') and k != 'HTTP_HOST'}
+        if environ.get('CONTENT_TYPE'):
+            headers['Content-Type'] = environ['CONTENT_TYPE']
+        body = environ['wsgi.input'].read()
+        path = environ['PATH_INFO']
+        if environ['QUERY_STRING']:
+            path += '?' + environ['QUERY_STRING']
+        try:
+            connection.request(environ['REQUEST_METHOD'], path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            local.connection = None
+            return 0
+    return send
+
+def send_wsgi(app):
+    '''
+    Return a function sending a WSGI environ to app.
+    '''
+    def send(environ):
+        status = []
+        iterable = app(environ, lambda s, headers, exc_info=None: status.append(s))
+        try:
+            b''.join(iterable)
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+        return int(status[0].split()[0])
+    return send
+
+def load_trace(path, limit=None, read_only=False):
+    records = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if read_only and record['method'] not in ('GET', 'HEAD'):
+                continue
+            records.append(record)
+            if limit is not None and len(records) >= limit:
+                break
+    records.sort(key=lambda x: x['t'])
+    return records
+
+def replay(records, replayer, send, speedup=1.0, workers=8):
+    '''
+    Send the requests of records at their pace. Return a dict mapping
+    routes to lists of (latency, status, recorded duration), the wall
+    time and the start delays.
+    '''
+    results = {}
+    delays = []
+    lock = threading.Lock()
+    def run(route, environ, scheduled, record):
+        start = time.perf_counter()
+        status = send(environ)
+        latency = time.perf_counter() - start
+        with lock:
+            results.setdefault(route, []).append((latency, status, record['duration'] / 1000))
+            # how late it started, from waiting for a free worker
+            delays.append(start - scheduled)
+    t0 = records[0]['t']
+    skipped = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(workers) as executor:
+        for record in records:
+            # made ahead of time, so that it does not delay the schedule
+            environ = replayer.make_request(record)
+            if environ is None:
+                skipped += 1
+                continue
+            scheduled = start + ((record['t'] - t0) / speedup if speedup else 0)
+            wait = scheduled - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            route = '{} {}'.format(record['method'], record['rule'])
+            executor.submit(run, route, environ, scheduled, record)
+    return results, time.perf_counter() - start, delays, skipped
+
+def report(results, wall, delays, skipped):
+    total = sum(len(x) for x in results.values())
+    print('{:<48} {:>6} {:>6} {:>8} {:>8} {:>8} {:>8} {:>9}'.format(
+        'route', 'count', 'errors', 'req/s', 'p50', 'p95', 'p99', 'rec. p50'))
+    for route, rows in sorted(results.items(), key=lambda x: -len(x[1])):
+        latencies = sorted(x[0] for x in rows)
+        errors = sum(1 for x in rows if not 0 < x[1] < 500)
+        print('{:<48} {:>6} {:>6} {:>8.1f} {:>7.1f}ms {:>6.1f}ms {:>6.1f}ms {:>7.1f}ms'.format(
+            route[:48], len(rows), errors, len(rows) / wall,
+            percentile(latencies, .5) * 1000, percentile(latencies, .95) * 1000,
+            percentile(latencies, .99) * 1000,
+            statistics.median(x[2] for x in rows) * 1000))
+    print('{} requests in {:.2f}s: {:.1f} req/s, {} skipped'.format(
+        total, wall, total / wall, skipped))
+    if delays:
+        delays.sort()
+        print('start delay p50 {:.1f}ms, p95 {:.1f}ms, max {:.1f}ms'.format(
+            percentile(delays, .5) * 1000, percentile(delays, .95) * 1000, delays[-1] * 1000))
+
+def main():
+    args = arg_parser.parse_args()
+    records = load_trace(args.trace, args.limit, args.read_only)
+    if not records:
+        raise SystemExit('empty trace')
+    from app import create_app
+    from app.models import database
+    app = create_app({'TRAFFIC_LOG': None})
+    with database.connection_context():
+        replayer = Replayer(app)
+    if args.in_process:
+        send = send_wsgi(app)
+    else:
+        send = send_http(args.url, threading.local())
+    print('{} requests over {:.1f}s, {}x speedup, {} workers'.format(
+        len(records), records[-1]['t'] - records[0]['t'], args.speedup, args.workers))
+    report(*replay(records, replayer, send, args.speedup, args.workers))
+
+if __name__ == '__main__':
+    main()
@@ -8,9 +8,10 @@ parser = argparse.ArgumentParser()
 parser.add_argument('-p', '--port', type=int, default=5000,
     help='An alternative port where to run the server.')
 
-from app import app, create_tables
+from app import create_app, create_tables
 
 if __name__ == '__main__':
     args = parser.parse_args()
+    app = create_app()
     create_tables()
     app.run(port=args.port)